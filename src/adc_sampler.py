@@ -0,0 +1,150 @@
+'''
+Background ADC sampling - one thread per ADS7828 scans the configured channels at a fixed rate
+and publishes converted (and filtered) values into a double-buffered snapshot.
+
+The sampler writes the inactive buffer and then flips the active index. Readers copy the active
+buffer without taking a lock; a per-buffer sequence number (odd while being written) tells a
+reader to retry in the rare case the sampler lapped it.
+'''
+from array import array
+import threading
+import time
+
+import ads7828
+import channel_calibration
+
+class SamplerSnapshot:
+    '''Converted values of one scan - values[i] belongs to the sampler's channels[i]'''
+
+    def __init__(self, channel_count) -> None:
+        self.values = array('d', [float('NaN')] * channel_count)
+        self.timestamp = 0.0        # time.monotonic() of the scan
+        self.sample_number = 0      # 0 = no scan yet
+        self._write_sequence = 0    # Odd while the sampler is writing this buffer
+
+class SamplerStats:
+
+    def __init__(self, target_rate_hz, achieved_rate_hz, sample_count, overrun_count, last_scan_secs, max_scan_secs) -> None:
+        self.target_rate_hz = target_rate_hz
+        self.achieved_rate_hz = achieved_rate_hz
+        self.sample_count = sample_count
+        self.overrun_count = overrun_count
+        self.last_scan_secs = last_scan_secs
+        self.max_scan_secs = max_scan_secs
+
+    def __str__(self) -> str:
+        return (f"{self.achieved_rate_hz:.1f}/{self.target_rate_hz:.1f} Hz, {self.sample_count} samples, "
+                f"{self.overrun_count} overruns, scan {self.last_scan_secs * 1000:.2f} ms (max {self.max_scan_secs * 1000:.2f} ms)")
+
+class ContinuousSampler:
+
+    # Achieved rate is measured over this many seconds
+    RATE_WINDOW_SECS = 1.0
+
+    def __init__(self, adc : ads7828.ADS7828, channels, rate_hz=50.0,
+                 conversion : channel_calibration.ChannelConversion = None, apply_filters=True) -> None:
+        self._adc = adc
+        self.channels = tuple(channels)
+        self.rate_hz = rate_hz
+        self._period_secs = 1.0 / rate_hz
+        self._conversion = conversion if conversion != None else adc.create_voltage_conversion()
+        self._apply_filters = apply_filters
+        self._codes = array('H', bytes(2 * len(self.channels)))
+        self._buffers = (SamplerSnapshot(len(self.channels)), SamplerSnapshot(len(self.channels)))
+        self._active_index = 0
+        self._thread = None
+        self._stop_event = threading.Event()
+        # Stats - written by the sampler thread only
+        self._sample_count = 0
+        self._overrun_count = 0
+        self._last_scan_secs = 0.0
+        self._max_scan_secs = 0.0
+        self._achieved_rate_hz = 0.0
+        self._rate_window_start = None
+        self._rate_window_count = 0
+
+    def start(self) -> None:
+        '''Take the first scan synchronously, then keep sampling on a background thread'''
+        if self._thread != None:
+            return
+        self._stop_event.clear()
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name="adc-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1.0) -> None:
+        if self._thread == None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def is_running(self) -> bool:
+        return self._thread != None and self._thread.is_alive()
+
+    def get_snapshot(self, out : SamplerSnapshot = None) -> SamplerSnapshot:
+        '''Copy of the newest scan - pass out to reuse a snapshot between calls'''
+        if out == None:
+            out = SamplerSnapshot(len(self.channels))
+        while True:
+            buffer = self._buffers[self._active_index]
+            write_sequence = buffer._write_sequence
+            if write_sequence & 1:
+                continue
+            out.values[:] = buffer.values
+            out.timestamp = buffer.timestamp
+            out.sample_number = buffer.sample_number
+            if buffer._write_sequence == write_sequence:
+                return out
+
+    def get_stats(self) -> SamplerStats:
+        return SamplerStats(self.rate_hz, self._achieved_rate_hz, self._sample_count,
+                            self._overrun_count, self._last_scan_secs, self._max_scan_secs)
+
+    def _run(self):
+        next_deadline = time.monotonic() + self._period_secs
+        while not self._stop_event.is_set():
+            wait_secs = next_deadline - time.monotonic()
+            if wait_secs > 0:
+                if self._stop_event.wait(wait_secs):
+                    break
+            self._sample()
+            next_deadline += self._period_secs
+            now = time.monotonic()
+            if now > next_deadline:
+                # Scan (or the wait for the bus) ran past the next slot - skip the missed slots
+                self._overrun_count += 1
+                next_deadline = now + self._period_secs
+
+    def _sample(self):
+        scan_start = time.monotonic()
+        self._adc.scan(self.channels, self._codes)
+        values = self._conversion.convert_scan(self.channels, self._codes)
+        if self._apply_filters:
+            self._adc.apply_filters(self.channels, values)
+        scan_end = time.monotonic()
+        # Write the inactive buffer, then publish it
+        buffer = self._buffers[self._active_index ^ 1]
+        buffer._write_sequence += 1
+        for (index, value) in enumerate(values):
+            buffer.values[index] = value
+        buffer.timestamp = scan_start
+        buffer.sample_number = self._sample_count + 1
+        buffer._write_sequence += 1
+        self._active_index ^= 1
+        self._update_stats(scan_start, scan_end)
+
+    def _update_stats(self, scan_start, scan_end):
+        self._sample_count += 1
+        self._last_scan_secs = scan_end - scan_start
+        self._max_scan_secs = max(self._max_scan_secs, self._last_scan_secs)
+        if self._rate_window_start == None:
+            self._rate_window_start = scan_start
+            self._rate_window_count = 0
+            return
+        self._rate_window_count += 1
+        window_secs = scan_start - self._rate_window_start
+        if window_secs >= self.RATE_WINDOW_SECS:
+            self._achieved_rate_hz = self._rate_window_count / window_secs
+            self._rate_window_start = scan_start
+            self._rate_window_count = 0
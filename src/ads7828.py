@@ -1,11 +1,13 @@
-import smbus
 import time
 import datetime
 import math
 from random import random
 import os
+from array import array
 
 import channel_calibration
+import channel_filter
+import i2c_bus_manager
 
 class ADS7828:
     
@@ -15,11 +17,12 @@ class ADS7828:
     _error_counter = 0
     _sample_counter  = 0
     _channel_calibration = None
-    _average_window_depth = 5
-    _buffer_array = list()
+    _channel_filters = None
 
     # Constants
     full_scale_12bits = math.pow(2, 12)
+    vref_volts = 2.5
+    INVALID_CODE = 0xFFFF       # Raw code stored by scan() for a failed conversion
     _channel_reg_index = [0x000, 0b100, 0b001, 0b101, 0b010, 0b110, 0b011, 0b111]
     #_channel_reg_index = [0x000, 0b001, 0b010, 0b011, 0b100, 0b101, 0b110, 0b111]
     
@@ -38,7 +41,7 @@ class ADS7828:
 
     '''Initialize the ADS7828 object - fast init, no fail'''
     def __init__(self, i2c_bus=1, i2c_addr=0x48) -> None:
-        self.bus = smbus.SMBus(i2c_bus)
+        self.bus = i2c_bus_manager.resolve_bus(i2c_bus)
         self._i2c_addr = i2c_addr
         self._error_counter = 0
         self._sample_counter = 0
@@ -46,25 +49,103 @@ class ADS7828:
                                                                            init_channel_count=8)
         self._channel_4to20ma_calibration = channel_calibration.ChannelCalibration("ads7828_channel_4to20ma_calibration.json",
                                                                            init_channel_count=8)
+        # Command byte per channel - selects the channel and starts the conversion
+        self._command_bytes = [self._ch_index_to_command_byte(channel_index) for channel_index in range(8)]
+        # Calibration compiled once into per-channel gain/offset
+        self._uncalibrated_conversion = self.create_voltage_conversion(apply_calibration=False)
+        self._voltage_conversion = self.create_voltage_conversion()
+        self._4to20ma_conversion = channel_calibration.ChannelConversion(8, self.vref_volts / self.full_scale_12bits,
+                                                                         self._channel_4to20ma_calibration,
+                                                                         self.INVALID_CODE)
+        # Optional per-channel filter stage - pass-through until configured
+        self._channel_filters = [channel_filter.create_filter() for channel_index in range(8)]
         pass
+    
+    '''Filter a channel's converted values - filter_type is one of channel_filter.FILTER_*
+    After max_invalid_samples failed conversions in a row the filter outputs NaN.'''
+    def set_channel_filter(self, channel_index, filter_type, depth=5, max_invalid_samples=3) -> None:
+        self._ch_index_to_reg_index(channel_index)
+        self._channel_filters[channel_index] = channel_filter.create_filter(filter_type, depth, max_invalid_samples)
+    
+    '''The filter of a channel'''
+    def get_channel_filter(self, channel_index) -> channel_filter.ChannelFilter:
+        return self._channel_filters[channel_index]
+    
+    '''Run converted values through the channel filters in place - values[i] belongs to channels[i]'''
+    def apply_filters(self, channels, values) -> list:
+        filters = self._channel_filters
+        for (index, channel_index) in enumerate(channels):
+            values[index] = filters[channel_index].update(values[index])
+        return values
+    
+    '''New raw code to calibrated voltage conversion - add an engineering scale/offset per channel with set_engineering_scale()'''
+    def create_voltage_conversion(self, apply_calibration=True) -> channel_calibration.ChannelConversion:
+        calibration = self._channel_0to5V_calibration if apply_calibration else None
+        return channel_calibration.ChannelConversion(8, self.vref_volts / self.full_scale_12bits,
+                                                     calibration, self.INVALID_CODE)
+    
+    '''Convert one channel and return the raw 12-bit code - one I2C transaction, raises on a bus error'''
+    def read_raw_code(self, channel_index) -> int:
+        # The block read writes the command byte (starting the conversion) then reads the result
+        data = self.bus.read_i2c_block_data(self._i2c_addr, self._command_bytes[channel_index], 2,
+                                            priority=i2c_bus_manager.PRIORITY_TELEMETRY)
+        return ((data[0] & 0x0F) << 8) | data[1]
+    
+    '''Convert one channel back to back as fast as the bus allows (capture mode).
+    Fills codes (array('H')) and, when given, timestamps_ns (array('q'), time.monotonic_ns() after each
+    conversion). Failed conversions are stored as INVALID_CODE; returns the number of failures.'''
+    def read_raw_block(self, channel_index, codes : array, timestamps_ns : array = None) -> int:
+        bus = self.bus
+        i2c_addr = self._i2c_addr
+        command_byte = self._command_bytes[channel_index]
+        monotonic_ns = time.monotonic_ns
+        error_count = 0
+        for index in range(len(codes)):
+            try:
+                data = bus.read_i2c_block_data(i2c_addr, command_byte, 2, priority=i2c_bus_manager.PRIORITY_TELEMETRY)
+                codes[index] = ((data[0] & 0x0F) << 8) | data[1]
+            except Exception:
+                codes[index] = self.INVALID_CODE
+                error_count += 1
+            if timestamps_ns != None:
+                timestamps_ns[index] = monotonic_ns()
+        self._sample_counter += len(codes) - error_count
+        self._error_counter += error_count
+        return error_count
+
+    '''Convert a list of channels back to back and return the raw 12-bit codes.
+    out - optional preallocated array('H') of len(channels), reused between scans.
+    Failed conversions are counted as errors and stored as INVALID_CODE.'''
+    def scan(self, channels, out : array = None) -> array:
+        if out == None:
+            out = array('H', bytes(2 * len(channels)))
+        bus = self.bus
+        i2c_addr = self._i2c_addr
+        command_bytes = self._command_bytes
+        for (index, channel_index) in enumerate(channels):
+            try:
+                data = bus.read_i2c_block_data(i2c_addr, command_bytes[channel_index], 2,
+                                               priority=i2c_bus_manager.PRIORITY_TELEMETRY)
+                out[index] = ((data[0] & 0x0F) << 8) | data[1]
+                self._sample_counter += 1
+            except Exception as e:
+                print(e)
+                self._error_counter += 1
+                out[index] = self.INVALID_CODE
+        return out
             
     '''Return voltage for a given channel''' 
     def get_voltage_from_channel(self, channel_index, apply_calibration=True) -> float:
-        scale=2.5
-        channel_reg_index = self._ch_index_to_reg_index(channel_index)
-        command_byte = (self.adc_input_type << 7) + (channel_reg_index << 4 ) + (self.adc_power_config << 2) 
+        self._ch_index_to_reg_index(channel_index)
         adc_voltage = float('NaN')
         try:
-            self.bus.write_byte(self._i2c_addr, command_byte)
-            data = self.bus.read_i2c_block_data(self._i2c_addr, command_byte, 2)
-            raw_adc_bits = (data[0] & 0x0F) * 256 + data[1]
-            #print(f"ch_idx:{channel_index}\tcmd_byte:{command_byte:08b}\tdata:{raw_adc_bits:04x}")
-            # Raw / Uncalibrated Voltage
-            adc_voltage = (raw_adc_bits / self.full_scale_12bits) * scale
-            # Apply Channel Calibration
+            raw_adc_bits = self.read_raw_code(channel_index)
+            #print(f"ch_idx:{channel_index}\tdata:{raw_adc_bits:04x}")
+            # Raw code to voltage, with or without channel calibration
             if apply_calibration:
-                ch_cal = self._channel_0to5V_calibration.get_scale_offset(channel_index)
-                adc_voltage = adc_voltage * ch_cal.scale + ch_cal.offset
+                adc_voltage = self._voltage_conversion.convert(channel_index, raw_adc_bits)
+            else:
+                adc_voltage = self._uncalibrated_conversion.convert(channel_index, raw_adc_bits)
             self._sample_counter += 1
         except Exception as e:
             print(e)
@@ -74,20 +155,13 @@ class ADS7828:
 
     '''Return voltage for a given channel''' 
     def get_4to20ma_from_channel(self, channel_index) -> float:
-        scale=2.5
-        channel_reg_index = self._ch_index_to_reg_index(channel_index)
-        command_byte = (self.adc_input_type << 7) + (channel_reg_index << 4 ) + (self.adc_power_config << 2) 
+        self._ch_index_to_reg_index(channel_index)
         adc_voltage = float('NaN')
         try:
-            self.bus.write_byte(self._i2c_addr, command_byte)
-            data = self.bus.read_i2c_block_data(self._i2c_addr, command_byte, 2)
-            raw_adc_bits = (data[0] & 0x0F) * 256 + data[1]
-            #print(f"ch_idx:{channel_reg_index}\tcmd_byte:{command_byte:08b}\tdata:{raw_adc_bits:04x}")
-            # Raw / Uncalibrated Voltage
-            adc_voltage = (raw_adc_bits / self.full_scale_12bits) * scale
-            # Apply Channel Calibration
-            ch_cal = self._channel_4to20ma_calibration.get_scale_offset(channel_index)
-            adc_voltage = adc_voltage * ch_cal.scale + ch_cal.offset
+            raw_adc_bits = self.read_raw_code(channel_index)
+            #print(f"ch_idx:{channel_index}\tdata:{raw_adc_bits:04x}")
+            # Raw code to calibrated 4-20mA channel value
+            adc_voltage = self._4to20ma_conversion.convert(channel_index, raw_adc_bits)
             self._sample_counter += 1
         except Exception as e:
             print(e)
@@ -97,17 +171,14 @@ class ADS7828:
     
     '''Read 8 channels and return list of voltages''' 
     def get_voltages_from_device(self, apply_calibration=True) -> list:
-        voltages = list()
-        for channel_index in range(8):
-            voltages.append(self.get_voltage_from_channel(channel_index, apply_calibration))
-        return voltages
+        channels = range(8)
+        conversion = self._voltage_conversion if apply_calibration else self._uncalibrated_conversion
+        return conversion.convert_scan(channels, self.scan(channels))
 
     '''Read 8 channels and return list of voltages''' 
     def get_currents_from_device(self) -> list:
-        currents = list()
-        for channel_index in range(8):
-            currents.append(self.get_4to20ma_from_channel(channel_index))
-        return currents
+        channels = range(8)
+        return self._4to20ma_conversion.convert_scan(channels, self.scan(channels))
     
     '''Print a static table of data to the console'''
     def print_data_table(self, data_dict):
@@ -138,6 +209,11 @@ class ADS7828:
             line_str = line_str + f'{str(item):^10}' + "|"
         print(line_str)
 
+    '''Build the I2C command byte for a channel index'''
+    def _ch_index_to_command_byte(self, adc_channel_index) -> int:
+        channel_reg_index = self._ch_index_to_reg_index(adc_channel_index)
+        return (self.adc_input_type << 7) + (channel_reg_index << 4 ) + (self.adc_power_config << 2)
+
     '''Convert numerical channel index to register value'''
     def _ch_index_to_reg_index(self, adc_channel_index) -> int:
         if adc_channel_index >= 0 and adc_channel_index <= 7:
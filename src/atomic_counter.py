@@ -0,0 +1,54 @@
+'''
+Event counter safe to increment from several threads without a lock on the increment path.
+
+Each incrementing thread owns a shard (a one-element list) that only it writes, so no increment
+can be lost to a read-modify-write race. The value is the sum of the shards minus a baseline.
+set(), reset() and snapshot_and_reset() only move the baseline (under a lock shared by the
+readers) and never write a shard, so edges that arrive while they run are kept.
+'''
+import threading
+
+class AtomicCounter:
+
+    def __init__(self, value=0) -> None:
+        self._shards = list()
+        self._local = threading.local()
+        self._shard_lock = threading.Lock()
+        self._reader_lock = threading.Lock()
+        self._baseline = -value
+
+    def increment(self, amount=1) -> None:
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._add_shard()
+        shard[0] += amount
+
+    def value(self) -> int:
+        with self._reader_lock:
+            return self._total() - self._baseline
+
+    def set(self, value) -> None:
+        with self._reader_lock:
+            self._baseline = self._total() - value
+
+    def reset(self) -> None:
+        self.set(0)
+
+    def snapshot_and_reset(self) -> int:
+        '''Count since the last reset, and reset - every increment lands in exactly one snapshot'''
+        with self._reader_lock:
+            total = self._total()
+            value = total - self._baseline
+            self._baseline = total
+            return value
+
+    def _total(self) -> int:
+        return sum(shard[0] for shard in tuple(self._shards))
+
+    def _add_shard(self) -> list:
+        shard = [0]
+        self._local.shard = shard
+        with self._shard_lock:
+            self._shards.append(shard)
+        return shard
@@ -53,6 +53,9 @@ class BallValve:
     VALVE_POSITION_UNKNOWN = 0
     VALVE_POSITION_OPEN = 1
     VALVE_POSITION_CLOSE = 2
+    _VALVE_POSITION_STRINGS = {VALVE_POSITION_UNKNOWN: "Unknown",
+                               VALVE_POSITION_OPEN: "Open",
+                               VALVE_POSITION_CLOSE: "Closed"}
     
     # Private Members
     _state = STATE_INIT
@@ -117,11 +120,11 @@ class BallValve:
             time_remaining = self._timer.time_remaining_seconds()  
         return ValveState(current_state, time_remaining)
     
-    def is_open(self) -> bool:
-        return self.get_valve_position() == self.VALVE_POSITION_OPEN
+    def is_open(self, port_snapshot : mcp23017.PortSnapshot = None) -> bool:
+        return self.get_valve_position(port_snapshot) == self.VALVE_POSITION_OPEN
     
-    def is_closed(self) -> bool:
-        return self.get_valve_position() == self.VALVE_POSITION_CLOSE
+    def is_closed(self, port_snapshot : mcp23017.PortSnapshot = None) -> bool:
+        return self.get_valve_position(port_snapshot) == self.VALVE_POSITION_CLOSE
     
     def is_timedout(self) -> bool:
         return self._timed_out
@@ -134,7 +137,8 @@ class BallValve:
                                       BallValve.STATE_CLOSING)
              
     '''Public API: This should be called in a loop to process the ball valve state and transition timeouts'''
-    def process(self):
+    '''port_snapshot: optional port read shared by all valves on the expander - read from the chip if None'''
+    def process(self, port_snapshot : mcp23017.PortSnapshot = None):
         # Big ol' State Machine
         # STATE_INIT 
         if self._state == self.STATE_INIT:
@@ -162,7 +166,7 @@ class BallValve:
         
         # STATE_OPENING
         elif self._state == self.STATE_OPENING:
-            valve_position = self.get_valve_position()
+            valve_position = self.get_valve_position(port_snapshot)
             if valve_position == self.VALVE_POSITION_OPEN:
                 self._change_state(self.STATE_OPEN, f"Valve Opened - moving to OPEN state.")  
                 self._timed_out = False              
@@ -188,7 +192,7 @@ class BallValve:
         
         # STATE_CLOSING
         elif self._state == self.STATE_CLOSING:
-            valve_position = self.get_valve_position()
+            valve_position = self.get_valve_position(port_snapshot)
             if valve_position == self.VALVE_POSITION_CLOSE:
                 self._change_state(self.STATE_CLOSED, f"Valve Closed. Returning to IDLE state.")  
                 self._timed_out = False 
@@ -218,35 +222,38 @@ class BallValve:
             
     '''Read the state of the open input pin and return True if the ball valve is open, False otherwise'''
     '''VALVE_POSITION_UNKNOWN, VALVE_POSITION_OPEN, or VALVE_POSITION_CLOSE'''
-    def get_valve_position(self) -> int:
-        valve_position = self.VALVE_POSITION_UNKNOWN
-        valve_position_string = "Unknown"
-        open_pin_state = self._mcp_io.read_kitchensink_dinput(self._open_pin)
-        close_pin_state = self._mcp_io.read_kitchensink_dinput(self._close_pin)
+    '''The pins are evaluated against port_snapshot when provided, otherwise read in one port snapshot'''
+    def get_valve_position(self, port_snapshot : mcp23017.PortSnapshot = None) -> int:
+        valve_position = self.peek_valve_position(port_snapshot)
+        self._emit_valve_position_change_callback(self._VALVE_POSITION_STRINGS[valve_position])
+        return valve_position
+    
+    '''Same as get_valve_position without the position change callback'''
+    def peek_valve_position(self, port_snapshot : mcp23017.PortSnapshot = None) -> int:
+        if port_snapshot == None:
+            port_snapshot = self._mcp_io.read_port_snapshot()
+        open_pin_state = port_snapshot.read_pin(self._open_pin)
+        close_pin_state = port_snapshot.read_pin(self._close_pin)
         if (open_pin_state) and (not close_pin_state):
-            valve_position = self.VALVE_POSITION_CLOSE
-            valve_position_string = "Closed"
+            return self.VALVE_POSITION_CLOSE
         elif (not open_pin_state) and (close_pin_state):
-            valve_position = self.VALVE_POSITION_OPEN
-            valve_position_string = "Open"
-        self._emit_valve_position_change_callback(valve_position_string)
-        return valve_position
+            return self.VALVE_POSITION_OPEN
+        return self.VALVE_POSITION_UNKNOWN
                       
     '''Change the drive pin state using the TRANSITION values'''
     '''TRANSITION_NONE, TRANSITION_OPEN, or TRANSITION_CLOSE'''
     def _set_drive_state(self, transition : int):
         if transition == self.TRANSITION_NONE:
-            self._mcp_io.write_kitchensink_doutput(self._direction_pin, False)
-            self._mcp_io.write_kitchensink_doutput(self._enable_pin, False)
+            direction, enable = False, False
         elif transition == self.TRANSITION_OPEN:
-            self._mcp_io.write_kitchensink_doutput(self._direction_pin, False)
-            self._mcp_io.write_kitchensink_doutput(self._enable_pin, True)
+            direction, enable = False, True
         elif transition == self.TRANSITION_CLOSE:
-            self._mcp_io.write_kitchensink_doutput(self._direction_pin, True)
-            self._mcp_io.write_kitchensink_doutput(self._enable_pin, True)
+            direction, enable = True, True
         else:
             raise Exception("_set_drive_state:: Unknown drive state transition")
-        pass
+        # Direction and enable change together so the H-bridge never sees a mixed state
+        self._mcp_io.write_kitchensink_doutputs({self._direction_pin: direction,
+                                                 self._enable_pin: enable})
     
     '''Emit a state change event to the caller if the state change callback is set'''
     def _emit_state_change_event(self, new_state:int, err_message : str):
@@ -0,0 +1,95 @@
+'''
+Benchmark of the flow counter paths: several threads hammer a counter with simulated edges while
+a reader takes snapshot-and-reset intervals, then the counted total is checked against the edges sent.
+
+    python bench_din_counter.py [--threads 4] [--edges 200000] [--switch-interval-us 5]
+
+Compares a plain attribute counter (the old DinCounter behaviour, read then reset from another
+thread) with AtomicCounter, and measures single-thread DinCounter.Counter.increment() throughput.
+'''
+import argparse
+import sys
+import threading
+import time
+
+from atomic_counter import AtomicCounter
+import din_counter
+
+class PlainCounter:
+    '''count += 1 on the edge thread, read-then-zero on the reader thread'''
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def increment(self) -> None:
+        self.count += 1
+
+    def snapshot_and_reset(self) -> int:
+        value = self.count
+        # The old main loop published and stored the count before zeroing it - edges in between were lost.
+        # Without the yield the GIL rarely switches inside this window and the race stays hidden.
+        time.sleep(0)
+        self.count = 0
+        return value
+
+class BenchResult:
+
+    def __init__(self, name, edges_sent, edges_counted, elapsed_secs, snapshots) -> None:
+        self.name = name
+        self.edges_sent = edges_sent
+        self.edges_counted = edges_counted
+        self.elapsed_secs = elapsed_secs
+        self.snapshots = snapshots
+
+    def __str__(self) -> str:
+        lost = self.edges_sent - self.edges_counted
+        return (f"{self.name:<14} {self.edges_sent / self.elapsed_secs / 1e6:6.2f} M edges/s   "
+                f"sent {self.edges_sent}   counted {self.edges_counted}   lost {lost}   snapshots {self.snapshots}")
+
+def hammer(name, counter, thread_count, edges_per_thread) -> BenchResult:
+    '''Edge threads increment while the calling thread takes snapshot-and-reset intervals'''
+    start_barrier = threading.Barrier(thread_count + 1)
+    def send_edges():
+        increment = counter.increment
+        start_barrier.wait()
+        for edge_index in range(edges_per_thread):
+            increment()
+    threads = [threading.Thread(target=send_edges) for thread_index in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    start_time = time.perf_counter()
+    edges_counted = 0
+    snapshots = 0
+    while any(thread.is_alive() for thread in threads):
+        edges_counted += counter.snapshot_and_reset()
+        snapshots += 1
+        time.sleep(0)
+    elapsed_secs = time.perf_counter() - start_time
+    edges_counted += counter.snapshot_and_reset()
+    return BenchResult(name, thread_count * edges_per_thread, edges_counted, elapsed_secs, snapshots + 1)
+
+def bench_din_counter_increment(edge_count) -> float:
+    '''Edges per second through DinCounter.Counter.increment (no debounce, one thread)'''
+    counter = din_counter.DinCounter.Counter(bcm_pin=16, debounce_ms=0)
+    start_time = time.perf_counter()
+    for edge_index in range(edge_count):
+        counter.increment()
+    elapsed_secs = time.perf_counter() - start_time
+    if counter.get_count() != edge_count:
+        print(f"DinCounter.Counter lost edges: {edge_count - counter.get_count()}")
+    return edge_count / elapsed_secs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="DinCounter counter benchmark")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--edges", type=int, default=200000, help="edges per thread")
+    parser.add_argument("--switch-interval-us", type=float, default=5,
+                        help="interpreter thread switch interval - smaller provokes more races")
+    args = parser.parse_args()
+
+    sys.setswitchinterval(args.switch_interval_us / 1e6)
+    print(f"{args.threads} edge threads x {args.edges} edges, switch interval {args.switch_interval_us} us")
+    print(hammer("PlainCounter", PlainCounter(), args.threads, args.edges))
+    print(hammer("AtomicCounter", AtomicCounter(), args.threads, args.edges))
+    print(f"DinCounter.Counter.increment: {bench_din_counter_increment(args.edges) / 1e6:.2f} M edges/s (one thread)")
@@ -8,6 +8,14 @@
 import os
 from os.path import exists
 import json
+from array import array
+from bisect import bisect_right
+
+# numpy is optional - block conversions fall back to pure Python without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class ScaleOffset:
     scale = None
@@ -17,6 +25,84 @@ class ScaleOffset:
         self.scale = 1.0
         self.offset = 0
     
+
+# Calibration curve types - a channel entry in the calibration file is one of:
+#   {"scale": 1.0, "offset": 0}                                 linear
+#   {"type": "piecewise", "points": [[x0, y0], [x1, y1], ...]}  piecewise-linear, extrapolated past the end points
+#   {"type": "polynomial", "coefficients": [c0, c1, c2, ...]}   y = c0 + c1*x + c2*x^2 + ...
+# x is the channel voltage. Non-linear curves are compiled into a lookup table indexed by the raw ADC code.
+CURVE_LINEAR = "linear"
+CURVE_PIECEWISE = "piecewise"
+CURVE_POLYNOMIAL = "polynomial"
+
+class LinearCurve:
+    
+    def __init__(self, scale=1.0, offset=0.0) -> None:
+        self.scale = float(scale)
+        self.offset = float(offset)
+    
+    def evaluate(self, x) -> float:
+        return self.scale * x + self.offset
+    
+    def to_dict(self) -> dict:
+        return {'scale': self.scale, 'offset': self.offset}
+
+class PiecewiseLinearCurve:
+    
+    def __init__(self, points) -> None:
+        if len(points) < 2:
+            raise Exception("PiecewiseLinearCurve: at least two points are required")
+        self.points = sorted([float(x), float(y)] for (x, y) in points)
+        self._xs = [x for (x, y) in self.points]
+        self._ys = [y for (x, y) in self.points]
+        if len(set(self._xs)) != len(self._xs):
+            raise Exception("PiecewiseLinearCurve: duplicate x values")
+    
+    def evaluate(self, x) -> float:
+        segment = min(max(bisect_right(self._xs, x) - 1, 0), len(self._xs) - 2)
+        (x0, x1) = (self._xs[segment], self._xs[segment + 1])
+        (y0, y1) = (self._ys[segment], self._ys[segment + 1])
+        return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+    
+    def to_dict(self) -> dict:
+        return {'type': CURVE_PIECEWISE, 'points': self.points}
+
+class PolynomialCurve:
+    
+    def __init__(self, coefficients) -> None:
+        if len(coefficients) < 1:
+            raise Exception("PolynomialCurve: at least one coefficient is required")
+        self.coefficients = [float(coefficient) for coefficient in coefficients]
+    
+    def evaluate(self, x) -> float:
+        # Horner's method
+        y = 0.0
+        for coefficient in reversed(self.coefficients):
+            y = y * x + coefficient
+        return y
+    
+    def to_dict(self) -> dict:
+        return {'type': CURVE_POLYNOMIAL, 'coefficients': self.coefficients}
+
+def curve_from_dict(entry):
+    '''Build a curve from a calibration file / config entry (dict or ScaleOffset)'''
+    if isinstance(entry, (LinearCurve, PiecewiseLinearCurve, PolynomialCurve)):
+        return entry
+    if isinstance(entry, ScaleOffset):
+        return LinearCurve(entry.scale, entry.offset)
+    curve_type = entry.get('type', CURVE_LINEAR)
+    if curve_type == CURVE_LINEAR:
+        return LinearCurve(entry.get('scale', 1.0), entry.get('offset', 0.0))
+    if curve_type == CURVE_PIECEWISE:
+        return PiecewiseLinearCurve(entry['points'])
+    if curve_type == CURVE_POLYNOMIAL:
+        return PolynomialCurve(entry['coefficients'])
+    raise Exception(f"curve_from_dict: unknown calibration curve type: {curve_type}")
+
+def _json_default(value):
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    return vars(value)
         
 class ChannelCalibration:
 
@@ -34,7 +120,7 @@ class ChannelCalibration:
             # File Name is Blank - create default  
             # Generate default file with initial channel count
             for channel_index in range(init_channel_count):
-                self._calibration_dict[channel_index] = ScaleOffset()
+                self._calibration_dict[str(channel_index)] = ScaleOffset()
             # Write file
             self._write_json_file()
     
@@ -42,18 +128,178 @@ class ChannelCalibration:
         return self._calibration_dict.copy()
     
     def write_scalar(self, key, value):
-        self._calibration_dict[key] = value
+        '''value - ScaleOffset, a curve object or a curve dict'''
+        self._calibration_dict[str(key)] = value
         self._write_json_file()
     
     def _write_json_file(self):
         with open(self._json_file_name, "w") as outfile:
-            json.dump(self._calibration_dict, outfile, default=vars)
+            json.dump(self._calibration_dict, outfile, default=_json_default)
             
     def get_scale_offset(self, channel_index=0) -> ScaleOffset:
+        curve = self.get_curve(channel_index)
+        if not isinstance(curve, LinearCurve):
+            raise Exception(f"get_scale_offset: channel {channel_index} has a non-linear calibration curve")
         scale_offset = ScaleOffset()
-        scale_offset.scale = self._calibration_dict[str(channel_index)].get('scale')
-        scale_offset.offset = self._calibration_dict[str(channel_index)].get('offset')
+        (scale_offset.scale, scale_offset.offset) = (curve.scale, curve.offset)
         return scale_offset
+    
+    def get_curve(self, channel_index=0):
+        '''Calibration curve of a channel - LinearCurve(1, 0) when the channel has no entry'''
+        entry = self._calibration_dict.get(str(channel_index))
+        if entry == None:
+            return LinearCurve()
+        return curve_from_dict(entry)
+    
+    def get_curves(self, channel_count=8) -> list:
+        return [self.get_curve(channel_index) for channel_index in range(channel_count)]
+
+class ChannelConversion:
+    '''
+    Raw ADC codes to engineering units, precompiled per channel.
+    Channels whose calibration and engineering stages are both linear convert with one gain and offset:
+        units = gain[channel] * code + offset[channel]
+    Any other channel is compiled into a lookup table indexed by the raw code (built when the
+    channel's curves are set, so converting never builds one on the sampling thread):
+        units = lut[channel][code]
+    The stages are the code-to-volts step, the channel calibration curve and an optional
+    engineering scale/offset or curve (e.g. volts to PSI from the app config).
+    Raw codes equal to invalid_code convert to NaN.
+    '''
+    
+    def __init__(self, channel_count=8, volts_per_code=1.0, calibration : ChannelCalibration = None,
+                 invalid_code=None, code_count=4096) -> None:
+        self.channel_count = channel_count
+        self.volts_per_code = volts_per_code
+        self.invalid_code = invalid_code
+        self.code_count = code_count
+        if calibration != None:
+            self._calibration_curves = calibration.get_curves(channel_count)
+        else:
+            self._calibration_curves = [LinearCurve() for channel_index in range(channel_count)]
+        self._engineering_curves = [LinearCurve() for channel_index in range(channel_count)]
+        # Linear channels: gain/offset; lookup table channels: NaN gain/offset and a LUT
+        self.gains = [float('NaN')] * channel_count
+        self.offsets = [float('NaN')] * channel_count
+        self._lut_channels = [False] * channel_count
+        self._luts = [None] * channel_count
+        self._numpy_luts = [None] * channel_count
+        for channel_index in range(channel_count):
+            self._compile_channel(channel_index)
+        self._scan_coefficients = dict()
+    
+    def set_engineering_scale(self, channel_index, scale, offset) -> None:
+        '''Apply units = scale * volts + offset on top of the channel calibration'''
+        self.set_engineering_curve(channel_index, LinearCurve(scale, offset))
+    
+    def set_engineering_curve(self, channel_index, curve) -> None:
+        '''Apply a curve (object or dict, see curve_from_dict) on top of the channel calibration'''
+        self._engineering_curves[channel_index] = curve_from_dict(curve)
+        self._compile_channel(channel_index)
+        self._scan_coefficients.clear()
+    
+    def is_linear(self, channel_index) -> bool:
+        return not self._is_lut_channel(channel_index)
+    
+    def get_lut(self, channel_index):
+        '''Lookup table (array('d') of code_count entries) of a non-linear channel - None for a linear one'''
+        return self._luts[channel_index]
+    
+    def convert(self, channel_index, code) -> float:
+        '''Convert one raw code'''
+        if code == self.invalid_code:
+            return float('NaN')
+        if self._is_lut_channel(channel_index):
+            return self.get_lut(channel_index)[code]
+        return self.gains[channel_index] * code + self.offsets[channel_index]
+    
+    def convert_scan(self, channels, codes) -> list:
+        '''Convert one scan - codes[i] is the raw code read from channels[i]'''
+        if np != None:
+            (gains, offsets, lut_indexes) = self._get_scan_coefficients(channels)
+            units = self._convert_numpy(codes, gains, offsets).tolist()
+        else:
+            invalid_code = self.invalid_code
+            gains = self.gains
+            offsets = self.offsets
+            units = [float('NaN') if code == invalid_code else gains[channel_index] * code + offsets[channel_index]
+                     for (channel_index, code) in zip(channels, codes)]
+            lut_indexes = [index for (index, channel_index) in enumerate(channels) if self._is_lut_channel(channel_index)]
+        for index in lut_indexes:
+            units[index] = self.convert(channels[index], codes[index])
+        return units
+    
+    def convert_block(self, channel_index, codes):
+        '''Convert a block of raw codes from one channel - numpy array when available, else a list'''
+        invalid_code = self.invalid_code
+        if self._is_lut_channel(channel_index):
+            lut = self.get_lut(channel_index)
+            if np != None:
+                numpy_lut = self._get_numpy_lut(channel_index)
+                code_array = self._as_code_array(codes)
+                valid = code_array < len(numpy_lut)
+                units = numpy_lut[np.where(valid, code_array, 0)]
+                units[~valid] = np.nan
+                return units
+            return [float('NaN') if code == invalid_code else lut[code] for code in codes]
+        gain = self.gains[channel_index]
+        offset = self.offsets[channel_index]
+        if np != None:
+            return self._convert_numpy(codes, gain, offset)
+        return [float('NaN') if code == invalid_code else gain * code + offset for code in codes]
+    
+    def _is_lut_channel(self, channel_index) -> bool:
+        return self._lut_channels[channel_index]
+    
+    def _compile_channel(self, channel_index):
+        calibration_curve = self._calibration_curves[channel_index]
+        engineering_curve = self._engineering_curves[channel_index]
+        self._luts[channel_index] = None
+        self._numpy_luts[channel_index] = None
+        if isinstance(calibration_curve, LinearCurve) and isinstance(engineering_curve, LinearCurve):
+            # Fold the linear stages into one gain/offset
+            self.gains[channel_index] = engineering_curve.scale * calibration_curve.scale * self.volts_per_code
+            self.offsets[channel_index] = engineering_curve.scale * calibration_curve.offset + engineering_curve.offset
+            self._lut_channels[channel_index] = False
+        else:
+            self._lut_channels[channel_index] = True
+            self.gains[channel_index] = float('NaN')
+            self.offsets[channel_index] = float('NaN')
+            volts_per_code = self.volts_per_code
+            lut = array('d', (engineering_curve.evaluate(calibration_curve.evaluate(code * volts_per_code))
+                              for code in range(self.code_count)))
+            self._luts[channel_index] = lut
+            if np != None:
+                self._numpy_luts[channel_index] = np.frombuffer(lut, dtype=np.float64)
+    
+    def _get_numpy_lut(self, channel_index):
+        return self._numpy_luts[channel_index]
+    
+    def _get_scan_coefficients(self, channels) -> tuple:
+        # Coefficient arrays in scan order, built once per channel list
+        key = tuple(channels)
+        coefficients = self._scan_coefficients.get(key)
+        if coefficients == None:
+            coefficients = (np.array([self.gains[channel_index] for channel_index in key]),
+                            np.array([self.offsets[channel_index] for channel_index in key]),
+                            [index for (index, channel_index) in enumerate(key) if self._is_lut_channel(channel_index)])
+            self._scan_coefficients[key] = coefficients
+        return coefficients
+    
+    def _as_code_array(self, codes):
+        if isinstance(codes, np.ndarray):
+            return codes
+        if isinstance(codes, (bytes, bytearray, memoryview)) or hasattr(codes, 'typecode'):
+            # array('H') and buffers are viewed without a copy
+            return np.frombuffer(codes, dtype=np.uint16)
+        return np.asarray(codes)
+    
+    def _convert_numpy(self, codes, gains, offsets):
+        code_array = self._as_code_array(codes)
+        units = code_array * gains + offsets
+        if self.invalid_code != None:
+            units[code_array == self.invalid_code] = np.nan
+        return units
 
 if __name__ == '__main__':
     test = ChannelCalibration()
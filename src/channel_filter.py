@@ -0,0 +1,154 @@
+'''
+Per-channel sample filters backed by fixed-size ring buffers (array('d')) - no allocation per sample.
+
+    moving_average - running sum over the last depth samples, O(1) per sample
+    ema            - exponential moving average, alpha = 2 / (depth + 1)
+    median         - median of the last depth samples (sorted window kept with bisect)
+    none           - pass-through
+
+NaN samples (failed conversions) are skipped and the filter holds its last value for up to
+max_invalid_samples in a row; after that it resets and returns NaN until a valid sample arrives,
+so a dead channel is visible downstream instead of freezing at a plausible value.
+invalid_run counts the current run of NaN samples.
+'''
+from array import array
+from bisect import bisect_left, insort
+import math
+
+FILTER_NONE = "none"
+FILTER_MOVING_AVERAGE = "moving_average"
+FILTER_EMA = "ema"
+FILTER_MEDIAN = "median"
+
+class ChannelFilter:
+    '''Pass-through filter - base class for the ring buffer filters'''
+
+    def __init__(self, depth=1, max_invalid_samples=3) -> None:
+        self.depth = depth
+        self.max_invalid_samples = max_invalid_samples
+        self.invalid_run = 0
+        self.value = float('NaN')
+
+    def update(self, sample) -> float:
+        '''Add a sample and return the filtered value'''
+        if math.isnan(sample):
+            return self._update_invalid()
+        self.invalid_run = 0
+        self.value = sample
+        return self.value
+
+    def is_stale(self) -> bool:
+        '''True once more than max_invalid_samples NaN samples came in a row'''
+        return self.invalid_run > self.max_invalid_samples
+
+    def reset(self) -> None:
+        self.value = float('NaN')
+
+    def _update_invalid(self) -> float:
+        # Hold the last value through short runs of failed conversions, then report NaN
+        self.invalid_run += 1
+        if self.invalid_run > self.max_invalid_samples:
+            if not math.isnan(self.value):
+                self.reset()
+        return self.value
+
+class MovingAverageFilter(ChannelFilter):
+
+    # Recompute the running sum from the buffer every this many wraps to shed float drift
+    _RESUM_WRAPS = 64
+
+    def __init__(self, depth=5, max_invalid_samples=3) -> None:
+        super().__init__(depth, max_invalid_samples)
+        self._buffer = array('d', bytes(8 * depth))
+        self.reset()
+
+    def update(self, sample) -> float:
+        if math.isnan(sample):
+            return self._update_invalid()
+        self.invalid_run = 0
+        index = self._next_index
+        if self._count < self.depth:
+            self._count += 1
+        else:
+            self._sum -= self._buffer[index]
+        self._buffer[index] = sample
+        self._sum += sample
+        index += 1
+        if index == self.depth:
+            index = 0
+            self._wraps += 1
+            if self._wraps == self._RESUM_WRAPS:
+                self._wraps = 0
+                self._sum = math.fsum(self._buffer)
+        self._next_index = index
+        self.value = self._sum / self._count
+        return self.value
+
+    def reset(self) -> None:
+        super().reset()
+        self._next_index = 0
+        self._count = 0
+        self._sum = 0.0
+        self._wraps = 0
+
+class EMAFilter(ChannelFilter):
+
+    def __init__(self, depth=5, max_invalid_samples=3) -> None:
+        super().__init__(depth, max_invalid_samples)
+        self.alpha = 2.0 / (depth + 1)
+
+    def update(self, sample) -> float:
+        if math.isnan(sample):
+            return self._update_invalid()
+        self.invalid_run = 0
+        if math.isnan(self.value):
+            self.value = sample
+        else:
+            self.value += self.alpha * (sample - self.value)
+        return self.value
+
+class MedianFilter(ChannelFilter):
+
+    def __init__(self, depth=5, max_invalid_samples=3) -> None:
+        super().__init__(depth, max_invalid_samples)
+        self._buffer = array('d', bytes(8 * depth))
+        self.reset()
+
+    def update(self, sample) -> float:
+        if math.isnan(sample):
+            return self._update_invalid()
+        self.invalid_run = 0
+        window = self._sorted_window
+        if self._count < self.depth:
+            self._count += 1
+        else:
+            # Drop the oldest sample from the sorted window
+            del window[bisect_left(window, self._buffer[self._next_index])]
+        self._buffer[self._next_index] = sample
+        insort(window, sample)
+        self._next_index = (self._next_index + 1) % self.depth
+        middle = self._count // 2
+        if self._count % 2 == 1:
+            self.value = window[middle]
+        else:
+            self.value = (window[middle - 1] + window[middle]) / 2
+        return self.value
+
+    def reset(self) -> None:
+        super().reset()
+        self._sorted_window = list()
+        self._next_index = 0
+        self._count = 0
+
+_FILTER_TYPES = {FILTER_NONE: ChannelFilter,
+                 FILTER_MOVING_AVERAGE: MovingAverageFilter,
+                 FILTER_EMA: EMAFilter,
+                 FILTER_MEDIAN: MedianFilter}
+
+def create_filter(filter_type=FILTER_NONE, depth=5, max_invalid_samples=3) -> ChannelFilter:
+    '''New filter by type name (see FILTER_*)'''
+    if filter_type not in _FILTER_TYPES:
+        raise Exception(f"create_filter: unknown filter type: {filter_type}")
+    if depth < 1:
+        raise Exception(f"create_filter: filter depth must be at least 1: {depth}")
+    return _FILTER_TYPES[filter_type](depth, max_invalid_samples)
@@ -1,6 +1,9 @@
-from RPi import GPIO
+from hw_backend import GPIO
 import datetime
 import time
+from array import array
+
+from atomic_counter import AtomicCounter
 
 '''Counts rising edges on GP16 and GP26 of a Raspberry PI'''
 class DinCounter:
@@ -9,31 +12,97 @@ class DinCounter:
         
         # Class Privates
         bcm_pin = 0
-        _count = 0
-        _debounce_ms = 0
-        _last_edge_time = datetime.datetime.now()
+        _count = None
+        _debounce_ns = 0
         
-        def __init__(self, bcm_pin, debounce_ms=250):
+        def __init__(self, bcm_pin, debounce_ms=250, history_depth=256):
             self.bcm_pin = bcm_pin
-            self._count = 0
-            self._debounce_ms = debounce_ms
+            # Incremented on the GPIO thread, read / set / reset from the main loop
+            self._count = AtomicCounter()
+            self._debounce_ns = int(debounce_ms * 1000000)
+            # Ring buffer of accepted edge times (time.monotonic_ns)
+            self._history_depth = history_depth
+            self._edge_times = array('q', bytes(8 * history_depth))
+            self._edge_total = 0
+            self._last_edge_ns = 0
+            # Odd while increment() updates the edge history - readers retry until they see one even value on both sides
+            self._edge_sequence = 0
+            # Called with the edge time of every accepted edge (GPIO callback thread)
+            self.edge_callback = None
             
         def increment(self):
-            time_delta = (datetime.datetime.now() - self._last_edge_time).total_seconds() * 1000.0
-            if time_delta > self._debounce_ms:
-                self._count += 1
-                self._last_edge_time = datetime.datetime.now()
+            # GPIO callback - no allocation beyond the timestamp
+            now_ns = time.monotonic_ns()
+            if self._edge_total == 0 or now_ns - self._last_edge_ns > self._debounce_ns:
+                self._count.increment()
+                self._edge_sequence += 1
+                self._edge_times[self._edge_total % self._history_depth] = now_ns
+                self._last_edge_ns = now_ns
+                self._edge_total += 1
+                self._edge_sequence += 1
+                if self.edge_callback != None:
+                    self.edge_callback(now_ns)
             
         def get_count(self) -> int:
-            return self._count
+            return self._count.value()
         
         def set_count(self, value : int):
-            self._count = value
+            self._count.set(value)
         
         def reset(self):
-            self._count = 0
+            self._count.reset()
+        
+        def snapshot_and_reset(self) -> int:
+            '''Edges since the last reset, and reset - no edge is lost or counted twice'''
+            return self._count.snapshot_and_reset()
+        
+        def get_edge_times_ns(self, edge_count) -> array:
+            '''The newest edge_count (at most the history depth) edge times, oldest first'''
+            while True:
+                sequence = self._begin_edge_read()
+                edge_total = self._edge_total
+                count = min(edge_count, edge_total, self._history_depth)
+                edge_times = array('q', (self._edge_times[index % self._history_depth]
+                                         for index in range(edge_total - count, edge_total)))
+                if self._edge_sequence == sequence:
+                    return edge_times
+        
+        def get_last_intervals(self, interval_count) -> list:
+            '''Seconds between the newest interval_count + 1 edges, oldest first'''
+            edge_times = self.get_edge_times_ns(interval_count + 1)
+            return [(edge_times[index] - edge_times[index - 1]) / 1e9 for index in range(1, len(edge_times))]
+        
+        def get_frequency_hz(self) -> float:
+            '''Instantaneous edge rate from the last interval - decays towards 0 once edges stop'''
+            edge_times = self.get_edge_times_ns(2)
+            if len(edge_times) < 2:
+                return 0.0
+            interval_ns = max(edge_times[1] - edge_times[0], time.monotonic_ns() - edge_times[1])
+            return 1e9 / interval_ns if interval_ns > 0 else 0.0
+        
+        def get_edges_in_window(self, window_secs) -> int:
+            '''Edges in the last window_secs (counts at most the history depth)'''
+            window_start_ns = time.monotonic_ns() - int(window_secs * 1e9)
+            while True:
+                sequence = self._begin_edge_read()
+                edge_total = self._edge_total
+                edge_count = 0
+                for index in range(edge_total - 1, max(edge_total - self._history_depth, 0) - 1, -1):
+                    if self._edge_times[index % self._history_depth] < window_start_ns:
+                        break
+                    edge_count += 1
+                if self._edge_sequence == sequence:
+                    return edge_count
+        
+        def _begin_edge_read(self) -> int:
+            # Wait out an edge being written - the GPIO thread needs the GIL to finish it
+            sequence = self._edge_sequence
+            while sequence & 1:
+                time.sleep(0)
+                sequence = self._edge_sequence
+            return sequence
     
-    def __init__(self,debounce_ms=250):
+    def __init__(self,debounce_ms=250, history_depth=256):
         
         # Counters
         self.count_A = 0
@@ -44,8 +113,8 @@ class DinCounter:
         #GPIO.cleanup()
         
         GPIO.setmode(GPIO.BCM)
-        self._counter_A = DinCounter.Counter(16,debounce_ms)
-        self._counter_B = DinCounter.Counter(26,debounce_ms)
+        self._counter_A = DinCounter.Counter(16,debounce_ms,history_depth)
+        self._counter_B = DinCounter.Counter(26,debounce_ms,history_depth)
         GPIO.setup(self._counter_A.bcm_pin, GPIO.IN)
         GPIO.setup(self._counter_B.bcm_pin, GPIO.IN)
         GPIO.add_event_detect(self._counter_A.bcm_pin, GPIO.FALLING, callback=self.increment_count_A)
@@ -82,6 +151,46 @@ class DinCounter:
     def reset_count_B(self):
         self._counter_B.reset()
     
+    '''Channel A edges since the last reset, and reset'''
+    def snapshot_and_reset_A(self) -> int:
+        return self._counter_A.snapshot_and_reset()
+    
+    '''Channel B edges since the last reset, and reset'''
+    def snapshot_and_reset_B(self) -> int:
+        return self._counter_B.snapshot_and_reset()
+    
+    '''Call edge_callback(edge time ns) for every accepted Channel A edge - runs on the GPIO callback thread'''
+    def set_edge_callback_A(self, edge_callback):
+        self._counter_A.edge_callback = edge_callback
+
+    '''Call edge_callback(edge time ns) for every accepted Channel B edge - runs on the GPIO callback thread'''
+    def set_edge_callback_B(self, edge_callback):
+        self._counter_B.edge_callback = edge_callback
+
+    '''Channel A edge rate (Hz) from the last interval'''
+    def get_frequency_A(self) -> float:
+        return self._counter_A.get_frequency_hz()
+
+    '''Channel B edge rate (Hz) from the last interval'''
+    def get_frequency_B(self) -> float:
+        return self._counter_B.get_frequency_hz()
+
+    '''Channel A seconds between the newest edges'''
+    def get_last_intervals_A(self, interval_count) -> list:
+        return self._counter_A.get_last_intervals(interval_count)
+
+    '''Channel B seconds between the newest edges'''
+    def get_last_intervals_B(self, interval_count) -> list:
+        return self._counter_B.get_last_intervals(interval_count)
+
+    '''Channel A edges in the last window_secs'''
+    def get_edges_in_window_A(self, window_secs) -> int:
+        return self._counter_A.get_edges_in_window(window_secs)
+
+    '''Channel B edges in the last window_secs'''
+    def get_edges_in_window_B(self, window_secs) -> int:
+        return self._counter_B.get_edges_in_window(window_secs)
+    
     '''GPIO Clean-up on exit'''
     def cleanup(self):
         GPIO.cleanup()
@@ -102,7 +211,8 @@ if __name__ == '__main__':
         count_A = counter.get_count_A()
         count_B = counter.get_count_B()
         # Print
-        print(f"[\t{elapsed_time.total_seconds():0.1f}s]\tCNT-A: {count_A}\tCNT-B: {count_B}")
+        print(f"[\t{elapsed_time.total_seconds():0.1f}s]\tCNT-A: {count_A}\tCNT-B: {count_B}"
+              f"\tFREQ-A: {counter.get_frequency_A():0.2f}Hz\tFREQ-B: {counter.get_frequency_B():0.2f}Hz")
         index += 1
         time.sleep(0.25)
         elapsed_time = datetime.datetime.now() - start_time
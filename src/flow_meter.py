@@ -0,0 +1,167 @@
+'''
+Flow rate and volume totalizer for pulse-output flow meters.
+
+Each FlowMeter turns the accepted edges of one DinCounter channel into volume with a K-factor
+(pulses per unit volume) and keeps:
+    instantaneous rate  - from the last pulse interval, decaying once pulses stop
+    windowed rates      - 1 minute and 15 minute, from a ring of 1-second pulse buckets with running sums
+    volume total        - pulses / K-factor
+FlowEngine groups the meters and attributes the volume of the meters flagged attribute_to_valves
+to the valves open at the time, split evenly between them.
+
+on_pulse() is O(1) and safe to call from the GPIO callback. The bucket ring is advanced lazily,
+O(1) amortized per elapsed second, so queries are O(1) as well.
+'''
+import threading
+import time
+
+class FlowMeter:
+
+    BUCKET_SECS = 1
+    WINDOW_1M_BUCKETS = 60
+    WINDOW_15M_BUCKETS = 900
+
+    def __init__(self, name, k_factor, attribute_to_valves=False) -> None:
+        if k_factor <= 0:
+            raise Exception(f"FlowMeter {name}: K-factor must be positive: {k_factor}")
+        self.name = name
+        self.k_factor = float(k_factor)
+        self.attribute_to_valves = attribute_to_valves
+        self.pulse_total = 0
+        self._lock = threading.Lock()
+        self._last_pulse_ns = None
+        self._last_interval_ns = None
+        # Pulse count per second, the last 15 minutes
+        self._buckets = [0] * self.WINDOW_15M_BUCKETS
+        self._current_bucket = int(time.monotonic())
+        self._sum_1m = 0
+        self._sum_15m = 0
+        self._pulse_listener = None
+
+    def on_pulse(self, now_ns=None) -> None:
+        '''One accepted edge - now_ns is the edge time (time.monotonic_ns)'''
+        if now_ns == None:
+            now_ns = time.monotonic_ns()
+        with self._lock:
+            self._advance(now_ns // 1000000000)
+            self._buckets[self._current_bucket % self.WINDOW_15M_BUCKETS] += 1
+            self._sum_1m += 1
+            self._sum_15m += 1
+            self.pulse_total += 1
+            if self._last_pulse_ns != None:
+                self._last_interval_ns = now_ns - self._last_pulse_ns
+            self._last_pulse_ns = now_ns
+        if self._pulse_listener != None:
+            self._pulse_listener(self)
+
+    def set_pulse_total(self, pulse_total) -> None:
+        '''Seed the total, e.g. from the value persisted before a restart'''
+        with self._lock:
+            self.pulse_total = pulse_total
+
+    def get_volume(self) -> float:
+        return self.pulse_total / self.k_factor
+
+    def get_instantaneous_rate(self) -> float:
+        '''Volume per minute from the last pulse interval'''
+        with self._lock:
+            if self._last_interval_ns == None:
+                return 0.0
+            interval_ns = max(self._last_interval_ns, time.monotonic_ns() - self._last_pulse_ns)
+        if interval_ns <= 0:
+            return 0.0
+        return 60e9 / interval_ns / self.k_factor
+
+    def get_rate_1m(self) -> float:
+        '''Mean volume per minute over the last minute'''
+        with self._lock:
+            self._advance(int(time.monotonic()))
+            pulses = self._sum_1m
+        return pulses * 60.0 / (self.WINDOW_1M_BUCKETS * self.BUCKET_SECS) / self.k_factor
+
+    def get_rate_15m(self) -> float:
+        '''Mean volume per minute over the last 15 minutes'''
+        with self._lock:
+            self._advance(int(time.monotonic()))
+            pulses = self._sum_15m
+        return pulses * 60.0 / (self.WINDOW_15M_BUCKETS * self.BUCKET_SECS) / self.k_factor
+
+    def _advance(self, bucket):
+        # Called with the lock held - retire buckets that left the windows, up to the current second
+        if bucket <= self._current_bucket:
+            return
+        if bucket - self._current_bucket >= self.WINDOW_15M_BUCKETS:
+            # Idle for longer than the longest window
+            self._buckets = [0] * self.WINDOW_15M_BUCKETS
+            self._sum_1m = 0
+            self._sum_15m = 0
+            self._current_bucket = bucket
+            return
+        buckets = self._buckets
+        while self._current_bucket < bucket:
+            self._current_bucket += 1
+            self._sum_1m -= buckets[(self._current_bucket - self.WINDOW_1M_BUCKETS) % self.WINDOW_15M_BUCKETS]
+            slot = self._current_bucket % self.WINDOW_15M_BUCKETS
+            self._sum_15m -= buckets[slot]
+            buckets[slot] = 0
+
+class FlowEngine:
+    '''Flow meters plus the volume delivered through each valve'''
+
+    def __init__(self) -> None:
+        self.meters = list()
+        self._lock = threading.Lock()
+        self._open_valve_count = 0
+        # Volume per open valve, integrated over every pulse: each valve's total is the growth while it was open
+        self._share_total = 0.0
+        self.unattributed_volume = 0.0
+        self._valves = dict()       # valve name -> [total volume, share total when opened, is open]
+
+    def add_meter(self, meter : FlowMeter) -> FlowMeter:
+        if meter.attribute_to_valves:
+            meter._pulse_listener = self._on_attributed_pulse
+        self.meters.append(meter)
+        return meter
+
+    def get_meter(self, name) -> FlowMeter:
+        for meter in self.meters:
+            if meter.name == name:
+                return meter
+        return None
+
+    def add_valve(self, valve_name, volume_total=0.0) -> None:
+        with self._lock:
+            self._valves[valve_name] = [float(volume_total), 0.0, False]
+
+    def set_valve_open(self, valve_name, is_open) -> None:
+        '''Track a valve's position - only a change of state does any work'''
+        with self._lock:
+            valve = self._valves[valve_name]
+            if valve[2] == is_open:
+                return
+            if is_open:
+                valve[1] = self._share_total
+                self._open_valve_count += 1
+            else:
+                valve[0] += self._share_total - valve[1]
+                self._open_valve_count -= 1
+            valve[2] = is_open
+
+    def get_valve_volume(self, valve_name) -> float:
+        with self._lock:
+            (volume_total, share_at_open, is_open) = self._valves[valve_name]
+            if is_open:
+                volume_total += self._share_total - share_at_open
+            return volume_total
+
+    def get_valve_names(self) -> list:
+        with self._lock:
+            return list(self._valves.keys())
+
+    def _on_attributed_pulse(self, meter : FlowMeter):
+        with self._lock:
+            volume = 1.0 / meter.k_factor
+            if self._open_valve_count > 0:
+                self._share_total += volume / self._open_valve_count
+            else:
+                self.unattributed_volume += volume
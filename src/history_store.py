@@ -0,0 +1,305 @@
+'''
+On-device time-series history - SQLite in WAL mode.
+
+Samples are (series name, timestamp, value) with timestamps in epoch seconds. record() only
+appends to a bounded queue; a writer thread commits the queue in batches (one transaction per
+batch) and folds each batch into 1 minute and 1 hour rollups (count, sum, min, max) with upserts,
+so the rollups are always complete even after raw samples are pruned. Events (valve state
+changes, limit trips, ...) are stored as text in their own table.
+
+The database is kept under budget_bytes by pruning the oldest rows: raw samples first, then the
+1 minute rollups, the events and the 1 hour rollups - history degrades to coarser resolution as it ages.
+
+Queries run on the calling thread with their own connection (WAL readers never block the
+writer) and use the (series, time) primary keys:
+    query_range(name, start, end, resolution)  - samples or rollup rows in a time range
+    aggregate(name, start, end, resolution)     - count / mean / min / max over a time range
+    query_events(name, start, end)
+'''
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+RESOLUTION_RAW = 'raw'
+RESOLUTION_1M = '1m'
+RESOLUTION_1H = '1h'
+
+_ROLLUP_TABLES = {RESOLUTION_1M: ('rollup_1m', 60), RESOLUTION_1H: ('rollup_1h', 3600)}
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS series (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS samples_raw (series_id INTEGER NOT NULL, ts REAL NOT NULL, value REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS samples_raw_series_ts ON samples_raw (series_id, ts);
+CREATE TABLE IF NOT EXISTS rollup_1m (series_id INTEGER NOT NULL, bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL, sum REAL NOT NULL, min REAL NOT NULL, max REAL NOT NULL,
+    PRIMARY KEY (series_id, bucket)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_1h (series_id INTEGER NOT NULL, bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL, sum REAL NOT NULL, min REAL NOT NULL, max REAL NOT NULL,
+    PRIMARY KEY (series_id, bucket)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS events (series_id INTEGER NOT NULL, ts REAL NOT NULL, text TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS events_series_ts ON events (series_id, ts);
+'''
+
+class HistoryStats:
+
+    def __init__(self, recorded_count, dropped_count, batch_count, pruned_count, used_bytes) -> None:
+        self.recorded_count = recorded_count
+        self.dropped_count = dropped_count      # record() calls refused because the queue was full
+        self.batch_count = batch_count
+        self.pruned_count = pruned_count        # rows removed to stay under the disk budget
+        self.used_bytes = used_bytes
+
+    def __str__(self) -> str:
+        return (f"{self.recorded_count} recorded, {self.dropped_count} dropped, {self.batch_count} batches, "
+                f"{self.pruned_count} pruned, {self.used_bytes / 1e6:.1f} MB")
+
+class HistoryStore:
+
+    def __init__(self, path, budget_bytes=64*1024*1024, batch_size=500, flush_interval_secs=5.0, queue_depth=20000) -> None:
+        self.path = path
+        self.budget_bytes = budget_bytes
+        self.batch_size = batch_size
+        self.flush_interval_secs = flush_interval_secs
+        self._queue = queue.Queue(queue_depth)
+        self._local = threading.local()
+        self._series_ids = dict()
+        self._thread = None
+        self.recorded_count = 0
+        self.dropped_count = 0
+        self.batch_count = 0
+        self.pruned_count = 0
+        self._used_bytes = 0
+        directory = os.path.dirname(path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+        # Schema and WAL mode up front so readers can open the database at once
+        connection = self._connect()
+        connection.executescript(_SCHEMA)
+        connection.commit()
+
+    @classmethod
+    def from_config(cls, history_config : dict, default_path):
+        '''
+        Started store from a service's 'history' config section (enabled, path, budget_mb, batch_size,
+        flush_interval_secs) - None when disabled. Queued samples are committed at exit.
+        '''
+        if not history_config.get('enabled', False):
+            return None
+        history = cls(history_config.get('path', default_path),
+                      int(history_config.get('budget_mb', 64) * 1024 * 1024),
+                      history_config.get('batch_size', 500),
+                      history_config.get('flush_interval_secs', 5))
+        history.start()
+        atexit.register(history.stop)
+        return history
+
+    def start(self) -> None:
+        if self._thread == None:
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10.0) -> None:
+        '''Commits what is queued and stops the writer'''
+        if self._thread == None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def record(self, name, value, timestamp=None) -> bool:
+        '''Queue one sample - never blocks; False when the queue is full or the value is None / NaN'''
+        if value == None or value != value:
+            return False
+        return self._put((False, name, time.time() if timestamp == None else timestamp, value))
+
+    def record_event(self, name, text, timestamp=None) -> bool:
+        return self._put((True, name, time.time() if timestamp == None else timestamp, str(text)))
+
+    def flush(self, timeout=10.0) -> bool:
+        '''Blocks until everything queued before the call is committed'''
+        if self._thread == None:
+            return False
+        committed = threading.Event()
+        self._queue.put(committed)
+        return committed.wait(timeout)
+
+    ''' Queries '''
+
+    def query_range(self, name, start, end, resolution=RESOLUTION_RAW) -> list:
+        '''raw: [(ts, value)], rollups: [(bucket start ts, count, mean, min, max)] - oldest first'''
+        connection = self._connect()
+        series_id = self._lookup_series(connection, name)
+        if series_id == None:
+            return list()
+        if resolution == RESOLUTION_RAW:
+            return connection.execute('SELECT ts, value FROM samples_raw WHERE series_id = ? AND ts >= ? AND ts < ? ORDER BY ts',
+                                      (series_id, start, end)).fetchall()
+        (table, bucket_secs) = _ROLLUP_TABLES[resolution]
+        rows = connection.execute(f'SELECT bucket, count, sum, min, max FROM {table} '
+                                  'WHERE series_id = ? AND bucket >= ? AND bucket < ? ORDER BY bucket',
+                                  (series_id, int(start // bucket_secs), self._end_bucket(end, bucket_secs))).fetchall()
+        return [(bucket * bucket_secs, count, total / count, minimum, maximum) for (bucket, count, total, minimum, maximum) in rows]
+
+    def aggregate(self, name, start, end, resolution=RESOLUTION_RAW) -> dict:
+        '''{count, mean, min, max} over [start, end) - rollup resolutions round to whole buckets'''
+        connection = self._connect()
+        series_id = self._lookup_series(connection, name)
+        if series_id == None:
+            return {'count': 0, 'mean': None, 'min': None, 'max': None}
+        if resolution == RESOLUTION_RAW:
+            row = connection.execute('SELECT count(*), sum(value), min(value), max(value) FROM samples_raw '
+                                     'WHERE series_id = ? AND ts >= ? AND ts < ?', (series_id, start, end)).fetchone()
+        else:
+            (table, bucket_secs) = _ROLLUP_TABLES[resolution]
+            row = connection.execute(f'SELECT sum(count), sum(sum), min(min), max(max) FROM {table} '
+                                     'WHERE series_id = ? AND bucket >= ? AND bucket < ?',
+                                     (series_id, int(start // bucket_secs), self._end_bucket(end, bucket_secs))).fetchone()
+        (count, total, minimum, maximum) = row
+        count = count or 0
+        return {'count': count, 'mean': total / count if count > 0 else None, 'min': minimum, 'max': maximum}
+
+    def query_events(self, name, start, end) -> list:
+        '''[(ts, text)] - oldest first'''
+        connection = self._connect()
+        series_id = self._lookup_series(connection, name)
+        if series_id == None:
+            return list()
+        return connection.execute('SELECT ts, text FROM events WHERE series_id = ? AND ts >= ? AND ts < ? ORDER BY ts',
+                                  (series_id, start, end)).fetchall()
+
+    def get_series_names(self) -> list:
+        return [row[0] for row in self._connect().execute('SELECT name FROM series ORDER BY name')]
+
+    def get_stats(self) -> HistoryStats:
+        return HistoryStats(self.recorded_count, self.dropped_count, self.batch_count, self.pruned_count, self._used_bytes)
+
+    ''' Writer '''
+
+    def _put(self, item) -> bool:
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped_count += 1
+            return False
+        self.recorded_count += 1
+        return True
+
+    def _run(self):
+        connection = self._connect()
+        running = True
+        while running:
+            batch = list()
+            waiters = list()
+            deadline = time.monotonic() + self.flush_interval_secs
+            # Collect until the batch is full, the interval is up, a flush is requested or stop
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item == None:
+                    running = False
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+            try:
+                if len(batch) > 0:
+                    self._write_batch(connection, batch)
+                    self._enforce_budget(connection)
+            except sqlite3.Error as e:
+                print(f"HistoryStore: batch of {len(batch)} not written: {e}")
+            for waiter in waiters:
+                waiter.set()
+        connection.close()
+
+    def _write_batch(self, connection, batch):
+        samples = list()
+        events = list()
+        rollups = {RESOLUTION_1M: dict(), RESOLUTION_1H: dict()}
+        with connection:
+            for (is_event, name, timestamp, value) in batch:
+                series_id = self._get_series_id(connection, name)
+                if is_event:
+                    events.append((series_id, timestamp, value))
+                    continue
+                samples.append((series_id, timestamp, value))
+                # Fold the batch per bucket first - one upsert per (series, bucket) instead of per sample
+                for (resolution, (table, bucket_secs)) in _ROLLUP_TABLES.items():
+                    key = (series_id, int(timestamp // bucket_secs))
+                    rollup = rollups[resolution].get(key)
+                    if rollup == None:
+                        rollups[resolution][key] = [1, value, value, value]
+                    else:
+                        rollup[0] += 1
+                        rollup[1] += value
+                        rollup[2] = min(rollup[2], value)
+                        rollup[3] = max(rollup[3], value)
+            connection.executemany('INSERT INTO samples_raw (series_id, ts, value) VALUES (?, ?, ?)', samples)
+            connection.executemany('INSERT INTO events (series_id, ts, text) VALUES (?, ?, ?)', events)
+            for (resolution, (table, bucket_secs)) in _ROLLUP_TABLES.items():
+                connection.executemany(f'INSERT INTO {table} (series_id, bucket, count, sum, min, max) VALUES (?, ?, ?, ?, ?, ?) '
+                                       'ON CONFLICT (series_id, bucket) DO UPDATE SET count = count + excluded.count, '
+                                       'sum = sum + excluded.sum, min = min(min, excluded.min), max = max(max, excluded.max)',
+                                       [key + tuple(rollup) for (key, rollup) in rollups[resolution].items()])
+        self.batch_count += 1
+
+    def _enforce_budget(self, connection):
+        '''Delete the oldest rows - raw, 1 minute, events, 1 hour - until the used pages fit the budget'''
+        self._used_bytes = self._get_used_bytes(connection)
+        # (count, delete the oldest LIMIT units) - the rollups are pruned by whole buckets, so they count buckets, not rows
+        prune_steps = (
+            ('SELECT count(*) FROM samples_raw',
+             'DELETE FROM samples_raw WHERE rowid IN (SELECT rowid FROM samples_raw ORDER BY rowid LIMIT ?)'),
+            ('SELECT count(DISTINCT bucket) FROM rollup_1m',
+             'DELETE FROM rollup_1m WHERE bucket IN (SELECT DISTINCT bucket FROM rollup_1m ORDER BY bucket LIMIT ?)'),
+            ('SELECT count(*) FROM events',
+             'DELETE FROM events WHERE rowid IN (SELECT rowid FROM events ORDER BY rowid LIMIT ?)'),
+            ('SELECT count(DISTINCT bucket) FROM rollup_1h',
+             'DELETE FROM rollup_1h WHERE bucket IN (SELECT DISTINCT bucket FROM rollup_1h ORDER BY bucket LIMIT ?)'),
+        )
+        for (count_sql, delete_sql) in prune_steps:
+            while self._used_bytes > self.budget_bytes:
+                # Remove a tenth of the table per pass; the freed pages are reused by later inserts
+                unit_count = connection.execute(count_sql).fetchone()[0]
+                if unit_count == 0:
+                    break
+                with connection:
+                    self.pruned_count += connection.execute(delete_sql, (max(1, unit_count // 10),)).rowcount
+                self._used_bytes = self._get_used_bytes(connection)
+
+    def _get_used_bytes(self, connection) -> int:
+        page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+        page_count = connection.execute('PRAGMA page_count').fetchone()[0]
+        freelist_count = connection.execute('PRAGMA freelist_count').fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def _get_series_id(self, connection, name) -> int:
+        # Writer thread only
+        series_id = self._series_ids.get(name)
+        if series_id == None:
+            connection.execute('INSERT OR IGNORE INTO series (name) VALUES (?)', (name,))
+            series_id = self._lookup_series(connection, name)
+            self._series_ids[name] = series_id
+        return series_id
+
+    def _lookup_series(self, connection, name):
+        row = connection.execute('SELECT id FROM series WHERE name = ?', (name,)).fetchone()
+        return None if row == None else row[0]
+
+    def _end_bucket(self, end, bucket_secs) -> int:
+        return int(-(-end // bucket_secs))
+
+    def _connect(self) -> sqlite3.Connection:
+        '''One connection per thread'''
+        connection = getattr(self._local, 'connection', None)
+        if connection == None:
+            connection = sqlite3.connect(self.path, timeout=10.0)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
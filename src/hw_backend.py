@@ -0,0 +1,71 @@
+'''
+Selects where the Kitchen Sink drivers get their I2C bus and GPIO from.
+
+    hardware - smbus2 and RPi.GPIO on a Raspberry Pi (default)
+    emulator - the in-process register models in hw_emulator (any Linux machine)
+
+Set KITCHEN_SINK_BACKEND=emulator in the environment, or call use_emulator()
+before any driver is created.
+'''
+import os
+
+BACKEND_HARDWARE = "hardware"
+BACKEND_EMULATOR = "emulator"
+
+_backend_name = os.environ.get("KITCHEN_SINK_BACKEND", BACKEND_HARDWARE)
+_emulator = None
+_rpi_gpio = None
+
+def get_backend_name() -> str:
+    return _backend_name
+
+def use_hardware() -> None:
+    global _backend_name
+    _backend_name = BACKEND_HARDWARE
+
+def use_emulator(emulator=None):
+    '''Switch to the emulator backend; returns the active HardwareEmulator'''
+    global _backend_name, _emulator
+    _backend_name = BACKEND_EMULATOR
+    if emulator != None:
+        _emulator = emulator
+    return get_emulator()
+
+def get_emulator():
+    '''The active HardwareEmulator - created with the default Kitchen Sink devices on first use'''
+    global _emulator
+    if _emulator == None:
+        import hw_emulator
+        _emulator = hw_emulator.HardwareEmulator.default_kitchen_sink()
+    return _emulator
+
+def open_smbus(bus_number=1):
+    '''Open an smbus2.SMBus compatible object for the given bus number'''
+    if _backend_name == BACKEND_EMULATOR:
+        return get_emulator().open_smbus(bus_number)
+    import smbus2
+    return smbus2.SMBus(bus_number)
+
+def create_read_message(address, length):
+    '''smbus2.i2c_msg.read compatible message for SMBus.i2c_rdwr - a plain read, no command byte'''
+    if _backend_name == BACKEND_EMULATOR:
+        import hw_emulator
+        return hw_emulator.EmulatedI2CMessage.read(address, length)
+    import smbus2
+    return smbus2.i2c_msg.read(address, length)
+
+def _gpio_module():
+    global _rpi_gpio
+    if _backend_name == BACKEND_EMULATOR:
+        return get_emulator().gpio
+    if _rpi_gpio == None:
+        from RPi import GPIO as rpi_gpio
+        _rpi_gpio = rpi_gpio
+    return _rpi_gpio
+
+'''Stands in for the RPi.GPIO module - attribute access is forwarded to the active backend'''
+class _GPIOProxy:
+    def __getattr__(self, name):
+        return getattr(_gpio_module(), name)
+
+GPIO = _GPIOProxy()
@@ -0,0 +1,712 @@
+'''
+In-process emulation of the Kitchen Sink hardware: MCP23017, ADS7828 and SHT31 register
+models behind an smbus.SMBus compatible bus, an RPi.GPIO compatible GPIO module with edge
+injection, and ball valve motors that reach their limit switches after a travel time.
+
+Device models see raw I2C messages - write(data) and read(length) - so the smbus calls
+the drivers make are decoded exactly as the chip would (register pointers, command bytes).
+'''
+import threading
+import queue
+import time
+import math
+
+import sht31
+
+# Returned by smbus when a device does not acknowledge (EREMOTEIO)
+_ERRNO_NACK = 121
+
+def _nack():
+    return OSError(_ERRNO_NACK, "Remote I/O error")
+
+''' ------------------------------ I2C Bus ------------------------------ '''
+'''smbus.SMBus compatible bus that routes transfers to device models by address'''
+class EmulatedSMBus:
+
+    def __init__(self):
+        self._devices = dict()
+        self._lock = threading.RLock()
+        self.transfer_count = 0
+
+    def attach(self, address : int, device_model) -> None:
+        self._devices[address] = device_model
+
+    def detach(self, address : int) -> None:
+        self._devices.pop(address, None)
+
+    def read_byte(self, address) -> int:
+        return self._transfer(address, None, 1)[0]
+
+    def write_byte(self, address, value) -> None:
+        self._transfer(address, [value], 0)
+
+    def read_byte_data(self, address, register) -> int:
+        return self._transfer(address, [register], 1)[0]
+
+    def write_byte_data(self, address, register, value) -> None:
+        self._transfer(address, [register, value], 0)
+
+    def read_i2c_block_data(self, address, register, length) -> list:
+        return self._transfer(address, [register], length)
+
+    def write_i2c_block_data(self, address, register, data) -> None:
+        self._transfer(address, [register] + list(data), 0)
+
+    def i2c_rdwr(self, *messages) -> None:
+        '''Combined transfer of EmulatedI2CMessage (smbus2.i2c_msg) messages - reads fill the message buffers'''
+        for message in messages:
+            if message.is_read:
+                message.buf[:] = self._transfer(message.addr, None, message.len)
+            else:
+                self._transfer(message.addr, list(message.buf), 0)
+
+    def close(self) -> None:
+        pass
+
+    def _transfer(self, address, write_data, read_length) -> list:
+        with self._lock:
+            device_model = self._devices.get(address)
+            if device_model == None:
+                raise _nack()
+            self.transfer_count += 1
+            if write_data != None:
+                device_model.write([value & 0xFF for value in write_data])
+            if read_length > 0:
+                return device_model.read(read_length)
+            return []
+
+'''smbus2.i2c_msg stand-in - iterating a read message yields the bytes read'''
+class EmulatedI2CMessage:
+
+    def __init__(self, address, data, is_read):
+        self.addr = address
+        self.buf = list(data)
+        self.len = len(self.buf)
+        self.is_read = is_read
+
+    @staticmethod
+    def read(address, length):
+        return EmulatedI2CMessage(address, [0] * length, True)
+
+    @staticmethod
+    def write(address, data):
+        return EmulatedI2CMessage(address, data, False)
+
+    def __iter__(self):
+        return iter(self.buf)
+
+''' ------------------------------ GPIO ------------------------------ '''
+'''RPi.GPIO compatible module. Edge callbacks run on a dispatcher thread, like RPi.GPIO.'''
+class EmulatedGPIO:
+    # RPi.GPIO constants
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self._mode = None
+        self._lock = threading.RLock()
+        self._levels = dict()
+        self._directions = dict()
+        self._event_detects = dict()    # channel -> [edge, [callbacks]]
+        self._event_queue = queue.Queue()
+        self._dispatcher = threading.Thread(target=self._dispatch_events, name="emulated-gpio", daemon=True)
+        self._dispatcher.start()
+        self.edge_count = 0
+
+    ''' -------- RPi.GPIO API -------- '''
+    def setmode(self, mode) -> None:
+        self._mode = mode
+
+    def getmode(self):
+        return self._mode
+
+    def setwarnings(self, flag) -> None:
+        pass
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None) -> None:
+        with self._lock:
+            self._directions[channel] = direction
+            if channel not in self._levels:
+                if direction == self.OUT and initial != None:
+                    self._levels[channel] = 1 if initial else 0
+                else:
+                    self._levels[channel] = 1 if pull_up_down == self.PUD_UP else 0
+
+    def input(self, channel) -> int:
+        with self._lock:
+            return self._levels.get(channel, 0)
+
+    def output(self, channel, value) -> None:
+        self.set_input_level(channel, value)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None) -> None:
+        with self._lock:
+            if channel in self._event_detects:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            self._event_detects[channel] = [edge, []]
+            if callback != None:
+                self._event_detects[channel][1].append(callback)
+
+    def add_event_callback(self, channel, callback) -> None:
+        with self._lock:
+            if channel not in self._event_detects:
+                raise RuntimeError("Add event detection using add_event_detect first before adding a callback")
+            self._event_detects[channel][1].append(callback)
+
+    def remove_event_detect(self, channel) -> None:
+        with self._lock:
+            self._event_detects.pop(channel, None)
+
+    def cleanup(self, channel=None) -> None:
+        with self._lock:
+            if channel == None:
+                self._event_detects.clear()
+                self._directions.clear()
+            else:
+                self._event_detects.pop(channel, None)
+                self._directions.pop(channel, None)
+
+    ''' -------- Injection -------- '''
+    def set_input_level(self, channel, level) -> None:
+        '''Drive a pin level; fires the edge callbacks registered for the resulting edge'''
+        level = 1 if level else 0
+        with self._lock:
+            previous_level = self._levels.get(channel, 0)
+            self._levels[channel] = level
+            if previous_level == level or channel not in self._event_detects:
+                return
+            (edge, callbacks) = self._event_detects[channel]
+            edge_matches = (edge == self.BOTH or
+                            (edge == self.RISING and level == 1) or
+                            (edge == self.FALLING and level == 0))
+            if not edge_matches:
+                return
+            self.edge_count += 1
+            for callback in callbacks:
+                self._event_queue.put((callback, channel))
+
+    def inject_pulse(self, channel, active_low=True) -> None:
+        '''One pulse - a falling then rising edge when active_low'''
+        self.set_input_level(channel, 0 if active_low else 1)
+        self.set_input_level(channel, 1 if active_low else 0)
+
+    def inject_pulses(self, channel, count, period_secs=0.0, active_low=True) -> None:
+        for pulse_index in range(count):
+            self.inject_pulse(channel, active_low)
+            if period_secs > 0:
+                time.sleep(period_secs)
+
+    def wait_idle(self) -> None:
+        '''Block until every queued edge callback has run'''
+        self._event_queue.join()
+
+    def _dispatch_events(self):
+        while True:
+            (callback, channel) = self._event_queue.get()
+            try:
+                callback(channel)
+            except Exception as e:
+                print(f"EmulatedGPIO: callback error on channel {channel}: {e}")
+            finally:
+                self._event_queue.task_done()
+
+''' ------------------------------ MCP23017 ------------------------------ '''
+# Register addresses with IOCON.BANK = 0
+_MCP_IODIRA = 0x00
+_MCP_IPOLA = 0x02
+_MCP_GPINTENA = 0x04
+_MCP_DEFVALA = 0x06
+_MCP_INTCONA = 0x08
+_MCP_IOCON = 0x0A
+_MCP_IOCONB = 0x0B
+_MCP_GPPUA = 0x0C
+_MCP_INTFA = 0x0E
+_MCP_INTCAPA = 0x10
+_MCP_GPIOA = 0x12
+_MCP_OLATA = 0x14
+_MCP_REGISTER_COUNT = 0x16
+
+_MCP_IOCON_INTPOL = 0x02
+_MCP_IOCON_SEQOP = 0x20
+_MCP_IOCON_MIRROR = 0x40
+
+'''
+MCP23017 register model (IOCON.BANK = 0 addressing).
+    - SEQOP = 0 increments the address pointer after each byte, SEQOP = 1 toggles it within the A/B pair
+    - GPIO reads return pin levels (IPOL applied to inputs), GPIO writes land in OLAT
+    - Interrupt-on-change / compare-to-DEFVAL with INTF and INTCAP; reading INTCAP or GPIO clears the port
+    - INTA / INTB outputs (MIRROR, INTPOL) can drive EmulatedGPIO lines
+'''
+class MCP23017Model:
+
+    def __init__(self, address=0x21):
+        self.address = address
+        self._lock = threading.RLock()
+        self._registers = [0] * _MCP_REGISTER_COUNT
+        self._registers[_MCP_IODIRA] = 0xFF
+        self._registers[_MCP_IODIRA + 1] = 0xFF
+        self._pointer = 0
+        self._external_levels = [0, 0]          # Levels driven onto input pins, per port
+        self._previous_levels = [0, 0]          # Pin levels at the last interrupt evaluation
+        self._int_outputs = [None, None]        # (gpio, bcm_pin) wired to INTA / INTB
+        self._output_change_callbacks = list()
+        self._pre_access_hooks = list()
+
+    ''' -------- I2C -------- '''
+    def write(self, data : list) -> None:
+        with self._lock:
+            self._run_pre_access_hooks()
+            if len(data) == 0:
+                return
+            self._pointer = data[0] % _MCP_REGISTER_COUNT
+            for value in data[1:]:
+                self._write_register(self._pointer, value)
+                self._advance_pointer()
+
+    def read(self, length : int) -> list:
+        with self._lock:
+            self._run_pre_access_hooks()
+            data = list()
+            for byte_index in range(length):
+                data.append(self._read_register(self._pointer))
+                self._advance_pointer()
+            return data
+
+    ''' -------- Injection / inspection -------- '''
+    def set_input(self, pin : int, level) -> None:
+        '''Drive an external level onto pin 0 - 15'''
+        with self._lock:
+            port = pin // 8
+            bit = 1 << (pin % 8)
+            if level:
+                self._external_levels[port] |= bit
+            else:
+                self._external_levels[port] &= ~bit
+            self._evaluate_interrupts(port)
+
+    def get_output(self, pin : int) -> int:
+        '''Level the chip drives on an output pin (OLAT)'''
+        with self._lock:
+            return (self._registers[_MCP_OLATA + pin // 8] >> (pin % 8)) & 1
+
+    def get_register(self, register : int) -> int:
+        with self._lock:
+            return self._registers[register]
+
+    def connect_interrupt(self, gpio : EmulatedGPIO, bcm_pin : int, port=0) -> None:
+        '''Wire INTA (port 0) or INTB (port 1) to an emulated Pi GPIO input'''
+        self._int_outputs[port] = (gpio, bcm_pin)
+        self._update_int_outputs()
+
+    def add_output_change_callback(self, callback) -> None:
+        '''callback(model) after any OLAT / IODIR change'''
+        self._output_change_callbacks.append(callback)
+
+    def add_pre_access_hook(self, hook) -> None:
+        '''hook() before every bus access - lets attached models advance their simulation'''
+        self._pre_access_hooks.append(hook)
+
+    def run_locked(self, function):
+        '''Run function() with the register file locked - attached models share this lock'''
+        with self._lock:
+            return function()
+
+    ''' -------- Register logic -------- '''
+    def _advance_pointer(self):
+        if self._registers[_MCP_IOCON] & _MCP_IOCON_SEQOP:
+            self._pointer ^= 0x01
+        else:
+            self._pointer = (self._pointer + 1) % _MCP_REGISTER_COUNT
+
+    def _pin_levels(self, port) -> int:
+        iodir = self._registers[_MCP_IODIRA + port]
+        olat = self._registers[_MCP_OLATA + port]
+        return (self._external_levels[port] & iodir) | (olat & ~iodir & 0xFF)
+
+    def _gpio_value(self, port) -> int:
+        iodir = self._registers[_MCP_IODIRA + port]
+        return self._pin_levels(port) ^ (self._registers[_MCP_IPOLA + port] & iodir)
+
+    def _read_register(self, register) -> int:
+        port = register & 0x01
+        base_register = register & ~0x01
+        if base_register == _MCP_GPIOA:
+            value = self._gpio_value(port)
+            self._clear_interrupt(port)
+            return value
+        if base_register == _MCP_INTCAPA:
+            value = self._registers[register]
+            self._clear_interrupt(port)
+            return value
+        return self._registers[register]
+
+    def _write_register(self, register, value):
+        port = register & 0x01
+        base_register = register & ~0x01
+        if base_register in (_MCP_INTFA, _MCP_INTCAPA):
+            return      # Read-only
+        if register in (_MCP_IOCON, _MCP_IOCONB):
+            # IOCON is shared by both addresses
+            self._registers[_MCP_IOCON] = value
+            self._registers[_MCP_IOCONB] = value
+            self._update_int_outputs()
+            return
+        if base_register == _MCP_GPIOA:
+            register = _MCP_OLATA + port
+            base_register = _MCP_OLATA
+        self._registers[register] = value
+        if base_register in (_MCP_OLATA, _MCP_IODIRA):
+            for callback in self._output_change_callbacks:
+                callback(self)
+        if base_register in (_MCP_GPINTENA, _MCP_INTCONA, _MCP_DEFVALA):
+            self._evaluate_interrupts(port)
+
+    def _evaluate_interrupts(self, port):
+        gpinten = self._registers[_MCP_GPINTENA + port]
+        intcon = self._registers[_MCP_INTCONA + port]
+        defval = self._registers[_MCP_DEFVALA + port]
+        levels = self._pin_levels(port)
+        previous_levels = self._previous_levels[port]
+        self._previous_levels[port] = levels
+        # INTCON = 0: any change from the previous level, INTCON = 1: level differs from DEFVAL
+        changed = ((levels ^ previous_levels) & ~intcon) | ((levels ^ defval) & intcon)
+        changed &= gpinten
+        if changed and self._registers[_MCP_INTFA + port] == 0:
+            self._registers[_MCP_INTFA + port] = changed
+            self._registers[_MCP_INTCAPA + port] = self._gpio_value(port)
+            self._update_int_outputs()
+
+    def _clear_interrupt(self, port):
+        if self._registers[_MCP_INTFA + port] != 0:
+            self._registers[_MCP_INTFA + port] = 0
+            self._update_int_outputs()
+        # Compare-to-DEFVAL interrupts re-assert while the condition persists
+        if self._registers[_MCP_INTCONA + port]:
+            self._evaluate_interrupts(port)
+
+    def _update_int_outputs(self):
+        iocon = self._registers[_MCP_IOCON]
+        active = [self._registers[_MCP_INTFA] != 0, self._registers[_MCP_INTFA + 1] != 0]
+        if iocon & _MCP_IOCON_MIRROR:
+            active = [active[0] or active[1]] * 2
+        active_level = 1 if iocon & _MCP_IOCON_INTPOL else 0
+        for port in range(2):
+            if self._int_outputs[port] == None:
+                continue
+            (gpio, bcm_pin) = self._int_outputs[port]
+            gpio.set_input_level(bcm_pin, active_level if active[port] else 1 - active_level)
+
+    def _run_pre_access_hooks(self):
+        for hook in self._pre_access_hooks:
+            hook()
+
+''' ------------------------------ ADS7828 ------------------------------ '''
+# Single-ended channel select bits (C2 C1 C0) to input channel
+_ADS7828_SINGLE_ENDED_CHANNELS = [0, 2, 4, 6, 1, 3, 5, 7]
+
+'''
+ADS7828 model - the command byte selects the channel and starts a conversion, the next
+two bytes read back the 12-bit result. Channel inputs are constant voltages or
+waveform functions of time (seconds since the model was created).
+'''
+class ADS7828Model:
+
+    def __init__(self, address=0x48, vref=2.5):
+        self.address = address
+        self.vref = vref
+        self._lock = threading.Lock()
+        self._command = None
+        self._result = 0
+        self._waveforms = [(lambda t: 0.0)] * 8
+        self._start_time = time.monotonic()
+        self.conversion_count = 0
+
+    def write(self, data : list) -> None:
+        with self._lock:
+            for command in data:
+                self._command = command
+                self._convert()
+
+    def read(self, length : int) -> list:
+        with self._lock:
+            result = [(self._result >> 8) & 0x0F, self._result & 0xFF]
+            return (result * ((length + 1) // 2))[:length]
+
+    def set_channel_voltage(self, channel : int, volts : float) -> None:
+        self._waveforms[channel] = (lambda t: volts)
+
+    def set_channel_waveform(self, channel : int, waveform) -> None:
+        '''waveform(t_secs) -> volts'''
+        self._waveforms[channel] = waveform
+
+    def channel_from_command(self, command : int) -> int:
+        # Differential mode (SD = 0) is modelled on the positive input of the pair
+        select_bits = (command >> 4) & 0x07
+        return _ADS7828_SINGLE_ENDED_CHANNELS[select_bits]
+
+    def _convert(self):
+        channel = self.channel_from_command(self._command)
+        volts = self._waveforms[channel](time.monotonic() - self._start_time)
+        code = int(volts / self.vref * 4096)
+        self._result = min(max(code, 0), 4095)
+        self.conversion_count += 1
+
+''' ------------------------------ SHT31 ------------------------------ '''
+_SHT31_CMD_FETCH = 0xE000
+_SHT31_CMD_BREAK = 0x3093
+_SHT31_CMD_SOFT_RESET = 0x30A2
+_SHT31_SINGLE_SHOT_STRETCH = (0x2C06, 0x2C0D, 0x2C10)
+_SHT31_SINGLE_SHOT_NO_STRETCH = (0x2400, 0x240B, 0x2416)
+# Periodic acquisition commands -> measurements per second
+_SHT31_PERIODIC = {0x2032: 0.5, 0x2024: 0.5, 0x202F: 0.5,
+                   0x2130: 1.0, 0x2126: 1.0, 0x212D: 1.0,
+                   0x2236: 2.0, 0x2220: 2.0, 0x222B: 2.0,
+                   0x2334: 4.0, 0x2322: 4.0, 0x2329: 4.0,
+                   0x2737: 10.0, 0x2721: 10.0, 0x272A: 10.0}
+_SHT31_MEASUREMENT_SECS = 0.015
+
+'''
+SHT31 model - 16-bit commands, single shot (with and without clock stretching) and periodic
+acquisition with fetch. A read with no measurement ready is not acknowledged, like the sensor.
+'''
+class SHT31Model:
+
+    def __init__(self, address=0x44, temperature_c=22.0, humidity=45.0):
+        self.address = address
+        self._lock = threading.Lock()
+        self.temperature_c = temperature_c
+        self.humidity = humidity
+        self._ready_time = None             # Single shot result available from this time
+        self._periodic_rate = None
+        self._periodic_start = None
+        self._last_fetched_index = -1
+        self._fetch_pending = False
+        self.measurement_count = 0
+
+    def write(self, data : list) -> None:
+        with self._lock:
+            if len(data) < 2:
+                raise _nack()       # Incomplete command
+            command = (data[0] << 8) | data[1]
+            now = time.monotonic()
+            if command in _SHT31_SINGLE_SHOT_STRETCH:
+                self._ready_time = now
+                self.measurement_count += 1
+            elif command in _SHT31_SINGLE_SHOT_NO_STRETCH:
+                self._ready_time = now + _SHT31_MEASUREMENT_SECS
+                self.measurement_count += 1
+            elif command in _SHT31_PERIODIC:
+                self._periodic_rate = _SHT31_PERIODIC[command]
+                self._periodic_start = now
+                self._last_fetched_index = -1
+            elif command == _SHT31_CMD_FETCH:
+                self._fetch_pending = True
+            elif command in (_SHT31_CMD_BREAK, _SHT31_CMD_SOFT_RESET):
+                self._periodic_rate = None
+                self._ready_time = None
+            else:
+                raise _nack()
+
+    def read(self, length : int) -> list:
+        with self._lock:
+            now = time.monotonic()
+            if self._fetch_pending and self._periodic_rate != None:
+                self._fetch_pending = False
+                measurement_index = int((now - self._periodic_start - _SHT31_MEASUREMENT_SECS) * self._periodic_rate)
+                if measurement_index < 0 or measurement_index == self._last_fetched_index:
+                    raise _nack()
+                self._last_fetched_index = measurement_index
+                self.measurement_count += 1
+            elif self._ready_time != None and now >= self._ready_time:
+                self._ready_time = None
+            else:
+                raise _nack()
+            return self.measurement_frame()[:length]
+
+    def measurement_frame(self) -> list:
+        '''Temp MSB, Temp LSB, Temp CRC, Humidity MSB, Humidity LSB, Humidity CRC'''
+        raw_temperature = int(round((self.temperature_c + 45.0) * 65535.0 / 175.0))
+        raw_humidity = int(round(self.humidity * 65535.0 / 100.0))
+        raw_temperature = min(max(raw_temperature, 0), 0xFFFF)
+        raw_humidity = min(max(raw_humidity, 0), 0xFFFF)
+        temperature_bytes = [raw_temperature >> 8, raw_temperature & 0xFF]
+        humidity_bytes = [raw_humidity >> 8, raw_humidity & 0xFF]
+        return (temperature_bytes + [sht31.crc8(temperature_bytes)] +
+                humidity_bytes + [sht31.crc8(humidity_bytes)])
+
+''' ------------------------------ Ball Valve ------------------------------ '''
+'''
+Ball valve motor driven by two MCP23017 outputs (direction, enable) with two limit switch
+inputs. The valve travels between closed (0.0) and open (1.0) in travel_time_secs while
+enabled; direction low opens, high closes (BallValve.TRANSITION_OPEN / TRANSITION_CLOSE).
+'''
+class BallValveModel:
+
+    def __init__(self, mcp_model : MCP23017Model, open_limit_pin, closed_limit_pin,
+                 direction_pin, enable_pin, travel_time_secs=2.0, position=0.0):
+        self._mcp_model = mcp_model
+        self._open_limit_pin = open_limit_pin
+        self._closed_limit_pin = closed_limit_pin
+        self._direction_pin = direction_pin
+        self._enable_pin = enable_pin
+        self.travel_time_secs = travel_time_secs
+        self.position = position
+        self._last_update = time.monotonic()
+        mcp_model.run_locked(self._update_limit_switches)
+        mcp_model.add_pre_access_hook(self._advance)
+
+    def update(self) -> None:
+        '''Advance the motor to the current time and refresh the limit switches'''
+        self._mcp_model.run_locked(self._advance)
+
+    def _advance(self):
+        now = time.monotonic()
+        elapsed_secs = now - self._last_update
+        self._last_update = now
+        if not self._mcp_model.get_output(self._enable_pin):
+            return
+        step = elapsed_secs / self.travel_time_secs if self.travel_time_secs > 0 else 1.0
+        if self._mcp_model.get_output(self._direction_pin):
+            self.position = max(0.0, self.position - step)
+        else:
+            self.position = min(1.0, self.position + step)
+        self._update_limit_switches()
+
+    def is_open(self) -> bool:
+        return self.position >= 1.0
+
+    def is_closed(self) -> bool:
+        return self.position <= 0.0
+
+    def _update_limit_switches(self):
+        self._mcp_model.set_input(self._open_limit_pin, self.position >= 1.0)
+        self._mcp_model.set_input(self._closed_limit_pin, self.position <= 0.0)
+
+''' ------------------------------ Emulator ------------------------------ '''
+'''Owns the emulated bus, GPIO and device models'''
+class HardwareEmulator:
+
+    def __init__(self):
+        self.bus = EmulatedSMBus()
+        self.gpio = EmulatedGPIO()
+        self.devices = dict()
+        self.ball_valves = list()
+        self._simulation_thread = None
+        self._run_simulation = False
+
+    @classmethod
+    def default_kitchen_sink(cls, number_of_valves=4, travel_time_secs=2.0):
+        '''One Kitchen Sink hat: MCP23017 at 0x21, ADS7828 at 0x48, SHT31 at 0x44 and ball valves on the expander'''
+        emulator = cls()
+        mcp_model = emulator.add_mcp23017(0x21)
+        emulator.add_ads7828(0x48)
+        emulator.add_sht31(0x44)
+        for valve_index in range(min(number_of_valves, 4)):
+            emulator.add_ball_valve(mcp_model,
+                                    open_pin=2 * valve_index,
+                                    close_pin=1 + 2 * valve_index,
+                                    direction_pin=8 + 2 * valve_index,
+                                    enable_pin=9 + 2 * valve_index,
+                                    travel_time_secs=travel_time_secs)
+        return emulator
+
+    def open_smbus(self, bus_number=1) -> EmulatedSMBus:
+        return self.bus
+
+    def add_mcp23017(self, address=0x21, int_bcm_pin=None) -> MCP23017Model:
+        mcp_model = MCP23017Model(address)
+        if int_bcm_pin != None:
+            self.gpio.setup(int_bcm_pin, EmulatedGPIO.IN, pull_up_down=EmulatedGPIO.PUD_UP)
+            mcp_model.connect_interrupt(self.gpio, int_bcm_pin)
+        self._attach(address, mcp_model)
+        return mcp_model
+
+    def add_ads7828(self, address=0x48, vref=2.5) -> ADS7828Model:
+        return self._attach(address, ADS7828Model(address, vref))
+
+    def add_sht31(self, address=0x44, temperature_c=22.0, humidity=45.0) -> SHT31Model:
+        return self._attach(address, SHT31Model(address, temperature_c, humidity))
+
+    def add_ball_valve(self, mcp_model, open_pin, close_pin, direction_pin, enable_pin,
+                       travel_time_secs=2.0, position=0.0) -> BallValveModel:
+        '''Pins as wired to BallValve: the 'open' input reads high at the closed end stop and the
+        'close' input at the open end stop (see BallValve.get_valve_position)'''
+        valve_model = BallValveModel(mcp_model,
+                                     open_limit_pin=close_pin,
+                                     closed_limit_pin=open_pin,
+                                     direction_pin=direction_pin,
+                                     enable_pin=enable_pin,
+                                     travel_time_secs=travel_time_secs,
+                                     position=position)
+        self.ball_valves.append(valve_model)
+        return valve_model
+
+    def start_simulation(self, period_secs=0.005) -> None:
+        '''Advance the valve motors in the background so limit switch interrupts fire without bus polling'''
+        if self._simulation_thread != None:
+            return
+        self._run_simulation = True
+        self._simulation_thread = threading.Thread(target=self._simulate, args=(period_secs,),
+                                                   name="hw-emulator", daemon=True)
+        self._simulation_thread.start()
+
+    def stop_simulation(self) -> None:
+        self._run_simulation = False
+        if self._simulation_thread != None:
+            self._simulation_thread.join()
+            self._simulation_thread = None
+
+    def _attach(self, address, device_model):
+        self.devices[address] = device_model
+        self.bus.attach(address, device_model)
+        return device_model
+
+    def _simulate(self, period_secs):
+        while self._run_simulation:
+            for valve_model in self.ball_valves:
+                valve_model.update()
+            time.sleep(period_secs)
+
+'''Component Test - run the drivers and a valve cycle against the emulator'''
+if __name__ == '__main__':
+    import hw_backend
+    emulator = hw_backend.use_emulator(HardwareEmulator.default_kitchen_sink(travel_time_secs=1.0))
+
+    import mcp23017
+    import ads7828
+    import ball_valve
+    import i2c_bus_manager
+
+    # Waveforms - 60 Hz motor current and a steady pressure signal
+    emulator.devices[0x48].set_channel_waveform(0, lambda t: 1.25 + 0.5 * math.sin(2 * math.pi * 60 * t))
+    emulator.devices[0x48].set_channel_voltage(1, 1.0)
+
+    adc = ads7828.ADS7828()
+    print(f"ADC Voltages: {[round(v, 3) for v in adc.get_voltages_from_device(apply_calibration=False)]}")
+    print(f"Enclosure: {sht31.SHT31().read_temp_humidity()}")
+
+    mcp = mcp23017.MCP23017(0x21)
+    valve = ball_valve.BallValve("Emulated Valve", mcp, 0, 1, 8, 9, transition_timeout_secs=5,
+                                 state_change_callback=lambda valve_obj, state, state_str, context: print(f"{state_str}: {context}"))
+    valve.process()
+    valve.request_open()
+    start_time = time.monotonic()
+    while not valve.is_open() and time.monotonic() - start_time < 5:
+        valve.process()
+        time.sleep(0.05)
+    for proc_index in range(3):
+        valve.process()
+    print(f"Valve open after {time.monotonic() - start_time:.2f} secs")
+
+    for stats in i2c_bus_manager.get_shared_bus(1).get_device_stats().values():
+        print(stats)
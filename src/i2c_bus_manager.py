@@ -0,0 +1,217 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import hw_backend
+import i2c_trace
+
+# Transaction priorities - lower value wins the bus first.
+# A transaction already on the bus is never interrupted; priority decides who goes next,
+# first come first served within a priority - a loop on the bus cannot barge ahead of a waiter.
+PRIORITY_SAFETY = 0         # Contactor / valve drive writes
+PRIORITY_CONTROL = 1        # Limit switch reads, expander configuration
+PRIORITY_TELEMETRY = 2      # ADC and environmental sensor reads
+_PRIORITY_LEVELS = 3
+
+# Latency histogram bucket upper bounds in microseconds (the last bucket holds everything slower)
+LATENCY_BUCKETS_US = [100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000]
+
+'''Transaction statistics for one device address'''
+class DeviceStats:
+    def __init__(self, address : int):
+        self.address = address
+        self.transaction_count = 0
+        self.error_count = 0
+        self.total_latency_secs = 0.0
+        self.max_latency_secs = 0.0
+        self.latency_histogram = [0] * (len(LATENCY_BUCKETS_US) + 1)
+
+    def record(self, latency_secs : float, error : bool) -> None:
+        self.transaction_count += 1
+        if error:
+            self.error_count += 1
+        self.total_latency_secs += latency_secs
+        if latency_secs > self.max_latency_secs:
+            self.max_latency_secs = latency_secs
+        latency_us = latency_secs * 1e6
+        bucket_index = 0
+        while bucket_index < len(LATENCY_BUCKETS_US) and latency_us > LATENCY_BUCKETS_US[bucket_index]:
+            bucket_index += 1
+        self.latency_histogram[bucket_index] += 1
+
+    def mean_latency_secs(self) -> float:
+        if self.transaction_count == 0:
+            return 0.0
+        return self.total_latency_secs / self.transaction_count
+
+    def copy(self):
+        stats_copy = DeviceStats(self.address)
+        stats_copy.transaction_count = self.transaction_count
+        stats_copy.error_count = self.error_count
+        stats_copy.total_latency_secs = self.total_latency_secs
+        stats_copy.max_latency_secs = self.max_latency_secs
+        stats_copy.latency_histogram = list(self.latency_histogram)
+        return stats_copy
+
+    def __str__(self) -> str:
+        return (f"0x{self.address:02X}: {self.transaction_count} transactions, {self.error_count} errors, "
+                f"mean {self.mean_latency_secs() * 1e6:.0f} us, max {self.max_latency_secs * 1e6:.0f} us")
+
+'''
+Owns the I2C bus file descriptor and serializes every transaction from the main loop,
+the GPIO callback thread and the MQTT thread. The transfer methods take the same
+arguments as smbus.SMBus plus an optional priority, so drivers use it in place of SMBus.
+'''
+class I2CBusManager:
+
+    def __init__(self, bus_number=1):
+        self.bus_number = bus_number
+        self._smbus = hw_backend.open_smbus(bus_number)
+        self._condition = threading.Condition()
+        self._owner = None
+        self._owner_depth = 0
+        self._waiting = [deque() for priority in range(_PRIORITY_LEVELS)]    # waiting thread ids per priority
+        self._stats_lock = threading.Lock()
+        self._device_stats = dict()
+        self._tracer = None
+
+    ''' ------------------------ Public Functions ------------------------ '''
+    @contextmanager
+    def transaction(self, priority=PRIORITY_CONTROL):
+        '''Hold the bus for a multi-transfer sequence (e.g. command write then data read)'''
+        self._acquire(priority)
+        try:
+            yield self
+        finally:
+            self._release()
+
+    def read_byte(self, address, priority=PRIORITY_CONTROL) -> int:
+        return self._transfer(address, priority, i2c_trace.OP_READ_BYTE, None, None,
+                              self._smbus.read_byte, address)
+
+    def write_byte(self, address, value, priority=PRIORITY_CONTROL) -> None:
+        return self._transfer(address, priority, i2c_trace.OP_WRITE_BYTE, None, value,
+                              self._smbus.write_byte, address, value)
+
+    def read_byte_data(self, address, register, priority=PRIORITY_CONTROL) -> int:
+        return self._transfer(address, priority, i2c_trace.OP_READ_BYTE_DATA, register, None,
+                              self._smbus.read_byte_data, address, register)
+
+    def write_byte_data(self, address, register, value, priority=PRIORITY_CONTROL) -> None:
+        return self._transfer(address, priority, i2c_trace.OP_WRITE_BYTE_DATA, register, value,
+                              self._smbus.write_byte_data, address, register, value)
+
+    def read_i2c_block_data(self, address, register, length, priority=PRIORITY_CONTROL) -> list:
+        return self._transfer(address, priority, i2c_trace.OP_READ_BLOCK, register, None,
+                              self._smbus.read_i2c_block_data, address, register, length)
+
+    def write_i2c_block_data(self, address, register, data, priority=PRIORITY_CONTROL) -> None:
+        return self._transfer(address, priority, i2c_trace.OP_WRITE_BLOCK, register, data,
+                              self._smbus.write_i2c_block_data, address, register, data)
+
+    def read_bytes(self, address, length, priority=PRIORITY_CONTROL) -> list:
+        '''Plain read of length bytes - unlike read_i2c_block_data no register byte is written first'''
+        return self._transfer(address, priority, i2c_trace.OP_READ_RAW, None, None,
+                              self._read_message, hw_backend.create_read_message(address, length))
+
+    def enable_tracing(self, depth=4096) -> i2c_trace.I2CTracer:
+        '''Record every transfer into a ring buffer of depth records (see i2c_trace)'''
+        if self._tracer == None or self._tracer.depth != depth:
+            self._tracer = i2c_trace.I2CTracer(depth)
+        return self._tracer
+
+    def disable_tracing(self) -> None:
+        self._tracer = None
+
+    def get_tracer(self) -> i2c_trace.I2CTracer:
+        return self._tracer
+
+    def trace_tick(self) -> None:
+        '''Mark the start of a main loop iteration in the trace - no-op when tracing is off'''
+        tracer = self._tracer
+        if tracer != None:
+            tracer.mark_tick()
+
+    def get_device_stats(self) -> dict:
+        '''Copy of the per-device statistics keyed by device address'''
+        with self._stats_lock:
+            return {address: stats.copy() for (address, stats) in self._device_stats.items()}
+
+    def reset_device_stats(self) -> None:
+        with self._stats_lock:
+            self._device_stats.clear()
+
+    ''' ------------------------ Private Functions ------------------------ '''
+    def _transfer(self, address, priority, trace_op, register, write_data, smbus_function, *args):
+        '''Run one smbus transfer with the bus held and record its latency'''
+        self._acquire(priority)
+        start_time = time.perf_counter()
+        error = True
+        result = None
+        try:
+            result = smbus_function(*args)
+            error = False
+            return result
+        finally:
+            latency_secs = time.perf_counter() - start_time
+            self._release()
+            self._record(address, latency_secs, error)
+            tracer = self._tracer
+            if tracer != None:
+                tracer.record(address, trace_op, register, write_data if write_data != None else result,
+                              latency_secs, not error)
+
+    def _read_message(self, message) -> list:
+        self._smbus.i2c_rdwr(message)
+        return list(message)
+
+    def _acquire(self, priority):
+        '''Wait for the bus - higher priority waiters are granted the bus first, then in arrival order. Re-entrant per thread.'''
+        thread_id = threading.get_ident()
+        with self._condition:
+            if self._owner == thread_id:
+                self._owner_depth += 1
+                return
+            waiting = self._waiting[priority]
+            if self._owner == None and not any(self._waiting[:priority + 1]):
+                self._owner = thread_id
+                self._owner_depth = 1
+                return
+            waiting.append(thread_id)
+            while self._owner != None or any(self._waiting[:priority]) or waiting[0] != thread_id:
+                self._condition.wait()
+            waiting.popleft()
+            self._owner = thread_id
+            self._owner_depth = 1
+
+    def _release(self):
+        with self._condition:
+            self._owner_depth -= 1
+            if self._owner_depth == 0:
+                self._owner = None
+                self._condition.notify_all()
+
+    def _record(self, address, latency_secs, error):
+        with self._stats_lock:
+            stats = self._device_stats.get(address)
+            if stats == None:
+                stats = DeviceStats(address)
+                self._device_stats[address] = stats
+            stats.record(latency_secs, error)
+
+'''One manager per physical bus, shared by every driver in the process'''
+_shared_buses = dict()
+_shared_buses_lock = threading.Lock()
+
+def get_shared_bus(bus_number=1) -> I2CBusManager:
+    with _shared_buses_lock:
+        if bus_number not in _shared_buses:
+            _shared_buses[bus_number] = I2CBusManager(bus_number)
+        return _shared_buses[bus_number]
+
+'''Accept either a bus number (shared manager) or an I2CBusManager instance'''
+def resolve_bus(bus) -> I2CBusManager:
+    if isinstance(bus, int):
+        return get_shared_bus(bus)
+    return bus
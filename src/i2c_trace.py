@@ -0,0 +1,233 @@
+'''
+Opt-in I2C transaction tracer - a fixed-size ring buffer of binary records filled by the
+bus manager and dumped to a compact binary file on demand (signal or MQTT command).
+
+File layout: header '<4sHHI' (magic, version, record size, record count) followed by the
+records oldest first. Record layout '<dBBhB8sIB':
+    timestamp (time.monotonic secs), device address, operation, register (-1 = none),
+    byte count, first 8 data bytes, duration (microseconds), ok (1) / error (0)
+A TICK record (address 0xFF) marks the start of each main loop iteration.
+'''
+import struct
+import threading
+import signal
+import os
+import sys
+import time
+import datetime
+
+import logger
+
+TRACE_MAGIC = b'I2CT'
+TRACE_VERSION = 1
+_HEADER_FORMAT = '<4sHHI'
+_RECORD_FORMAT = '<dBBhB8sIB'
+HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+RECORD_SIZE = struct.calcsize(_RECORD_FORMAT)
+
+# Operations
+OP_TICK = 0
+OP_READ_BYTE = 1
+OP_WRITE_BYTE = 2
+OP_READ_BYTE_DATA = 3
+OP_WRITE_BYTE_DATA = 4
+OP_READ_BLOCK = 5
+OP_WRITE_BLOCK = 6
+OP_READ_RAW = 7
+OP_NAMES = {OP_TICK: "TICK",
+            OP_READ_BYTE: "RD_BYTE",
+            OP_WRITE_BYTE: "WR_BYTE",
+            OP_READ_BYTE_DATA: "RD_DATA",
+            OP_WRITE_BYTE_DATA: "WR_DATA",
+            OP_READ_BLOCK: "RD_BLOCK",
+            OP_WRITE_BLOCK: "WR_BLOCK",
+            OP_READ_RAW: "RD_RAW"}
+TICK_ADDRESS = 0xFF
+
+'''One decoded trace record'''
+class TraceRecord:
+    def __init__(self, timestamp, address, op, register, length, data, duration_us, ok):
+        self.timestamp = timestamp
+        self.address = address
+        self.op = op
+        self.register = register
+        self.length = length
+        self.data = data
+        self.duration_us = duration_us
+        self.ok = ok
+
+    def __str__(self) -> str:
+        if self.op == OP_TICK:
+            return f"{self.timestamp:.6f} ---- TICK {self.register}"
+        register_str = "--" if self.register < 0 else f"{self.register:02X}"
+        data_str = " ".join(f"{byte:02X}" for byte in self.data)
+        status_str = "OK " if self.ok else "ERR"
+        return (f"{self.timestamp:.6f} 0x{self.address:02X} {OP_NAMES.get(self.op, '?'):<8} reg {register_str} "
+                f"{status_str} {self.duration_us:6d} us [{data_str}]")
+
+class I2CTracer:
+
+    def __init__(self, depth=4096):
+        self.depth = depth
+        self._buffer = bytearray(depth * RECORD_SIZE)
+        self._next_index = 0
+        self._record_count = 0
+        self._tick_count = 0
+        self._lock = threading.Lock()
+
+    def record(self, address, op, register, data, duration_secs, ok) -> None:
+        '''Add one transaction - data is the bytes written or read (first 8 are kept)'''
+        if register == None:
+            register = -1
+        length = 0
+        data_bytes = b''
+        if data != None:
+            if isinstance(data, int):
+                data = (data,)
+            length = min(len(data), 255)
+            data_bytes = bytes(byte & 0xFF for byte in data[:8])
+        with self._lock:
+            struct.pack_into(_RECORD_FORMAT, self._buffer, self._next_index * RECORD_SIZE,
+                             time.monotonic(), address, op, register, length, data_bytes,
+                             min(int(duration_secs * 1e6), 0xFFFFFFFF), 1 if ok else 0)
+            self._advance()
+
+    def mark_tick(self) -> None:
+        '''Mark the start of a main loop iteration'''
+        with self._lock:
+            self._tick_count += 1
+            struct.pack_into(_RECORD_FORMAT, self._buffer, self._next_index * RECORD_SIZE,
+                             time.monotonic(), TICK_ADDRESS, OP_TICK, self._tick_count & 0x7FFF, 0, b'', 0, 1)
+            self._advance()
+
+    def snapshot(self) -> bytes:
+        '''Buffered records oldest first'''
+        with self._lock:
+            if self._record_count < self.depth:
+                return bytes(self._buffer[:self._record_count * RECORD_SIZE])
+            split = self._next_index * RECORD_SIZE
+            return bytes(self._buffer[split:]) + bytes(self._buffer[:split])
+
+    def dump(self, file_path) -> int:
+        '''Write the buffered records to a trace file; returns the record count'''
+        records = self.snapshot()
+        record_count = len(records) // RECORD_SIZE
+        folder_path = os.path.dirname(file_path)
+        if folder_path != "" and not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        with open(file_path, 'wb') as trace_file:
+            trace_file.write(struct.pack(_HEADER_FORMAT, TRACE_MAGIC, TRACE_VERSION, RECORD_SIZE, record_count))
+            trace_file.write(records)
+        return record_count
+
+    def dump_to_directory(self, directory="trace") -> str:
+        '''Dump to a time-stamped file in directory; returns the file path'''
+        file_path = os.path.join(directory, datetime.datetime.now().strftime("i2c_trace_%Y%m%d_%H%M%S.bin"))
+        self.dump(file_path)
+        return file_path
+
+    def clear(self) -> None:
+        with self._lock:
+            self._next_index = 0
+            self._record_count = 0
+
+    def _advance(self):
+        self._next_index = (self._next_index + 1) % self.depth
+        if self._record_count < self.depth:
+            self._record_count += 1
+
+def read_trace_file(file_path) -> list:
+    '''Decode a trace file into a list of TraceRecord'''
+    with open(file_path, 'rb') as trace_file:
+        (magic, version, record_size, record_count) = struct.unpack(_HEADER_FORMAT, trace_file.read(HEADER_SIZE))
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != RECORD_SIZE:
+            raise Exception(f"read_trace_file: unsupported trace file: {file_path}")
+        payload = trace_file.read(record_count * RECORD_SIZE)
+    records = list()
+    for fields in struct.iter_unpack(_RECORD_FORMAT, payload):
+        (timestamp, address, op, register, length, data, duration_us, ok) = fields
+        records.append(TraceRecord(timestamp, address, op, register, length,
+                                   data[:min(length, 8)], duration_us, ok == 1))
+    return records
+
+def install_dump_signal(tracer : I2CTracer, directory="trace", signum=signal.SIGUSR1, on_dump=None) -> None:
+    '''Dump the trace when the process receives signum (kill -USR1 <pid>)'''
+    def _dump():
+        file_path = tracer.dump_to_directory(directory)
+        if on_dump != None:
+            on_dump(file_path)
+    def _signal_handler(sig, frame):
+        # The interrupted thread may hold the tracer lock - dump from a separate thread
+        threading.Thread(target=_dump, name="i2c-trace-dump", daemon=True).start()
+    signal.signal(signum, _signal_handler)
+
+class ServiceTrace:
+    '''A service's bus trace - dump() writes it to directory; dump_topic is the full MQTT topic that requests a dump (None without one)'''
+
+    def __init__(self, tracer : I2CTracer, directory, dump_topic, app_logger, log_key) -> None:
+        self.tracer = tracer
+        self.directory = directory
+        self.dump_topic = dump_topic
+        self._logger = app_logger
+        self._log_key = log_key
+
+    def dump(self) -> str:
+        file_path = self.tracer.dump_to_directory(self.directory)
+        self._on_dump(file_path)
+        return file_path
+
+    def _on_dump(self, file_path):
+        self._logger.write(self._log_key, f"I2C trace written to {file_path}", logger.MessageLevel.INFO)
+
+def setup_service_trace(bus, config : dict, mqtt_client, app_logger, log_key) -> ServiceTrace:
+    '''
+    Opt-in trace of bus from the service config ('i2c_trace' section) - None when disabled.
+    Dumped on SIGUSR1 or an MQTT message on the subscribe/i2c_trace_dump topic (under base_topic).
+    '''
+    trace_config = config.get('i2c_trace', {})
+    if not trace_config.get('enabled', False):
+        return None
+    tracer = bus.enable_tracing(trace_config.get('depth', 4096))
+    dump_topic = config.get('subscribe', {}).get('i2c_trace_dump')
+    if dump_topic != None:
+        mqtt_client.subscribe(dump_topic)
+        dump_topic = f"{config['base_topic']}/{dump_topic}"
+    service_trace = ServiceTrace(tracer, trace_config.get('dump_directory', 'trace'), dump_topic, app_logger, log_key)
+    install_dump_signal(tracer, service_trace.directory, on_dump=service_trace._on_dump)
+    app_logger.write(log_key, f"I2C trace enabled - {tracer.depth} records", logger.MessageLevel.INFO)
+    return service_trace
+
+def print_summary(records : list) -> None:
+    '''Transactions per tick and per-device latency'''
+    tick_transactions = list()
+    device_stats = dict()
+    transactions_this_tick = None
+    for record in records:
+        if record.op == OP_TICK:
+            if transactions_this_tick != None:
+                tick_transactions.append(transactions_this_tick)
+            transactions_this_tick = 0
+            continue
+        if transactions_this_tick != None:
+            transactions_this_tick += 1
+        (count, errors, total_us, max_us) = device_stats.get(record.address, (0, 0, 0, 0))
+        device_stats[record.address] = (count + 1,
+                                        errors + (0 if record.ok else 1),
+                                        total_us + record.duration_us,
+                                        max(max_us, record.duration_us))
+    if transactions_this_tick != None:
+        tick_transactions.append(transactions_this_tick)
+    print(f"Records: {len(records)}")
+    if len(tick_transactions) > 0:
+        print(f"Ticks: {len(tick_transactions)}\tTransactions/tick: min {min(tick_transactions)} "
+              f"mean {sum(tick_transactions) / len(tick_transactions):.1f} max {max(tick_transactions)}")
+    for (address, (count, errors, total_us, max_us)) in sorted(device_stats.items()):
+        print(f"0x{address:02X}: {count} transactions, {errors} errors, mean {total_us / count:.0f} us, max {max_us} us")
+
+'''Print a trace file: python i2c_trace.py <trace file> [--records]'''
+if __name__ == '__main__':
+    trace_records = read_trace_file(sys.argv[1])
+    if "--records" in sys.argv:
+        for trace_record in trace_records:
+            print(trace_record)
+    print_summary(trace_records)
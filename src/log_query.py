@@ -0,0 +1,45 @@
+'''
+Query the structured logs (log/YYYYMMDD.jsonl) - only the hours, and with --key only the spans of
+that key, listed in each file's index are read.
+
+    python log_query.py [--dir log ...] [--start 2026-10-01] [--end 2026-11-01T12:00] [--key service]
+                        [--level WARN] [--contains "Limit Violation"] [--json | --count]
+
+--dir can be given once per unit; each record is then prefixed with its directory.
+--start defaults to 24 hours before --end, --end to now.
+'''
+import argparse
+import json
+from datetime import datetime, timedelta
+
+import structured_log
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Structured log query")
+    parser.add_argument("--dir", action="append", help="log directory (repeat for several units)")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="ISO date/time, local")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="ISO date/time, local")
+    parser.add_argument("--key", help="log key, e.g. service or monitor")
+    parser.add_argument("--level", choices=list(structured_log.LEVEL_ORDER.keys()), help="minimum level")
+    parser.add_argument("--contains", help="text the message must contain")
+    output_group = parser.add_mutually_exclusive_group()
+    output_group.add_argument("--json", action="store_true", help="print the records as JSON lines")
+    output_group.add_argument("--count", action="store_true", help="print the number of matches per directory")
+    args = parser.parse_args()
+
+    directories = args.dir if args.dir != None else ["log"]
+    end = args.end if args.end != None else datetime.now()
+    start = args.start if args.start != None else end - timedelta(days=1)
+    for directory in directories:
+        match_count = 0
+        prefix = f"{directory}: " if len(directories) > 1 else ""
+        for record in structured_log.query(directory, start, end, args.key, args.level, args.contains):
+            match_count += 1
+            if args.count:
+                continue
+            if args.json:
+                print(prefix + json.dumps(record, default=str))
+            else:
+                print(prefix + structured_log.format_record(record))
+        if args.count:
+            print(f"{directory}: {match_count}")
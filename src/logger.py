@@ -2,11 +2,20 @@ from enum import Enum
 from datetime import datetime
 import os
 import sys
+import gzip
+import queue
+import shutil
+import threading
+import time
+import atexit
+
+import structured_log
 
 # Fixed multi-threading bug by using os.write instead of print
 # Ref: https://stackoverflow.com/questions/75367828/runtimeerror-reentrant-call-inside-io-bufferedwriter-name-stdout
 
 class MessageLevel(Enum):
+    DEBUG = -1
     INFO = 0
     WARN = 1
     ERROR = 2
@@ -18,17 +27,57 @@ class Logger:
     _log_to_disk = False
     _log_directory = "log"
 
-    def __init__(self, log_to_disk = False) -> None:
+    def __init__(self, log_to_disk = False, background = False, queue_depth = 4096, max_file_bytes = 16*1024*1024,
+                 flush_interval_secs = 1.0, compress_rotated = True, structured = False) -> None:
+        '''
+        background moves console and file output to a writer thread fed by a bounded queue: write() never
+        blocks, and when the queue is full the message is dropped and counted in dropped_count.
+        The writer keeps the day file open, flushes at most every flush_interval_secs, starts a new file
+        at midnight or past max_file_bytes and gzips the finished files in the background.
+        structured also writes every record to log/YYYYMMDD.jsonl with a time and key index (see structured_log).
+        '''
         self._msg_count = 0
         self._log_to_disk = log_to_disk
+        self._background = background
+        self._max_file_bytes = max_file_bytes
+        self._flush_interval_secs = flush_interval_secs
+        self._compress_rotated = compress_rotated
+        self.dropped_count = 0
+        # Minimum level - per key overrides the default; records below it (and muted keys) are counted, not formatted
+        self._min_level_value = MessageLevel.INFO.value
+        self._key_min_level_values = dict()
+        self.suppressed_count = 0
+        self._suppressed_counts = dict()
         if self._log_to_disk:
             if not os.path.exists(self._log_directory):
                 os.makedirs(self._log_directory)
+        self._structured = None
+        if structured:
+            self._structured = structured_log.StructuredLogWriter(self._log_directory, flush_interval_secs)
+        self._queue = None
+        self._writer_thread = None
+        if self._structured != None and not self._background:
+            atexit.register(self.close)
+        if self._background:
+            self._queue = queue.Queue(queue_depth)
+            self._writer_thread = threading.Thread(target=self._run_writer, name="log-writer", daemon=True)
+            self._writer_thread.start()
+            atexit.register(self.close)
         pass
 
-    def write(self, key, msg, level = MessageLevel.INFO) -> None:
-        if (key in self._mute_list):
+    def write(self, key, msg, level = MessageLevel.INFO, *args, fields = None) -> None:
+        '''
+        msg is a string, a format string for args (str.format) or a callable returning the string -
+        the last two are only rendered when the record is emitted. fields (dict) only go to the structured log.
+        '''
+        if (key in self._mute_list) or level.value < self._key_min_level_values.get(key, self._min_level_value):
+            self.suppressed_count += 1
+            self._suppressed_counts[key] = self._suppressed_counts.get(key, 0) + 1
             return
+        if callable(msg):
+            msg = msg()
+        elif len(args) > 0:
+            msg = msg.format(*args)
         level_str = ""
         if (level == MessageLevel.ERROR):
             level_str = 'ERROR'
@@ -36,18 +85,29 @@ class Logger:
             level_str = 'WARN'
         elif (level == MessageLevel.INFO):
             level_str = 'INFO'
+        elif (level == MessageLevel.DEBUG):
+            level_str = 'DEBUG'
         else:
             level_str = 'UNKNOWN'
         
         # Format
         # [DateTime][key][level]{message} 
-        header = "[{0}][{1}][{2}]".format(datetime.now(),
+        timestamp = datetime.now()
+        header = "[{0}][{1}][{2}]".format(timestamp,
                                             key,
                                             level_str).ljust(50)
+        if self._background:
+            try:
+                self._queue.put_nowait((header + msg, timestamp, key, level_str, msg, fields))
+            except queue.Full:
+                self.dropped_count += 1
+            return
         #print(header + msg)
         log_msg = ("\n" + header + msg).encode('utf8')
         os.write(sys.stdout.fileno(), log_msg)
         self._write_to_log_file(header + msg + "\n")
+        if self._structured != None:
+            self._structured.write(timestamp, key, level_str, msg, fields)
     
     '''
     Write a string to the console without a header or new line
@@ -55,6 +115,37 @@ class Logger:
     def write_single_line_no_header(self, msg) -> None:
         os.write(sys.stdout.fileno(), (msg).encode('utf8'))
         
+    def is_enabled(self, key, level = MessageLevel.INFO) -> bool:
+        '''True when a record for key at level would be emitted - guard for expensive log-only work'''
+        return (key not in self._mute_list) and level.value >= self._key_min_level_values.get(key, self._min_level_value)
+    
+    def set_min_level(self, level : MessageLevel, key = None) -> None:
+        '''Minimum level for one key, or the default for every key without its own (key None)'''
+        if key == None:
+            self._min_level_value = level.value
+        else:
+            self._key_min_level_values[key] = level.value
+    
+    def apply_level_config(self, logging_config : dict) -> None:
+        '''{'min_level': 'INFO', 'key_min_levels': {key: 'WARN', ...}} - level names as in MessageLevel'''
+        self.set_min_level(MessageLevel[logging_config.get('min_level', 'INFO')])
+        for (key, level_name) in logging_config.get('key_min_levels', {}).items():
+            self.set_min_level(MessageLevel[level_name], key)
+    
+    def get_suppressed_counts(self) -> dict:
+        '''{key: records suppressed by the mute list or the minimum levels}'''
+        return dict(self._suppressed_counts)
+        
+    def close(self) -> None:
+        '''Background mode: write out what is queued and stop the writer'''
+        if self._writer_thread == None:
+            if self._structured != None:
+                self._structured.close()
+            return
+        self._queue.put(None)
+        self._writer_thread.join(5.0)
+        self._writer_thread = None
+
     ''' ---- File Logger ---- '''
     _last_log_file_date_str = None
     _log_file_date_format = '%Y%m%d.log'    
@@ -67,4 +158,96 @@ class Logger:
         log_file = open(self._log_directory + "/" + file_date_string, "a")
         log_file.write(log_msg)
         log_file.close()
-            
\ No newline at end of file
+
+    ''' ---- Background Writer ---- '''
+    _WRITER_BATCH = 256
+    def _run_writer(self):
+        log_file = None
+        log_file_path = None
+        last_flush = time.monotonic()
+        reported_dropped_count = 0
+        running = True
+        while running:
+            # Block for the first message, then take whatever else is queued
+            try:
+                messages = [self._queue.get(timeout=self._flush_interval_secs)]
+            except queue.Empty:
+                messages = []
+            while len(messages) < self._WRITER_BATCH:
+                try:
+                    messages.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in messages:
+                running = False
+                messages = [message for message in messages if message != None]
+            if self.dropped_count != reported_dropped_count:
+                dropped = self.dropped_count - reported_dropped_count
+                reported_dropped_count += dropped
+                timestamp = datetime.now()
+                header = "[{0}][{1}][{2}]".format(timestamp, "logger", "WARN").ljust(50)
+                dropped_msg = f"{dropped} messages dropped - log queue full"
+                messages.append((header + dropped_msg, timestamp, "logger", "WARN", dropped_msg, {'dropped': dropped}))
+            lines = [message[0] for message in messages]
+            flush_due = not running or time.monotonic() - last_flush >= self._flush_interval_secs
+            if flush_due:
+                last_flush = time.monotonic()
+            if len(lines) > 0:
+                try:
+                    os.write(sys.stdout.fileno(), ("\n" + "\n".join(lines)).encode('utf8'))
+                except OSError:
+                    pass
+            if self._structured != None:
+                try:
+                    for (line, timestamp, key, level_str, msg, fields) in messages:
+                        self._structured.write(timestamp, key, level_str, msg, fields)
+                    if flush_due:
+                        self._structured.flush()
+                except OSError as e:
+                    os.write(sys.stderr.fileno(), f"\nLogger: structured log write failed: {e}".encode('utf8'))
+            if self._log_to_disk:
+                try:
+                    (log_file, log_file_path) = self._rotate_log_file(log_file, log_file_path)
+                    if len(lines) > 0:
+                        log_file.write("\n".join(lines) + "\n")
+                    if flush_due:
+                        log_file.flush()
+                except OSError as e:
+                    os.write(sys.stderr.fileno(), f"\nLogger: log file write failed: {e}".encode('utf8'))
+                    log_file = None
+        if log_file != None:
+            log_file.close()
+        if self._structured != None:
+            self._structured.close()
+
+    def _rotate_log_file(self, log_file, log_file_path) -> tuple:
+        '''Persistent handle on the day file - a new file at midnight or once the size limit is reached'''
+        day_file_path = self._log_directory + "/" + datetime.now().strftime(self._log_file_date_format)
+        if log_file != None and log_file_path == day_file_path and log_file.tell() < self._max_file_bytes:
+            return (log_file, log_file_path)
+        if log_file != None:
+            log_file.close()
+            if log_file_path == day_file_path:
+                # Size limit: move the full file aside as <date>.<n>.log
+                (base, extension) = os.path.splitext(day_file_path)
+                index = 1
+                while os.path.exists(f"{base}.{index}{extension}") or os.path.exists(f"{base}.{index}{extension}.gz"):
+                    index += 1
+                os.replace(day_file_path, f"{base}.{index}{extension}")
+                self._compress_in_background(f"{base}.{index}{extension}")
+            else:
+                # Midnight: yesterday's file is finished
+                self._compress_in_background(log_file_path)
+        return (open(day_file_path, "a"), day_file_path)
+
+    def _compress_in_background(self, file_path):
+        if self._compress_rotated:
+            threading.Thread(target=self._compress_file, args=(file_path,), name="log-compress", daemon=True).start()
+
+    def _compress_file(self, file_path):
+        try:
+            with open(file_path, 'rb') as source, gzip.open(file_path + ".gz", 'wb') as destination:
+                shutil.copyfileobj(source, destination)
+            os.remove(file_path)
+        except OSError as e:
+            os.write(sys.stderr.fileno(), f"\nLogger: compressing {file_path} failed: {e}".encode('utf8'))
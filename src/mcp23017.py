@@ -1,7 +1,9 @@
-import smbus
 import time
 import datetime
 
+import i2c_bus_manager
+from hw_backend import GPIO
+
 # Datasheet
 # https://ww1.microchip.com/downloads/en/devicedoc/20001952c.pdf
 
@@ -44,30 +46,145 @@ IOCON_SEQOP	        = 0x20
 IOCON_MIRROR	    = 0x40
 IOCON_BANK_MODE	    = 0x80
 
+'''Port levels of both ports read in one transaction (port B in the upper byte)'''
+class PortSnapshot:
+    def __init__(self, port_value : int, timestamp : float):
+        self.port_value = port_value
+        self.timestamp = timestamp      # time.monotonic() of the read
+    
+    '''Level of a pin 0 - 15 in the snapshot'''
+    def read_pin(self, pin) -> int:
+        return (self.port_value >> pin) & 1
+    
+    '''Age of the snapshot in seconds'''
+    def age_secs(self) -> float:
+        return time.monotonic() - self.timestamp
+
+'''Port A input change captured by the MCP23017 interrupt logic'''
+class InputChangeEvent:
+    def __init__(self, changed_pins : int, port_a_value : int, timestamp : float):
+        self.changed_pins = changed_pins    # Bit mask of the port A pins that changed (INTFA)
+        self.port_a_value = port_a_value    # Port A value at the time of the interrupt (INTCAPA)
+        self.timestamp = timestamp          # time.monotonic() of the GPIO edge
+    
+    '''Level of a port A pin 0 - 7 at the time of the interrupt'''
+    def read_pin(self, pin) -> int:
+        return (self.port_a_value >> pin) & 1
+
 class MCP23017:
-    def __init__(self, address=0x21, bus=1):
+    def __init__(self, address=0x21, bus=1, latch_resync_secs=60):
         self.address = address
-        self.bus = smbus.SMBus(bus)
-        
+        self.bus = i2c_bus_manager.resolve_bus(bus)
+
         # Enable sequential mode - increments its address counter after each byte during the data transfer.
-        self.bus.write_byte_data(self.address, MCP23x17_IOCON, IOCON_SEQOP) 
+        self.bus.write_byte_data(self.address, MCP23x17_IOCON, IOCON_SEQOP)
         # Initialize port directions
         self.bus.write_byte_data(self.address, IODIRA, 0xFF)  # Set all pins on port A as inputs
         self.bus.write_byte_data(self.address, IODIRB, 0x00)  # Set all pins on port B as outputs
 
+        # Shadow copy of the output latches (OLATA / OLATB). Outputs are written through to
+        # the latch without reading the port back first. The shadow is checked against the
+        # chip every latch_resync_secs (None = never) and re-read after any bus error.
+        self._latch_resync_secs = latch_resync_secs
+        self._olat_a = 0
+        self._olat_b = 0
+        self._latch_valid = False
+        self._last_latch_sync = None
+        self.latch_mismatch_count = 0
+        self.resync_output_latch()
+
+        # Most recent port read (see read_port_snapshot)
+        self.last_snapshot = None
+        
+        # Interrupt-on-change (see enable_input_interrupts)
+        self._int_bcm_pin = None
+        self._input_change_callback = None
+        self.interrupt_count = 0
+
+    '''Read OLATA / OLATB from the chip into the shadow copy'''
+    def resync_output_latch(self):
+        self._latch_valid = False
+        self._olat_a = self.bus.read_byte_data(self.address, MCP23x17_OLATA)
+        self._olat_b = self.bus.read_byte_data(self.address, MCP23x17_OLATB)
+        self._latch_valid = True
+        self._last_latch_sync = time.monotonic()
+
+    '''Compare the chip output latches to the shadow copy - rewrite the shadow values on a mismatch'''
+    def verify_output_latch(self) -> bool:
+        olat_a = self.bus.read_byte_data(self.address, MCP23x17_OLATA)
+        olat_b = self.bus.read_byte_data(self.address, MCP23x17_OLATB)
+        latch_okay = (olat_a == self._olat_a) and (olat_b == self._olat_b)
+        if not latch_okay:
+            # Chip was reset or disturbed; the shadow holds the last commanded state
+            self.latch_mismatch_count += 1
+            self.bus.write_byte_data(self.address, MCP23x17_OLATA, self._olat_a, priority=i2c_bus_manager.PRIORITY_SAFETY)
+            self.bus.write_byte_data(self.address, MCP23x17_OLATB, self._olat_b, priority=i2c_bus_manager.PRIORITY_SAFETY)
+        self._last_latch_sync = time.monotonic()
+        return latch_okay
+
+    '''Return the commanded output latch value of both ports (port B in the upper byte)'''
+    def get_output_latch(self) -> int:
+        return (self._olat_b << 8) | self._olat_a
+
     '''Raw Write - pins 0 - 16'''
     def write_pin(self, pin, value):
+        self._sync_output_latch_if_due()
         if pin < 8:
-            register = GPIOA
+            register = MCP23x17_OLATA
+            current_value = self._olat_a
         else:
-            register = GPIOB
+            register = MCP23x17_OLATB
+            current_value = self._olat_b
             pin -= 8
-        current_value = self.bus.read_byte_data(self.address, register)
         if value:
             current_value |= (1 << pin)
         else:
             current_value &= ~(1 << pin)
-        self.bus.write_byte_data(self.address, register, current_value)
+        self._write_latch_register(register, current_value)
+
+    '''Raw Masked Write - update the pins set in mask (bit 0 = pin 0 ... bit 15 = pin 15) to the matching bits of values'''
+    def write_outputs(self, mask, values):
+        if mask < 0 or mask > 0xFFFF:
+            raise ValueError("Invalid pin mask")
+        self._sync_output_latch_if_due()
+        new_olat_a = (self._olat_a & ~mask | values & mask) & 0xFF
+        new_olat_b = (self._olat_b & ~(mask >> 8) | (values >> 8) & (mask >> 8)) & 0xFF
+        write_a = (mask & 0xFF) != 0
+        write_b = (mask >> 8) != 0
+        if write_a and write_b:
+            # Both latches in one transfer - with IOCON.BANK = 0 the address pointer steps from OLATA to OLATB
+            try:
+                self.bus.write_i2c_block_data(self.address, MCP23x17_OLATA, [new_olat_a, new_olat_b],
+                                              priority=i2c_bus_manager.PRIORITY_SAFETY)
+            except Exception:
+                self._latch_valid = False
+                raise
+            self._olat_a = new_olat_a
+            self._olat_b = new_olat_b
+        elif write_a:
+            self._write_latch_register(MCP23x17_OLATA, new_olat_a)
+        elif write_b:
+            self._write_latch_register(MCP23x17_OLATB, new_olat_b)
+
+    '''Re-read or verify the shadow latch if it is invalid or the resync interval has elapsed'''
+    def _sync_output_latch_if_due(self):
+        if not self._latch_valid:
+            self.resync_output_latch()
+        elif self._latch_resync_secs != None and (time.monotonic() - self._last_latch_sync) > self._latch_resync_secs:
+            self.verify_output_latch()
+
+    '''Write an OLAT register and update the shadow copy'''
+    def _write_latch_register(self, register, value):
+        try:
+            self.bus.write_byte_data(self.address, register, value, priority=i2c_bus_manager.PRIORITY_SAFETY)
+        except Exception:
+            # Latch state unknown - re-read the chip before the next write
+            self._latch_valid = False
+            raise
+        if register == MCP23x17_OLATA:
+            self._olat_a = value
+        else:
+            self._olat_b = value
 
     '''Raw Read - pins 0 - 16'''
     def read_pin(self, pin):
@@ -90,12 +207,72 @@ class MCP23017:
         if channel_index < 0 or channel_index > 15:
             raise ValueError("Invalid channel index")
         self.write_pin(channel_index, value)
+
+    '''Write several digital outputs mapped to the Kitchen Sink I/O in a single transaction - {channel_index: value}'''
+    def write_kitchensink_doutputs(self, channel_values : dict):
+        mask = 0
+        values = 0
+        for (channel_index, value) in channel_values.items():
+            if channel_index < 0 or channel_index > 15:
+                raise ValueError("Invalid channel index")
+            mask |= (1 << channel_index)
+            if value:
+                values |= (1 << channel_index)
+        self.write_outputs(mask, values)
         
+    '''Read GPIOA and GPIOB in one block read and cache the result as the last snapshot'''
+    def read_port_snapshot(self) -> PortSnapshot:
+        # With IOCON.BANK = 0 the address pointer steps from GPIOA to GPIOB in either SEQOP mode
+        data = self.bus.read_i2c_block_data(self.address, MCP23x17_GPIOA, 2)
+        self.last_snapshot = PortSnapshot((data[1] << 8) | data[0], time.monotonic())
+        return self.last_snapshot
+    
+    '''Enable interrupt-on-change for the port A pins in pin_mask. The INTA output is wired to the Pi GPIO
+    int_bcm_pin (active low) and input_change_callback(mcp, InputChangeEvent) is called from the GPIO thread.'''
+    def enable_input_interrupts(self, int_bcm_pin : int, input_change_callback, pin_mask=0xFF):
+        self._input_change_callback = input_change_callback
+        # Compare against the previous pin value (INTCON = 0), INTA active-low push-pull (IOCON.INTPOL = ODR = 0)
+        self.bus.write_byte_data(self.address, MCP23x17_GPINTENA, 0x00)
+        self.bus.write_byte_data(self.address, MCP23x17_INTCONA, 0x00)
+        self.bus.write_byte_data(self.address, MCP23x17_DEFVALA, 0x00)
+        # Clear any pending interrupt before arming the GPIO edge
+        self.bus.read_byte_data(self.address, MCP23x17_INTCAPA)
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(int_bcm_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(int_bcm_pin, GPIO.FALLING, callback=self._on_interrupt)
+        self._int_bcm_pin = int_bcm_pin
+        self.bus.write_byte_data(self.address, MCP23x17_GPINTENA, pin_mask & 0xFF)
+    
+    '''Disable interrupt-on-change and release the GPIO edge detect'''
+    def disable_input_interrupts(self):
+        self.bus.write_byte_data(self.address, MCP23x17_GPINTENA, 0x00)
+        if self._int_bcm_pin != None:
+            GPIO.remove_event_detect(self._int_bcm_pin)
+            self._int_bcm_pin = None
+        self._input_change_callback = None
+    
+    '''GPIO edge callback - read the interrupt flags and captured port value (reading INTCAPA clears INTA)'''
+    def _on_interrupt(self, channel):
+        timestamp = time.monotonic()
+        try:
+            with self.bus.transaction():
+                changed_pins = self.bus.read_byte_data(self.address, MCP23x17_INTFA)
+                captured_value = self.bus.read_byte_data(self.address, MCP23x17_INTCAPA)
+                # Changes after the capture but before the clear do not raise a new interrupt - catch them here
+                current_value = self.bus.read_byte_data(self.address, MCP23x17_GPIOA)
+        except Exception as e:
+            print(e)
+            return
+        self.interrupt_count += 1
+        if self._input_change_callback == None:
+            return
+        if changed_pins != 0:
+            self._input_change_callback(self, InputChangeEvent(changed_pins, captured_value, timestamp))
+        if current_value != captured_value:
+            self._input_change_callback(self, InputChangeEvent(current_value ^ captured_value, current_value, time.monotonic()))
+    
     def read_kitchensink_dports(self) -> int:
-        port_a = current_value = self.bus.read_byte_data(self.address, MCP23x17_GPIOA)
-        port_b = current_value = self.bus.read_byte_data(self.address, MCP23x17_GPIOB)
-        port_value = (port_b << 8) | port_a
-        return port_value
+        return self.read_port_snapshot().port_value
     
     def print_kitchensink_dports(self):
         port_value = self.read_kitchensink_dports()
@@ -127,6 +127,7 @@ class ConfigManager:
         
         # Subscribe Topics
         self.active_config['subscribe']['pump_control'] = 'remote_run_state'
+        self.active_config['subscribe']['i2c_trace_dump'] = 'i2c_trace_dump'
         
         # Publish Topics
         self.active_config['publish']['system_state'] = 'system_state'
@@ -139,6 +140,11 @@ class ConfigManager:
         self.active_config['publish']['enclosure_temperature'] = 'enclosure_temperature'
         self.active_config['publish']['enclosure_humidity'] = 'enclosure_humidity'
         
+        # I2C Transaction Trace (diagnostics) - dumped on SIGUSR1 or a message on subscribe/i2c_trace_dump
+        self.active_config['i2c_trace']['enabled'] = False
+        self.active_config['i2c_trace']['depth'] = 4096
+        self.active_config['i2c_trace']['dump_directory'] = 'trace'
+        
         # Ball Valve
         self.active_config['ball_valve']['open_pin'] = 0
         self.active_config['ball_valve']['close_pin'] = 1
@@ -158,13 +164,59 @@ class ConfigManager:
         self.active_config['motor_current']['scale'] = 4.25
         self.active_config['motor_current']['offset'] = 0
         self.active_config['motor_current']['max_motor_current_amps'] = 10.0
+        # Filter: none, moving_average, ema or median over filter_depth samples
+        # After filter_max_invalid_samples failed conversions in a row the measurement goes NaN and is reported
+        self.active_config['motor_current']['filter'] = 'moving_average'
+        self.active_config['motor_current']['filter_depth'] = 5
+        self.active_config['motor_current']['filter_max_invalid_samples'] = 3
         
         # Water Pressure
+        # A curve replaces scale/offset, e.g. {'type': 'piecewise', 'points': [[0.55, 0], [2.5, 49]]}
+        # or {'type': 'polynomial', 'coefficients': [c0, c1, c2]} - x is the channel voltage
         self.active_config['water_pressure']['adc_channel_index'] = 1
         self.active_config['water_pressure']['scale'] = 25.143
         self.active_config['water_pressure']['offset'] = -13.829
         #self.active_config['water_pressure']['scale'] = 1
         #self.active_config['water_pressure']['offset'] = 0
+        self.active_config['water_pressure']['filter'] = 'median'
+        self.active_config['water_pressure']['filter_depth'] = 5
+        self.active_config['water_pressure']['filter_max_invalid_samples'] = 3
+
+        # Enclosure Sensor (SHT31) periodic acquisition: 0.5, 1, 2, 4 or 10 per second; high, medium or low repeatability
+        self.active_config['enclosure_sensor']['measurements_per_sec'] = 1
+        self.active_config['enclosure_sensor']['repeatability'] = 'high'
+        
+        # Sensor cache - reads older than the TTL are refreshed in the background
+        # adc_ttl_secs only applies with the ADC sampler disabled; 0 reads the ADC every loop (motor current is a protection input)
+        self.active_config['sensor_cache']['enclosure_ttl_secs'] = 10
+        self.active_config['sensor_cache']['adc_ttl_secs'] = 0
+        
+        # Background ADC sampling - filters then run at rate_hz instead of the main loop rate
+        self.active_config['adc_sampler']['enabled'] = True
+        self.active_config['adc_sampler']['rate_hz'] = 50
+
+        # Logging - minimum level (DEBUG, INFO, WARN, ERROR) and per log key overrides, e.g. {'monitor': 'WARN'}
+        self.active_config['logging']['min_level'] = 'INFO'
+        self.active_config['logging']['key_min_levels'] = {}
+
+        # On-device history (SQLite) - raw samples with 1 minute / 1 hour rollups; the oldest rows are pruned to stay under budget_mb
+        self.active_config['history']['enabled'] = True
+        self.active_config['history']['path'] = 'history/pumpbox_history.db'
+        self.active_config['history']['budget_mb'] = 64
+        self.active_config['history']['batch_size'] = 500
+        self.active_config['history']['flush_interval_secs'] = 5
+        self.active_config['history']['record_interval_secs'] = 1
+
+        # Motor current waveform capture - shares the I2C bus with the ADC sampler that feeds the motor current limits,
+        # so enabling it costs protection sampling bus time; rate_hz 0 (as fast as the bus allows) starves the sampler
+        self.active_config['waveform_capture']['enabled'] = False
+        self.active_config['waveform_capture']['ring_file'] = 'capture/motor_current_ring.bin'
+        self.active_config['waveform_capture']['capacity_samples'] = 65536
+        self.active_config['waveform_capture']['pre_trigger_samples'] = 4096
+        self.active_config['waveform_capture']['post_trigger_samples'] = 4096
+        self.active_config['waveform_capture']['capture_directory'] = 'capture'
+        self.active_config['waveform_capture']['rate_hz'] = 1000
+        self.active_config['waveform_capture']['trigger_holdoff_secs'] = 10
                             
     '''
     Recursively convert all defaultdicts to dicts; useful for JSON serialization
@@ -0,0 +1,127 @@
+'''
+TTL cache in front of slow-changing sensor reads.
+
+Each measurement is registered with a read function and a time-to-live. get() always returns
+the cached value immediately; once an entry is older than its TTL a refresh is queued on the
+cache's worker thread and the caller gets the previous value marked stale until it completes.
+A read that raises or returns None keeps the previous value (and its timestamp).
+'''
+import threading
+import queue
+import time
+
+class CachedValue:
+
+    def __init__(self, key, value, timestamp, ttl_secs, refresh_pending, error_count) -> None:
+        self.key = key
+        self.value = value
+        self.timestamp = timestamp              # time.monotonic() of the last good read, None = never read
+        self.ttl_secs = ttl_secs
+        self.refresh_pending = refresh_pending
+        self.error_count = error_count
+
+    def age_secs(self) -> float:
+        if self.timestamp == None:
+            return float('inf')
+        return time.monotonic() - self.timestamp
+
+    def is_stale(self) -> bool:
+        return self.age_secs() > self.ttl_secs
+
+    def __str__(self) -> str:
+        return f"{self.value} (age {self.age_secs():.1f} secs{', stale' if self.is_stale() else ''})"
+
+class _CacheEntry:
+
+    def __init__(self, key, read_function, ttl_secs) -> None:
+        self.key = key
+        self.read_function = read_function
+        self.ttl_secs = ttl_secs
+        self.value = None
+        self.timestamp = None
+        self.refresh_pending = False
+        self.read_count = 0
+        self.error_count = 0
+
+class SensorCache:
+
+    def __init__(self, name="sensor-cache") -> None:
+        self._name = name
+        self._entries = dict()
+        self._lock = threading.Lock()
+        self._refresh_queue = queue.Queue()
+        self._thread = None
+        self.get_count = 0
+        self.refresh_count = 0
+
+    def register(self, key, read_function, ttl_secs, prime=True) -> None:
+        '''Add a measurement - prime reads it once now, on the calling thread'''
+        entry = _CacheEntry(key, read_function, ttl_secs)
+        with self._lock:
+            self._entries[key] = entry
+        if prime:
+            self._refresh(entry)
+
+    def get(self, key) -> CachedValue:
+        '''Cached value with staleness metadata - queues a background refresh when expired'''
+        with self._lock:
+            entry = self._entries[key]
+            self.get_count += 1
+            expired = entry.timestamp == None or time.monotonic() - entry.timestamp > entry.ttl_secs
+            if expired and not entry.refresh_pending:
+                entry.refresh_pending = True
+                self._refresh_queue.put(entry)
+                self._start_worker()
+            return CachedValue(key, entry.value, entry.timestamp, entry.ttl_secs, entry.refresh_pending, entry.error_count)
+
+    def get_value(self, key):
+        return self.get(key).value
+
+    def invalidate(self, key) -> None:
+        '''Force a refresh on the next get()'''
+        with self._lock:
+            self._entries[key].timestamp = None
+
+    def stop(self, timeout=1.0) -> None:
+        if self._thread == None:
+            return
+        self._refresh_queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def get_stats(self) -> dict:
+        '''{key: (reads, errors)} plus the overall get/refresh counts'''
+        with self._lock:
+            stats = {key: (entry.read_count, entry.error_count) for (key, entry) in self._entries.items()}
+        stats['gets'] = self.get_count
+        stats['refreshes'] = self.refresh_count
+        return stats
+
+    def _start_worker(self):
+        # Called with the lock held
+        if self._thread == None:
+            self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            entry = self._refresh_queue.get()
+            if entry == None:
+                return
+            self._refresh(entry)
+
+    def _refresh(self, entry : _CacheEntry):
+        value = None
+        try:
+            value = entry.read_function()
+        except Exception as e:
+            print(f"SensorCache: {entry.key} read failed: {e}")
+        with self._lock:
+            self.refresh_count += 1
+            entry.read_count += 1
+            entry.refresh_pending = False
+            if value == None:
+                entry.error_count += 1
+                return
+            entry.value = value
+            entry.timestamp = time.monotonic()
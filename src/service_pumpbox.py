@@ -1,13 +1,21 @@
 import time
+import math
 import datetime
+from array import array
 
 import logger
 import pumpbox_config
 import mqtt_client_pubsub
 import mcp23017
 import ads7828
+import adc_sampler
+import waveform_capture
+import sensor_cache
+import history_store
 import sht31
 import ball_valve
+import i2c_bus_manager
+import i2c_trace
 
 class ServiceExitError:
     def __init__(self, error = True, error_message = "") -> None:
@@ -34,6 +42,13 @@ class PumpMonitor:
     
     '''Class Constants'''
     LOG_KEY = 'monitor'
+    CACHE_KEY_ENCLOSURE = 'enclosure'
+    CACHE_KEY_ADC = 'adc'
+    HISTORY_MOTOR_CURRENT = 'motor_current'
+    HISTORY_WATER_PRESSURE = 'water_pressure'
+    HISTORY_ENCLOSURE_TEMPERATURE = 'enclosure_temperature'
+    HISTORY_ENCLOSURE_HUMIDITY = 'enclosure_humidity'
+    HISTORY_LIMIT_VIOLATION = 'limit_violation'
     
     '''Public Variables'''
     motor_current_amps = None
@@ -43,17 +58,89 @@ class PumpMonitor:
     '''Private Variables'''
     _last_mqtt_publish = None
     _last_print_time = None
+    _last_history_record = None
     _pump_start_time = None
         
-    def __init__(self, app_logger, app_config, mqtt_client, mqtt_transmit_time_sec=1, print_measurements_time_secs=10) -> None:
+    def __init__(self, app_logger, app_config, mqtt_client, mqtt_transmit_time_sec=1, print_measurements_time_secs=10, history=None) -> None:
         '''Monitors environmental conditions of the pump.'''
         self._logger = app_logger
         self._config = app_config
         self._mqtt_client = mqtt_client
+        self._history = history
+        self._history_record_interval_secs = self._config.active_config.get('history', {}).get('record_interval_secs', 1)
         self._mqtt_transmit_time_sec = mqtt_transmit_time_sec
         self._print_measurements_time_secs = print_measurements_time_secs
         self._adc = ads7828.ADS7828()
         self._env_sensor = sht31.SHT31()
+        # Enclosure sensor measures periodically on its own - the loop only fetches the newest result
+        enclosure_config = self._config.active_config.get('enclosure_sensor', {})
+        self._env_sensor.start_periodic(enclosure_config.get('measurements_per_sec', 1),
+                                        enclosure_config.get('repeatability', 'high'))
+        self.enclosure_temp_humidity = None
+        
+        '''Slow-changing measurements are read through a TTL cache, refreshed in the background'''
+        cache_config = self._config.active_config.get('sensor_cache', {})
+        self._sensor_cache = sensor_cache.SensorCache()
+        # Only new results refresh the entry - a dead sensor keeps its last timestamp and goes stale
+        self._sensor_cache.register(self.CACHE_KEY_ENCLOSURE, self._env_sensor.get_new_measurement,
+                                    cache_config.get('enclosure_ttl_secs', 10))
+        
+        '''Compile ADC channel scaling - one scan of [motor current, water pressure] per update'''
+        motor_current_config = self._config.active_config['motor_current']
+        water_pressure_config = self._config.active_config['water_pressure']
+        self._adc_channels = (motor_current_config['adc_channel_index'], water_pressure_config['adc_channel_index'])
+        self._adc_conversion = self._adc.create_voltage_conversion()
+        for measurement_config in (motor_current_config, water_pressure_config):
+            # A calibration curve (piecewise/polynomial) replaces the linear scale/offset when given
+            if 'curve' in measurement_config:
+                self._adc_conversion.set_engineering_curve(measurement_config['adc_channel_index'],
+                                                           measurement_config['curve'])
+            else:
+                self._adc_conversion.set_engineering_scale(measurement_config['adc_channel_index'],
+                                                           measurement_config['scale'], measurement_config['offset'])
+        self._adc_codes = array('H', bytes(2 * len(self._adc_channels)))
+        for measurement_config in (motor_current_config, water_pressure_config):
+            self._adc.set_channel_filter(measurement_config['adc_channel_index'],
+                                         measurement_config.get('filter', 'none'),
+                                         measurement_config.get('filter_depth', 5),
+                                         measurement_config.get('filter_max_invalid_samples', 3))
+        # Limits violating at the last test_limits() call - a new pump run starts clean
+        self._violating_limit_names = set()
+        # Measurements currently NaN (dead channel) - reported once when they go invalid and when they recover
+        self._invalid_measurements = set()
+        
+        '''Optional background ADC sampling - decouples the sample rate from the main loop'''
+        self._adc_sampler = None
+        self._adc_cache_enabled = False
+        sampler_config = self._config.active_config.get('adc_sampler', {})
+        if sampler_config.get('enabled', False):
+            self._adc_sampler = adc_sampler.ContinuousSampler(self._adc, self._adc_channels,
+                                                              sampler_config.get('rate_hz', 50),
+                                                              self._adc_conversion)
+            self._adc_snapshot = adc_sampler.SamplerSnapshot(len(self._adc_channels))
+            self._adc_sampler.start()
+        elif cache_config.get('adc_ttl_secs', 0) > 0:
+            self._sensor_cache.register(self.CACHE_KEY_ADC, self._read_adc, cache_config['adc_ttl_secs'])
+            self._adc_cache_enabled = True
+        
+        '''Optional motor current waveform capture - limit violations freeze the samples around them to disk'''
+        self._waveform_capture = None
+        capture_config = self._config.active_config.get('waveform_capture', {})
+        if capture_config.get('enabled', False):
+            motor_current_channel_index = motor_current_config['adc_channel_index']
+            self._waveform_capture = waveform_capture.WaveformCapture(self._adc, motor_current_channel_index,
+                                                                      capture_config.get('ring_file', 'capture/motor_current_ring.bin'),
+                                                                      capture_config.get('capacity_samples', 65536),
+                                                                      capture_config.get('pre_trigger_samples', 4096),
+                                                                      capture_config.get('post_trigger_samples', 4096),
+                                                                      capture_config.get('capture_directory', 'capture'),
+                                                                      self._adc_conversion.gains[motor_current_channel_index],
+                                                                      self._adc_conversion.offsets[motor_current_channel_index],
+                                                                      capture_config.get('rate_hz', 1000),
+                                                                      capture_config.get('trigger_holdoff_secs', 10),
+                                                                      on_capture=self._on_waveform_capture,
+                                                                      lut=self._adc_conversion.get_lut(motor_current_channel_index))
+            self._waveform_capture.start()
         
         '''Create Monitor Limits'''
         self._monitor_limits = list()
@@ -75,33 +162,34 @@ class PumpMonitor:
         
     def update(self):
         '''Refreshes measurements from the pump.'''
-        # Motor Current (Amps)
+        # Motor Current (Amps) and Water Pressure (PSI)
         self.motor_current_amps = None
-        motor_current_channel_index = self._config.active_config['motor_current']['adc_channel_index']
-        raw_motor_current_meas = self._adc.get_voltage_from_channel(motor_current_channel_index)
-        motor_current_scale = self._config.active_config['motor_current']['scale']
-        motor_current_offset = self._config.active_config['motor_current']['offset']
-        self.motor_current_amps = motor_current_scale * raw_motor_current_meas + motor_current_offset
-        # Water Pressure (PSI)    
         self.water_pressure_psi = None
-        water_pressure_channel_index = self._config.active_config['water_pressure']['adc_channel_index']
-        raw_water_pressure_meas = self._adc.get_voltage_from_channel(water_pressure_channel_index)
-        water_pressure_scale = self._config.active_config['water_pressure']['scale']
-        water_pressure_offset = self._config.active_config['water_pressure']['offset']
-        self.water_pressure_psi = water_pressure_scale * raw_water_pressure_meas + water_pressure_offset
+        if self._adc_sampler != None:
+            self._adc_sampler.get_snapshot(self._adc_snapshot)
+            (self.motor_current_amps, self.water_pressure_psi) = self._adc_snapshot.values
+        elif self._adc_cache_enabled:
+            (self.motor_current_amps, self.water_pressure_psi) = self._sensor_cache.get_value(self.CACHE_KEY_ADC)
+        else:
+            (self.motor_current_amps, self.water_pressure_psi) = self._read_adc()
+        self._check_valid(PumpMonitor.MEAS_TYPE_CURRENT, self.motor_current_amps)
+        self._check_valid(PumpMonitor.MEAS_TYPE_PRESSURE, self.water_pressure_psi)
         # Enclosure Temperature and Humidity
-        self.enclosure_temp_humidity = self._env_sensor.read_temp_humidity()
+        self._enclosure_cached = self._sensor_cache.get(self.CACHE_KEY_ENCLOSURE)
+        self.enclosure_temp_humidity = self._enclosure_cached.value
         # Run Time
         self.pump_run_time_secs = 0
         if self._pump_start_time != None:
              self.pump_run_time_secs = (datetime.datetime.now() - self._pump_start_time).total_seconds()
         # Print it
-        if self._last_print_time == None or (datetime.datetime.now() - self._last_print_time).total_seconds() > self._print_measurements_time_secs:
+        if self._logger.is_enabled(self.LOG_KEY) and (self._last_print_time == None or (datetime.datetime.now() - self._last_print_time).total_seconds() > self._print_measurements_time_secs):
             self._last_print_time = datetime.datetime.now()
-            self._logger.write(self.LOG_KEY, f"Motor Current: {self.motor_current_amps:.2f} A", logger.MessageLevel.INFO)
-            self._logger.write(self.LOG_KEY, f"Water Pressure: {self.water_pressure_psi:.0f} PSI", logger.MessageLevel.INFO)
-            self._logger.write(self.LOG_KEY, f"Pump Run Time: {self.pump_run_time_secs:.0f} secs", logger.MessageLevel.INFO)    
-            self._logger.write(self.LOG_KEY, f"Enclosure: {self.enclosure_temp_humidity}", logger.MessageLevel.INFO)      
+            self._logger.write(self.LOG_KEY, "Motor Current: {:.2f} A", logger.MessageLevel.INFO, self.motor_current_amps)
+            self._logger.write(self.LOG_KEY, "Water Pressure: {:.0f} PSI", logger.MessageLevel.INFO, self.water_pressure_psi)
+            self._logger.write(self.LOG_KEY, "Pump Run Time: {:.0f} secs", logger.MessageLevel.INFO, self.pump_run_time_secs)    
+            self._logger.write(self.LOG_KEY, "Enclosure: {}", logger.MessageLevel.INFO, self._enclosure_cached)      
+            if self._adc_sampler != None:
+                self._logger.write(self.LOG_KEY, "ADC Sampler: {}", logger.MessageLevel.INFO, self._adc_sampler.get_stats())
         # Ship it
         if self._last_mqtt_publish == None or (datetime.datetime.now() - self._last_mqtt_publish).total_seconds() > self._mqtt_transmit_time_sec:
             self._last_mqtt_publish = datetime.datetime.now()                
@@ -109,8 +197,17 @@ class PumpMonitor:
             self._mqtt_client.publish(self._config.active_config['publish']['motor_current'], self.motor_current_amps)
             self._mqtt_client.publish(self._config.active_config['publish']['water_pressure'], self.water_pressure_psi)
             self._mqtt_client.publish(self._config.active_config['publish']['pump_run_time_secs'], self.pump_run_time_secs)
-            self._mqtt_client.publish(self._config.active_config['publish']['enclosure_temperature'], self.enclosure_temp_humidity.temperature)
-            self._mqtt_client.publish(self._config.active_config['publish']['enclosure_humidity'], self.enclosure_temp_humidity.humidity)
+            if self.enclosure_temp_humidity != None:
+                self._mqtt_client.publish(self._config.active_config['publish']['enclosure_temperature'], self.enclosure_temp_humidity.temperature)
+                self._mqtt_client.publish(self._config.active_config['publish']['enclosure_humidity'], self.enclosure_temp_humidity.humidity)
+        # Record it
+        if self._history != None and (self._last_history_record == None or (datetime.datetime.now() - self._last_history_record).total_seconds() >= self._history_record_interval_secs):
+            self._last_history_record = datetime.datetime.now()
+            self._history.record(self.HISTORY_MOTOR_CURRENT, self.motor_current_amps)
+            self._history.record(self.HISTORY_WATER_PRESSURE, self.water_pressure_psi)
+            if self._enclosure_cached.value != None and not self._enclosure_cached.is_stale():
+                self._history.record(self.HISTORY_ENCLOSURE_TEMPERATURE, self.enclosure_temp_humidity.temperature)
+                self._history.record(self.HISTORY_ENCLOSURE_HUMIDITY, self.enclosure_temp_humidity.humidity)
             
   
     def test_limits(self) -> list:
@@ -133,8 +230,40 @@ class PumpMonitor:
             if limit.test_limit(measurement):
                 limit.error_result = f"Limit Violation: {limit.name} - {measurement:.2f} {units}"
                 violations.append(limit)
+        if self._history != None:
+            # Events only when a limit starts or stops violating - test_limits runs every loop tick
+            violating_names = set(limit.name for limit in violations)
+            for limit in violations:
+                if limit.name not in self._violating_limit_names:
+                    self._history.record_event(self.HISTORY_LIMIT_VIOLATION, limit.error_result)
+            for limit_name in sorted(self._violating_limit_names - violating_names):
+                self._history.record_event(self.HISTORY_LIMIT_VIOLATION, f"Limit Cleared: {limit_name}")
+            self._violating_limit_names = violating_names
+        if len(violations) > 0 and self._waveform_capture != None:
+            self._waveform_capture.trigger(violations[0].name)
         return violations
     
+    def _read_adc(self) -> tuple:
+        '''(motor current, water pressure) from one synchronous scan'''
+        self._adc.scan(self._adc_channels, self._adc_codes)
+        measurements = self._adc_conversion.convert_scan(self._adc_channels, self._adc_codes)
+        return tuple(self._adc.apply_filters(self._adc_channels, measurements))
+    
+    def _check_valid(self, measurement_name, value):
+        '''Report a measurement going NaN (the filter ran out of valid samples) and recovering'''
+        invalid = value == None or math.isnan(value)
+        if invalid and measurement_name not in self._invalid_measurements:
+            self._invalid_measurements.add(measurement_name)
+            error_msg = f"{measurement_name} Invalid - no valid ADC samples"
+            self._mqtt_client.publish(self._config.active_config['publish']['error_message'], error_msg)
+            self._logger.write(self.LOG_KEY, error_msg, logger.MessageLevel.ERROR, fields={'measurement': measurement_name})
+        elif not invalid and measurement_name in self._invalid_measurements:
+            self._invalid_measurements.discard(measurement_name)
+            self._logger.write(self.LOG_KEY, f"{measurement_name} valid again: {value:.2f}", logger.MessageLevel.INFO)
+    
+    def _on_waveform_capture(self, file_path, reason):
+        self._logger.write(self.LOG_KEY, f"Waveform captured ({reason}): {file_path}", logger.MessageLevel.INFO)
+    
     def update_pump_state(self, new_state):
         '''Updated from the main state machine and used to monitor the pump'''
         if new_state == PumpBoxService.PUMP_STATE_INIT:
@@ -143,6 +272,7 @@ class PumpMonitor:
             self._pump_start_time = None
         elif new_state == PumpBoxService.PUMP_STATE_STARTING:
             self._pump_start_time = datetime.datetime.now()
+            self._violating_limit_names = set()
         elif new_state == PumpBoxService.PUMP_STATE_OPENING_VALVE:
             pass
         elif new_state == PumpBoxService.PUMP_STATE_PUMPING:
@@ -160,6 +290,8 @@ class PumpBoxService:
     
     '''Class Constants'''
     LOG_KEY = 'service'
+    HISTORY_PUMP_STATE = 'pump_state'
+    HISTORY_VALVE_STATE = 'valve_state'
     
     # Pump State
     PUMP_STATE_INIT             = 0
@@ -187,6 +319,8 @@ class PumpBoxService:
     _mcp_portexpander = None
     _ignore_first_mqtt_remote_control = True
     _verbose_valve_state_message = False
+    _i2c_bus = None
+    _i2c_trace = None
     
     def __init__(self, app_logger, app_config) -> None:
         '''Initialize the PumpBoxService object - fast init, _can_ fail'''
@@ -200,6 +334,14 @@ class PumpBoxService:
         # Create Port Expander
         self._mcp_portexpander = mcp23017.MCP23017()
         
+        # I2C Transaction Trace - opt-in, dumped on SIGUSR1 or an MQTT message on the trace dump topic
+        self._i2c_bus = i2c_bus_manager.get_shared_bus()
+        self._i2c_trace = i2c_trace.setup_service_trace(self._i2c_bus, self._config.active_config, self._mqtt_client,
+                                                        self._logger, self.LOG_KEY)
+        
+        # On-device history - measurements and events survive a lost broker connection
+        self._init_history()
+        
         # Ball Valve 
         self._ball_valve = ball_valve.BallValve("Pump Valve",
                                                 self._mcp_portexpander, 
@@ -212,7 +354,7 @@ class PumpBoxService:
                                                 valve_position_change_callback=self._ball_valve_position_change)
         
         # Pump Monitor
-        self._pump_monitor = PumpMonitor(app_logger, app_config, self._mqtt_client)
+        self._pump_monitor = PumpMonitor(app_logger, app_config, self._mqtt_client, history=self._history)
                
     ''' Run Main Loop '''
     def run(self) -> ServiceExitError:
@@ -220,9 +362,11 @@ class PumpBoxService:
         # Main loop
         while self._run_main_loop:
             self._last_loop_start = datetime.datetime.now()
+            self._i2c_bus.trace_tick()
             self._pet_mqtt_client_watchdog()
-            # Process the ball valve state machine
-            self._ball_valve.process()
+            # Process the ball valve state machine - one port read per tick
+            port_snapshot = self._mcp_portexpander.read_port_snapshot()
+            self._ball_valve.process(port_snapshot)
             # Update Monitor
             self._pump_monitor.update()
             # Main State Machine
@@ -250,7 +394,7 @@ class PumpBoxService:
             # PUMP_STATE_OPENING_VALVE - Awaiting valve open
             elif self._pump_state == self.PUMP_STATE_OPENING_VALVE:
                 # If valve is open, start motor and move to next state
-                if self._ball_valve.is_open():
+                if self._ball_valve.is_open(port_snapshot):
                     self._change_state(self.PUMP_STATE_PUMPING)
                     self._energize_motor_contactor(True)
                     self._last_pump_start = datetime.datetime.now()
@@ -273,14 +417,15 @@ class PumpBoxService:
                         self._ball_valve.request_close()
                         error_topic = self._config.active_config['publish']['error_message']
                         self._mqtt_client.publish(error_topic, violations.error_msg)
-                        self._logger.write(self.LOG_KEY, f"Limit Violation: [{violations.error_msg}]", logger.MessageLevel.ERROR)
+                        self._logger.write(self.LOG_KEY, f"Limit Violation: [{violations.error_msg}]", logger.MessageLevel.ERROR,
+                                           fields={'limit': violations.name, 'result': violations.error_result})
             
                 pass
             
             # PUMP_STATE_STOPPING - Close the ball valve
             elif self._pump_state == self.PUMP_STATE_STOPPING:
                 # If valve is open, start motor and move to next state
-                if self._ball_valve.is_closed():
+                if self._ball_valve.is_closed(port_snapshot):
                     self._change_state(self.PUMP_STATE_STOPPED)
                 elif self._ball_valve.is_timedout():
                     self._change_state(self.PUMP_STATE_INIT)
@@ -300,14 +445,17 @@ class PumpBoxService:
     def _change_state(self, new_state):
         '''Change the state of the pump'''
         self._pump_state = new_state
-        self._logger.write(self.LOG_KEY, f"New state: {self._system_state_to_str(self._pump_state)}", logger.MessageLevel.INFO)
+        self._logger.write(self.LOG_KEY, f"New state: {self._system_state_to_str(self._pump_state)}", logger.MessageLevel.INFO,
+                           fields={'state': self._system_state_to_str(self._pump_state)})
+        if self._history != None:
+            self._history.record_event(self.HISTORY_PUMP_STATE, self._system_state_to_str(self._pump_state))
         self._pump_monitor.update_pump_state(self._pump_state)
         sys_state_topic = self._config.active_config['publish']['system_state']
         self._mqtt_client.publish(sys_state_topic, self._system_state_to_str(self._pump_state))
         
     def _on_new_message(self, topic, message) -> None:
         '''Received a new message from the MQTT Broker'''
-        self._logger.write(self.LOG_KEY, f"New message: {topic}->[{message}]", logger.MessageLevel.INFO)
+        self._logger.write(self.LOG_KEY, "New message: {}->[{}]", logger.MessageLevel.INFO, topic, message)
         # Parse the message
         if topic == self._format_topic(self._config.active_config['subscribe']['pump_control']):
             if self._ignore_first_mqtt_remote_control:
@@ -318,6 +466,8 @@ class PumpBoxService:
                     self._pump_request = self.PUMP_REQUEST_ON
                 elif message == b'OFF':
                     self._pump_request = self.PUMP_REQUEST_OFF
+        elif self._i2c_trace != None and topic == self._i2c_trace.dump_topic:
+            self._i2c_trace.dump()
     
     def _init_and_start_mqtt_client(self):
         self._logger.write(self.LOG_KEY, "Initializing MQTT Client...", logger.MessageLevel.INFO)
@@ -329,6 +479,13 @@ class PumpBoxService:
         self._mqtt_client.subscribe(self._config.active_config['subscribe']['pump_control'])  
         self._logger.write(self.LOG_KEY, "MQTT Client initialized.", logger.MessageLevel.INFO)
     
+    def _init_history(self) -> None:
+        '''Time-series history in SQLite - written in batches by a background thread, committed at exit'''
+        self._history = history_store.HistoryStore.from_config(self._config.active_config.get('history', {}),
+                                                               'history/pumpbox_history.db')
+        if self._history != None:
+            self._logger.write(self.LOG_KEY, f"History enabled - {self._history.path}", logger.MessageLevel.INFO)
+    
     _last_mqtt_client_pet = None
     def _pet_mqtt_client_watchdog(self):
         if self._last_mqtt_client_pet == None or (datetime.datetime.now() - self._last_mqtt_client_pet).total_seconds() > 10:
@@ -341,7 +498,7 @@ class PumpBoxService:
     def _on_publish_message(self, topic, message) -> None:
         '''Published a new message to the MQTT Broker'''
         if self._verbose_valve_state_message:
-            self._logger.write(self.LOG_KEY, f"Publishing message: {topic}->[{message}]", logger.MessageLevel.INFO)
+            self._logger.write(self.LOG_KEY, "Publishing message: {}->[{}]", logger.MessageLevel.INFO, topic, message)
 
     def _format_topic(self, topic) -> str:
         '''Format the topic with the base topic'''
@@ -353,11 +510,13 @@ class PumpBoxService:
         if self._verbose_valve_state_message:
             ball_valve_state_str = f"Ball Valve State Changed [{new_state}]: {context}"
         self._logger.write(self.LOG_KEY, ball_valve_state_str, logger.MessageLevel.INFO)
+        if self._history != None:
+            self._history.record_event(self.HISTORY_VALVE_STATE, new_state)
         valve_state_topic = self._config.active_config['publish']['valve_state']
         self._mqtt_client.publish(valve_state_topic, ball_valve_state_str)
     
     def _ball_valve_position_change(self, valve_obj, valve_position_str) -> None:
-        self._logger.write(self.LOG_KEY, f"Ball Valve Position= {valve_position_str}", logger.MessageLevel.INFO)
+        self._logger.write(self.LOG_KEY, "Ball Valve Position= {}", logger.MessageLevel.INFO, valve_position_str)
         valve_position_topic = self._config.active_config['publish']['valve_position']
         self._mqtt_client.publish(valve_position_topic, valve_position_str)
                     
@@ -385,12 +544,8 @@ class PumpBoxService:
         direction_pin = self._config.active_config['motor_contactor']['direction_pin'] 
         enable_pin = self._config.active_config['motor_contactor']['enable_pin'] 
         '''Set the motor contactor state'''
-        if energize_contactor:
-            self._mcp_portexpander.write_kitchensink_doutput(direction_pin, True)
-            self._mcp_portexpander.write_kitchensink_doutput(enable_pin, True)
-        else:
-            self._mcp_portexpander.write_kitchensink_doutput(direction_pin, False)
-            self._mcp_portexpander.write_kitchensink_doutput(enable_pin, False)
+        self._mcp_portexpander.write_kitchensink_doutputs({direction_pin: energize_contactor,
+                                                          enable_pin: energize_contactor})
             
 '''Measure and print 8 channels'''
 if __name__ == '__main__':
@@ -400,12 +555,13 @@ if __name__ == '__main__':
     config_file = "default_pumpbox_config.json"
     
     # Initialize Main object
-    app_logger = logger.Logger(log_to_disk=True)
+    app_logger = logger.Logger(log_to_disk=True, background=True, structured=True)
     app_logger.write(log_key, "Initializing PumpBox Service...", logger.MessageLevel.INFO)
     
     # Load or create default config
     app_logger.write(log_key, "Loading config...", logger.MessageLevel.INFO)
     app_config = pumpbox_config.ConfigManager(config_file, app_logger)
+    app_logger.apply_level_config(app_config.active_config.get('logging', {}))
     
     # Create service object and run it
     app_logger.write(log_key, "Running Pump Box Service...", logger.MessageLevel.INFO)
@@ -9,11 +9,16 @@ import mcp23017
 
 import ball_valve
 import din_counter
+import flow_meter
 import simple_data_store
+import history_store
+import i2c_bus_manager
+import i2c_trace
 
 import signal
 import sys
-from RPi import GPIO
+import threading
+from hw_backend import GPIO
 
 class ServiceExitError:
     def __init__(self, error = True, error_message = "") -> None:
@@ -47,11 +52,13 @@ class ValveBoxService:
     _run_main_loop = True
     _last_loop_start = None
     _last_pump_start = None
-    _mcp_portexpander = None
+    _mcp_portexpanders = None
     _ignore_first_mqtt_remote_control = True
     _verbose_valve_state_message = True
     _ball_valves = list()
     _command_queue = None
+    _i2c_bus = None
+    _i2c_trace = None
     
     def __init__(self, app_logger, app_config) -> None:
         '''Initialize the ValveBoxService object - fast init, _can_ fail'''
@@ -60,11 +67,24 @@ class ValveBoxService:
         self._config = app_config
         self._command_queue = queue.Queue()
         
-        # Create a simple data store for the counter
-        self.data_store = simple_data_store.DiskDataStore("valve_box_data_store.json")
+        # Create a simple data store for the counter - write-behind, flushed on an interval, a count delta and at exit
+        data_store_config = self._config.active_config.get('data_store', {})
+        self.data_store = simple_data_store.DiskDataStore("valve_box_data_store.json",
+                                                          write_behind=data_store_config.get('write_behind', True),
+                                                          flush_interval_secs=data_store_config.get('flush_interval_secs', 30),
+                                                          delta_threshold=data_store_config.get('flush_delta_threshold', 100),
+                                                          journal=data_store_config.get('journal', True),
+                                                          compact_threshold_bytes=data_store_config.get('journal_compact_bytes', 65536))
         
-        # Create Port Expander
-        self._mcp_portexpander = mcp23017.MCP23017()
+        # Create Port Expanders - limit switch changes wake the main loop when an INTA line is wired
+        self._mcp_portexpanders = list()
+        self._input_change_event = threading.Event()
+        for (address, interrupt_bcm_pin) in zip(self._config.get_io_expander_addresses(),
+                                                 self._config.get_io_expander_interrupt_pins()):
+            mcp_portexpander = mcp23017.MCP23017(address)
+            if interrupt_bcm_pin != None:
+                mcp_portexpander.enable_input_interrupts(interrupt_bcm_pin, self._on_input_change)
+            self._mcp_portexpanders.append(mcp_portexpander)
                 
         # Create and Start Mqtt Client
         self._logger.write(self.LOG_KEY, "Initializing MQTT Client...", logger.MessageLevel.INFO)
@@ -74,26 +94,42 @@ class ValveBoxService:
                                                 self._on_publish_message)
         self._mqtt_client.start()
         
+        # I2C Transaction Trace - opt-in, dumped on SIGUSR1 or an MQTT message on the trace dump topic
+        self._i2c_bus = i2c_bus_manager.get_shared_bus()
+        self._i2c_trace = i2c_trace.setup_service_trace(self._i2c_bus, self._config.active_config, self._mqtt_client,
+                                                        self._logger, self.LOG_KEY)
+        
+        # On-device history - flow and valve events survive a lost broker connection
+        self._init_history()
+        
         # Subscribe the Valve Box Control Topics
-        # Create Ball Valve Objects
-        for index in range(valvebox_config.ConfigManager.NUMBER_OF_VALVES):
+        # Create Ball Valve Objects - grouped by expander so each chip is read once per tick
+        self._ball_valves = list()
+        self._ball_valves_by_expander = [list() for mcp_portexpander in self._mcp_portexpanders]
+        for index in range(self._config.get_number_of_valves()):
             valve_topic = f'valve_{index + 1}'
             # MQTT Subscription topics
             self._mqtt_client.subscribe(self._config.active_config[valve_topic]['subscribe']['valve_control'])
             # Create list of ball valves
-            self._ball_valves.append(ball_valve.BallValve(  valve_topic,  
-                                                            self._mcp_portexpander,
-                                                            self._config.active_config[valve_topic]['open_pin'],
-                                                            self._config.active_config[valve_topic]['close_pin'],
-                                                            self._config.active_config[valve_topic]['direction_pin'],
-                                                            self._config.active_config[valve_topic]['enable_pin'],
-                                                            self._config.active_config[valve_topic]['transition_time_secs'],
-                                                            state_change_callback=self._ball_valve_state_change,
-                                                            valve_position_change_callback=self._ball_valve_position_change))
+            (expander_index, open_pin, close_pin, direction_pin, enable_pin) = self._config.get_valve_pin_assignment(valve_topic)
+            valve = ball_valve.BallValve(valve_topic,  
+                                         self._mcp_portexpanders[expander_index],
+                                         open_pin,
+                                         close_pin,
+                                         direction_pin,
+                                         enable_pin,
+                                         self._config.active_config[valve_topic]['transition_time_secs'],
+                                         state_change_callback=self._ball_valve_state_change,
+                                         valve_position_change_callback=self._ball_valve_position_change)
+            self._ball_valves.append(valve)
+            self._ball_valves_by_expander[expander_index].append(valve)
             
         # Flow Counter
-        self.counter = din_counter.DinCounter()
+        self.counter = din_counter.DinCounter(debounce_ms=self._config.get_flow_meter_config().get('debounce_ms', 5))
         self._last_counter_value = None
+        
+        # Flow Engine - rates and volume from both counter channels, volume per valve
+        self._init_flow_engine()
                         
     ''' Run Main Loop '''
     def run(self) -> ServiceExitError:
@@ -101,18 +137,30 @@ class ValveBoxService:
         # Main loop
         while self._run_main_loop:
             self._last_loop_start = datetime.datetime.now()
+            self._input_change_event.clear()
+            self._i2c_bus.trace_tick()
             
             # Update Flow Counter and MQTT Topic
             self._update_flow_counter()
         
-            # Process the ball valve state machines
-            for ball_valve in self._ball_valves:
-                ball_valve.process()
+            # Process the ball valve state machines - one port read per expander shared by its valves
+            for (mcp_portexpander, expander_valves) in zip(self._mcp_portexpanders, self._ball_valves_by_expander):
+                if len(expander_valves) == 0:
+                    continue
+                port_snapshot = mcp_portexpander.read_port_snapshot()
+                for ball_valve in expander_valves:
+                    ball_valve.process(port_snapshot)
+                    # Flow is attributed to a valve from the moment it leaves the closed position
+                    self._flow_engine.set_valve_open(ball_valve.valve_name,
+                                                     ball_valve.peek_valve_position(port_snapshot) != ball_valve.VALVE_POSITION_CLOSE)
+            
+            # Publish flow rates and volumes
+            self._update_flow_engine()
             
             # Check for new requests on the subscribed channels
             while self._command_queue.qsize() > 0:
                 command = self._command_queue.get()
-                self._logger.write(self.LOG_KEY, f"New valve command: {command}", logger.MessageLevel.INFO)
+                self._logger.write(self.LOG_KEY, "New valve command: {}", logger.MessageLevel.INFO, command)
                 # Update the ball valve
                 for ball_valve in self._ball_valves:
                     if (ball_valve.valve_name == command.name):
@@ -130,9 +178,13 @@ class ValveBoxService:
                             else:
                                 self._logger.write(self.LOG_KEY, f"Unknown valve command received: {command}", logger.MessageLevel.ERROR)    
                 
-            # Sleep to prevent CPU thrashing    
-            time.sleep(0.2)
+            # Sleep to prevent CPU thrashing - an input change interrupt ends the sleep early
+            self._input_change_event.wait(0.2)
             
+    def _on_input_change(self, mcp, input_change_event) -> None:
+        '''Limit switch change reported by the port expander (GPIO thread) - wake the main loop'''
+        self._input_change_event.set()
+    
     def _update_flow_counter(self) -> None:
         '''Syncs flow counter output and what was written to disk last'''
         FLOW_COUNTER_TAG = "FLOW_COUNTER"
@@ -161,9 +213,65 @@ class ValveBoxService:
             self._mqtt_client.publish(self._config.active_config['publish']['flow_counter'], 
                                         self._last_counter_value)  
                 
+    def _init_flow_engine(self) -> None:
+        self._flow_engine = flow_meter.FlowEngine()
+        flow_config = self._config.get_flow_meter_config()
+        self._flow_publish_interval_secs = flow_config.get('publish_interval_secs', 5)
+        self._last_flow_publish = None
+        self._persisted_flow_values = dict()
+        self._flow_publish_topics = dict()
+        # Channel A (GP16) and channel B (GP26)
+        edge_callback_setters = (self.counter.set_edge_callback_A, self.counter.set_edge_callback_B)
+        for (channel_config, set_edge_callback) in zip(flow_config.get('channels', []), edge_callback_setters):
+            meter = flow_meter.FlowMeter(channel_config['name'], channel_config['k_factor'],
+                                         channel_config.get('attribute_to_valves', False))
+            (pulse_total, timestamp) = self.data_store.read(self._flow_pulses_tag(meter.name))
+            if pulse_total != None:
+                meter.set_pulse_total(pulse_total)
+            self._flow_engine.add_meter(meter)
+            self._flow_publish_topics[meter.name] = channel_config.get('publish', {})
+            set_edge_callback(meter.on_pulse)
+        for valve in self._ball_valves:
+            (volume_total, timestamp) = self.data_store.read(self._valve_volume_tag(valve.valve_name))
+            self._flow_engine.add_valve(valve.valve_name, volume_total if volume_total != None else 0.0)
+    
+    def _update_flow_engine(self) -> None:
+        '''Publish flow rates and volumes every publish interval; persist totals that changed'''
+        if self._last_flow_publish != None and (datetime.datetime.now() - self._last_flow_publish).total_seconds() < self._flow_publish_interval_secs:
+            return
+        self._last_flow_publish = datetime.datetime.now()
+        for meter in self._flow_engine.meters:
+            publish_topics = self._flow_publish_topics[meter.name]
+            self._mqtt_client.publish(publish_topics.get('rate', f'{meter.name}/rate'), round(meter.get_instantaneous_rate(), 3))
+            self._mqtt_client.publish(publish_topics.get('rate_1m', f'{meter.name}/rate_1m'), round(meter.get_rate_1m(), 3))
+            self._mqtt_client.publish(publish_topics.get('rate_15m', f'{meter.name}/rate_15m'), round(meter.get_rate_15m(), 3))
+            self._mqtt_client.publish(publish_topics.get('volume', f'{meter.name}/volume'), round(meter.get_volume(), 3))
+            self._persist_flow_value(self._flow_pulses_tag(meter.name), meter.pulse_total)
+            if self._history != None:
+                self._history.record(f"{meter.name}/rate", meter.get_instantaneous_rate())
+                self._history.record(f"{meter.name}/volume", meter.get_volume())
+        for valve_name in self._flow_engine.get_valve_names():
+            volume_total = self._flow_engine.get_valve_volume(valve_name)
+            volume_topic = self._config.active_config[valve_name]['publish'].get('volume', f'{valve_name}/volume')
+            self._mqtt_client.publish(volume_topic, round(volume_total, 3))
+            self._persist_flow_value(self._valve_volume_tag(valve_name), volume_total)
+            if self._history != None:
+                self._history.record(f"{valve_name}/volume", volume_total)
+    
+    def _persist_flow_value(self, tag, value) -> None:
+        if self._persisted_flow_values.get(tag) != value:
+            self.data_store.write(tag, value)
+            self._persisted_flow_values[tag] = value
+    
+    def _flow_pulses_tag(self, meter_name) -> str:
+        return f"FLOW_PULSES_{meter_name}"
+    
+    def _valve_volume_tag(self, valve_name) -> str:
+        return f"VALVE_VOLUME_{valve_name}"
+                
     def _on_new_message(self, topic, message) -> None:
         '''Received a new message from the MQTT Broker'''
-        self._logger.write(self.LOG_KEY, f"New message: {topic}->[{message}]", logger.MessageLevel.INFO)
+        self._logger.write(self.LOG_KEY, "New message: {}->[{}]", logger.MessageLevel.INFO, topic, message)
         # Parse the message
         # First Scan - Valve Control (Hacked for now)
         for (valve_key, valve_conf) in self._config.get_valve_configs().items():
@@ -173,8 +281,18 @@ class ValveBoxService:
                     self._command_queue.put(ValveQueueCommand(valve_key, ValveQueueCommand.OPEN))
                 elif message == b'CLOSE':
                     self._command_queue.put(ValveQueueCommand(valve_key, ValveQueueCommand.CLOSE))               
+        # Diagnostics - I2C trace dump request
+        if self._i2c_trace != None and topic == self._i2c_trace.dump_topic:
+            self._i2c_trace.dump()
 
             
+    def _init_history(self) -> None:
+        '''Time-series history in SQLite - written in batches by a background thread, committed at exit'''
+        self._history = history_store.HistoryStore.from_config(self._config.active_config.get('history', {}),
+                                                               'history/valvebox_history.db')
+        if self._history != None:
+            self._logger.write(self.LOG_KEY, f"History enabled - {self._history.path}", logger.MessageLevel.INFO)
+    
     def _on_publish_message(self, topic, message) -> None:
         '''Published a new message to the MQTT Broker'''
         #self._logger.write(self.LOG_KEY, f"Publishing message: {topic}->[{message}]", logger.MessageLevel.INFO)
@@ -187,15 +305,19 @@ class ValveBoxService:
     def _ball_valve_state_change(self, valve_obj, valve_state, new_state, context) -> None:
         '''Callback for when the ball valve state changes'''
         # TODO: Figure out the ball valve name 
-        ball_valve_state_str = new_state
         if self._verbose_valve_state_message:
-            ball_valve_state_str = f"{valve_obj.valve_name} State: [{new_state}]: {context}"
-        self._logger.write(self.LOG_KEY, ball_valve_state_str, logger.MessageLevel.INFO)
+            self._logger.write(self.LOG_KEY, "{} State: [{}]: {}", logger.MessageLevel.INFO, valve_obj.valve_name, new_state, context)
+        else:
+            self._logger.write(self.LOG_KEY, new_state, logger.MessageLevel.INFO)
+        if self._history != None:
+            self._history.record_event(f"{valve_obj.valve_name}/state", new_state)
         valve_state_topic = self._config.active_config[valve_obj.valve_name]['publish']['state']
         self._mqtt_client.publish(valve_state_topic, context)
     
     def _ball_valve_position_change(self, valve_obj, valve_position_str) -> None:
-        self._logger.write(self.LOG_KEY, f"{valve_obj.valve_name} Position: {valve_position_str}", logger.MessageLevel.INFO)
+        self._logger.write(self.LOG_KEY, "{} Position: {}", logger.MessageLevel.INFO, valve_obj.valve_name, valve_position_str)
+        if self._history != None:
+            self._history.record_event(f"{valve_obj.valve_name}/position", valve_position_str)
         valve_position_topic = self._config.active_config[valve_obj.valve_name]['publish']['position']
         self._mqtt_client.publish(valve_position_topic, valve_position_str)
 
@@ -213,15 +335,18 @@ if __name__ == '__main__':
     log_key = "main"
     config_file = "default_valvebox_config.json"
     
+    # SIGINT and SIGTERM exit through sys.exit so the data store flushes pending writes at exit
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
     
     # Initialize Main object
-    app_logger = logger.Logger()
+    app_logger = logger.Logger(background=True)
     app_logger.write(log_key, "Initializing ValveBox Service...", logger.MessageLevel.INFO)
     
     # Load or create default config
     app_logger.write(log_key, "Loading config...", logger.MessageLevel.INFO)
     app_config = valvebox_config.ConfigManager(config_file, app_logger)
+    app_logger.apply_level_config(app_config.active_config.get('logging', {}))
     
     # Create service object and run it
     app_logger.write(log_key, "Running ValveBox Service...", logger.MessageLevel.INFO)
@@ -1,8 +1,3 @@
-import busio
-from busio import I2C
-from adafruit_bus_device import i2c_device
-from board import SCL, SDA
-
 import time
 import datetime
 from random import random
@@ -10,6 +5,8 @@ import os
 
 import json
 
+import i2c_bus_manager
+
 class SingleTempHumidityMeasurement:
         
     timestamp_isostr = None 
@@ -33,20 +30,128 @@ class SingleTempHumidityMeasurement:
         return json.dumps(json_dict)
     
 class SHT31():
-    def __init__(self, i2c_addr : int = 0x44) -> None:
-        i2c = busio.I2C(SCL, SDA)
-        self.i2c_device = i2c_device.I2CDevice(i2c, i2c_addr)
+    
+    # Commands
+    CMD_SINGLE_SHOT_STRETCH = 0x2C06        # Single shot, clock stretching, high repeatability
+    CMD_SINGLE_SHOT = 0x2400                # Single shot, no clock stretching, high repeatability
+    CMD_FETCH = 0xE000                      # Fetch the last periodic result
+    CMD_BREAK = 0x3093                      # Stop periodic acquisition
+    # Periodic acquisition commands by (measurements per second, repeatability)
+    PERIODIC_COMMANDS = {(0.5, 'high'): 0x2032, (0.5, 'medium'): 0x2024, (0.5, 'low'): 0x202F,
+                         (1, 'high'): 0x2130, (1, 'medium'): 0x2126, (1, 'low'): 0x212D,
+                         (2, 'high'): 0x2236, (2, 'medium'): 0x2220, (2, 'low'): 0x222B,
+                         (4, 'high'): 0x2334, (4, 'medium'): 0x2322, (4, 'low'): 0x2329,
+                         (10, 'high'): 0x2737, (10, 'medium'): 0x2721, (10, 'low'): 0x272A}
+    MEASUREMENT_SECS = 0.0155               # Max conversion time, high repeatability
+    # Periods without a new result before periodic mode is restarted (e.g. after a sensor power cycle)
+    PERIODIC_RESTART_PERIODS = 5
+    
+    def __init__(self, i2c_addr : int = 0x44, i2c_bus=1) -> None:
+        # Shares the bus manager with the other Kitchen Sink devices
+        self.bus = i2c_bus_manager.resolve_bus(i2c_bus)
+        self._i2c_addr = i2c_addr
+        self.last_measurement = None
+        self.crc_error_count = 0
+        self.not_ready_count = 0
+        self._periodic_command = None
+        self._periodic_running = False
+        self._periodic_period_secs = None
+        self._next_fetch_time = None
+        self._last_result_time = None
+        self._result_count = 0
+        self._reported_result_count = 0
         
     def read_temp_humidity(self) -> SingleTempHumidityMeasurement:
-        wr_data = bytearray(2)
-        wr_data[0] = 0x2C
-        wr_data[1] = 0x06
-        self.i2c_device.write(wr_data)
-        # SHT31 address, 0x44(68)
-        # Read data back from 0x00(00), 6 bytes
+        '''Blocking single shot measurement (clock stretching) - None on a CRC error'''
+        with self.bus.transaction(i2c_bus_manager.PRIORITY_TELEMETRY):
+            self._write_command(self.CMD_SINGLE_SHOT_STRETCH)
+            data = self._read_frame()
+        return self._decode(data)
+    
+    def trigger_measurement(self) -> None:
+        '''Start a single shot measurement without clock stretching - fetch it MEASUREMENT_SECS later'''
+        self._write_command(self.CMD_SINGLE_SHOT)
+        self._next_fetch_time = time.monotonic() + self.MEASUREMENT_SECS
+    
+    def fetch_measurement(self) -> SingleTempHumidityMeasurement:
+        '''Result of trigger_measurement() or the newest periodic result - None if not ready or on a CRC error'''
+        try:
+            with self.bus.transaction(i2c_bus_manager.PRIORITY_TELEMETRY):
+                if self._periodic_running:
+                    self._write_command(self.CMD_FETCH)
+                data = self._read_frame()
+        except OSError:
+            # The sensor NACKs the read until a result is ready
+            self.not_ready_count += 1
+            return None
+        measurement = self._decode(data)
+        if measurement != None:
+            self.last_measurement = measurement
+            self._last_result_time = time.monotonic()
+            self._result_count += 1
+        return measurement
+    
+    def start_periodic(self, measurements_per_sec=1, repeatability='high') -> None:
+        '''Measure continuously in the sensor - see PERIODIC_COMMANDS for the supported rates'''
+        key = (measurements_per_sec, repeatability)
+        if key not in self.PERIODIC_COMMANDS:
+            raise Exception(f"start_periodic: unsupported rate/repeatability: {key}")
+        self._periodic_command = self.PERIODIC_COMMANDS[key]
+        self._periodic_period_secs = 1.0 / measurements_per_sec
+        self._send_periodic_command()
+    
+    def stop_periodic(self) -> None:
+        self._periodic_command = None
+        self._periodic_running = False
+        self._write_command(self.CMD_BREAK)
+    
+    def get_latest_measurement(self) -> SingleTempHumidityMeasurement:
+        '''Newest good periodic measurement (None before the first) - only touches the bus once a new result is due'''
+        if self._periodic_command == None:
+            raise Exception("get_latest_measurement: periodic mode not started")
+        now = time.monotonic()
+        if not self._periodic_running:
+            self._send_periodic_command()
+        elif now >= self._next_fetch_time:
+            if self.fetch_measurement() != None:
+                self._next_fetch_time = now + self._periodic_period_secs
+            elif now - self._last_result_time > self.PERIODIC_RESTART_PERIODS * self._periodic_period_secs:
+                self._send_periodic_command()
+        return self.last_measurement
+    
+    def get_new_measurement(self) -> SingleTempHumidityMeasurement:
+        '''get_latest_measurement(), but None unless a result arrived since the last call - a dead sensor reads as a failure'''
+        self.get_latest_measurement()
+        if self._result_count == self._reported_result_count:
+            return None
+        self._reported_result_count = self._result_count
+        return self.last_measurement
+    
+    def _send_periodic_command(self):
+        try:
+            self._write_command(self._periodic_command)
+        except OSError as e:
+            print(f"SHT31 start periodic failed: {e}")
+            self._periodic_running = False
+            return
+        self._periodic_running = True
+        # First result is ready one conversion time after the start
+        now = time.monotonic()
+        self._next_fetch_time = now + self.MEASUREMENT_SECS
+        self._last_result_time = now
+    
+    def _write_command(self, command):
+        self.bus.write_i2c_block_data(self._i2c_addr, command >> 8, [command & 0xFF], priority=i2c_bus_manager.PRIORITY_TELEMETRY)
+    
+    def _read_frame(self) -> list:
         # Temp MSB, Temp LSB, Temp CRC, Humididty MSB, Humidity LSB, Humidity CRC
-        data = bytearray(6)
-        self.i2c_device.readinto(data)
+        # A plain read - a register byte written first would be an incomplete command to the sensor
+        return self.bus.read_bytes(self._i2c_addr, 6, priority=i2c_bus_manager.PRIORITY_TELEMETRY)
+    
+    def _decode(self, data) -> SingleTempHumidityMeasurement:
+        if crc8(data[0:2]) != data[2] or crc8(data[3:5]) != data[5]:
+            self.crc_error_count += 1
+            return None
         # Convert the data
         temp = data[0] * 256 + data[1]
         cTemp = -45 + (175 * temp / 65535.0)
@@ -54,6 +159,15 @@ class SHT31():
         humidity = 100 * (data[3] * 256 + data[4]) / 65535.0
         return SingleTempHumidityMeasurement(fTemp, humidity)
     # End of SHT31 Class
+
+def crc8(data) -> int:
+    '''SHT3x CRC-8: polynomial 0x31, init 0xFF'''
+    crc = 0xFF
+    for byte in data:
+        crc ^= byte
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x31) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
  
 '''Measure and print 8 channels'''
 if __name__ == '__main__':
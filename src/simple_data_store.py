@@ -1,40 +1,265 @@
 import os
 import json
+import atexit
+import struct
+import threading
+import zlib
 from datetime import datetime
 
 class DiskDataStore:
-    
-    def __init__(self, filename):
+    """
+    Tagged values with timestamps persisted to a JSON file.
+    Every save is atomic (temp file + fsync + rename), so the file is always either the old
+    or the new version. In write-behind mode write() only updates memory; the file is written
+    every flush_interval_secs, when a numeric value moved by delta_threshold or more since it
+    was last saved, on flush() / close() and at interpreter exit.
+
+    In journal mode the JSON file is a snapshot and each saved value is appended to
+    <filename>.journal as one fixed-size record (crc32, tag, value, timestamp), so the cost of
+    a save does not grow with the number of tags. Startup loads the snapshot and replays the
+    journal; once the journal passes compact_threshold_bytes a background thread folds it into
+    a new snapshot. Journal mode stores int and float values only.
+    """
+
+    # crc32 of the rest, tag (utf-8, zero padded), value type, value (int64 or float64), timestamp (epoch secs)
+    JOURNAL_RECORD = struct.Struct('<I48sB7x8sd')
+    JOURNAL_TAG_BYTES = 48
+    _VALUE_INT = 0
+    _VALUE_FLOAT = 1
+
+    def __init__(self, filename, write_behind=False, flush_interval_secs=10.0, delta_threshold=None,
+                 journal=False, compact_threshold_bytes=65536, journal_fsync=True):
         self.filename = filename
+        self.write_behind = write_behind
+        self.flush_interval_secs = flush_interval_secs
+        self.delta_threshold = delta_threshold
+        self.journal = journal
+        self.journal_filename = filename + ".journal"
+        self.compact_threshold_bytes = compact_threshold_bytes
+        self.journal_fsync = journal_fsync
+        self.flush_count = 0
+        self.compaction_count = 0
+        self._lock = threading.RLock()
+        # Serializes snapshot writes (flush thread, delta-triggered write(), compaction) - they share the temp file
+        # and a slower writer must not replace a newer snapshot
+        self._snapshot_lock = threading.Lock()
+        self._dirty_tags = set()
+        self._flush_thread = None
+        self._compaction_thread = None
+        self._compaction_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._journal_fd = None
+        self._journal_size = 0
         self.data = self._load_data()
+        if self.journal:
+            self._replay_journal(self.journal_filename + ".old")
+            self._replay_journal(self.journal_filename)
+            if os.path.exists(self.journal_filename + ".old"):
+                # A compaction was interrupted - finish it before the next one reuses the name
+                self._write_snapshot(json.dumps(self.data))
+                os.remove(self.journal_filename + ".old")
+            self._open_journal()
+            self._compaction_thread = threading.Thread(target=self._run_compaction, name="data-store-compaction", daemon=True)
+            self._compaction_thread.start()
+        self._saved_values = {tag: value for (tag, (value, timestamp)) in self.data.items()}
+        if self.write_behind or self.journal:
+            atexit.register(self.close)
+        if self.write_behind:
+            self._flush_thread = threading.Thread(target=self._run_flush, name="data-store-flush", daemon=True)
+            self._flush_thread.start()
 
     def _load_data(self):
-        """Loads data from the file. Create if DNE"""
+        """Loads data from the file. Starts empty if DNE"""
         if not os.path.exists(self.filename):
-            os.mknod(self.filename)
+            return {}
         try:
             with open(self.filename, 'r') as file:
                 return json.load(file)
-        except FileNotFoundError:
-            print("DiskDataStore: File not found.")
-            return {}
         except json.JSONDecodeError:
-            print("DiskDataStore: JSONDecodeError")
+            # Keep the unreadable file for inspection instead of overwriting it on the next save
+            corrupt_filename = self.filename + ".corrupt"
+            os.replace(self.filename, corrupt_filename)
+            print(f"DiskDataStore: JSONDecodeError - moved to {corrupt_filename}")
             return {}
 
     def _save_data(self):
-        """Saves data to the file."""
-        with open(self.filename, 'w') as file:
-            json.dump(self.data, file)
+        """Saves data to the file - atomically."""
+        with self._snapshot_lock:
+            with self._lock:
+                json_string = json.dumps(self.data)
+                self._saved_values = {tag: value for (tag, (value, timestamp)) in self.data.items()}
+                self._dirty_tags.clear()
+            self._write_snapshot(json_string)
+            self.flush_count += 1
+
+    def _write_snapshot(self, json_string):
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, 'w') as file:
+            file.write(json_string)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_filename, self.filename)
+        self._fsync_directory()
+
+    def _fsync_directory(self):
+        # Make the rename itself durable
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        try:
+            directory_fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(directory_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(directory_fd)
 
     def write(self, tag, value):
         """Writes a number with a timestamp based on the provided tag."""
+        if self.journal:
+            self._check_journal_value(tag, value)
         timestamp = datetime.now().isoformat()
-        self.data[tag] = (value, timestamp)
-        self._save_data()
+        with self._lock:
+            self.data[tag] = (value, timestamp)
+            self._dirty_tags.add(tag)
+            save_now = not self.write_behind or self._exceeds_delta(tag, value)
+        if save_now:
+            self._save()
 
     def read(self, tag):
         """Reads all numbers with their timestamps for the given tag."""
-        if tag not in self.data:
-            return (None, None)
-        return self.data.get(tag, None)
\ No newline at end of file
+        with self._lock:
+            if tag not in self.data:
+                return (None, None)
+            return self.data.get(tag, None)
+
+    def flush(self):
+        """Writes pending changes to the file."""
+        with self._lock:
+            dirty = len(self._dirty_tags) > 0
+        if dirty:
+            self._save()
+
+    def close(self):
+        """Stops the background threads and writes pending changes."""
+        self._stop_event.set()
+        if self._flush_thread != None:
+            self._flush_thread.join(self.flush_interval_secs + 1)
+            self._flush_thread = None
+        if self._compaction_thread != None:
+            self._compaction_event.set()
+            self._compaction_thread.join()
+            self._compaction_thread = None
+        self.flush()
+        with self._lock:
+            if self._journal_fd != None:
+                os.close(self._journal_fd)
+                self._journal_fd = None
+
+    def compact(self):
+        """Folds the journal into a new snapshot."""
+        with self._snapshot_lock:
+            with self._lock:
+                if self._journal_fd == None or self._journal_size == 0:
+                    return
+                # Writes from here on go to a new journal; the old one is replayed over the snapshot
+                # at startup until the snapshot that covers it is in place
+                json_string = json.dumps(self.data)
+                os.close(self._journal_fd)
+                os.replace(self.journal_filename, self.journal_filename + ".old")
+                self._open_journal()
+            self._write_snapshot(json_string)
+            os.remove(self.journal_filename + ".old")
+            self.compaction_count += 1
+
+    def _save(self):
+        if self.journal:
+            self._append_journal()
+        else:
+            self._save_data()
+
+    def _exceeds_delta(self, tag, value):
+        if self.delta_threshold == None:
+            return False
+        saved_value = self._saved_values.get(tag)
+        if not isinstance(value, (int, float)) or not isinstance(saved_value, (int, float)):
+            return saved_value == None
+        return abs(value - saved_value) >= self.delta_threshold
+
+    def _run_flush(self):
+        while not self._stop_event.wait(self.flush_interval_secs):
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"DiskDataStore: flush failed: {e}")
+
+    ''' Journal '''
+
+    def _check_journal_value(self, tag, value):
+        if not isinstance(value, (int, float)):
+            raise Exception(f"DiskDataStore: journal mode stores int and float values only: {tag} = {value!r}")
+        if len(tag.encode('utf-8')) > DiskDataStore.JOURNAL_TAG_BYTES:
+            raise Exception(f"DiskDataStore: journal tag longer than {DiskDataStore.JOURNAL_TAG_BYTES} bytes: {tag}")
+
+    def _open_journal(self):
+        self._journal_fd = os.open(self.journal_filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._journal_size = os.fstat(self._journal_fd).st_size
+
+    def _append_journal(self):
+        with self._lock:
+            records = list()
+            for tag in self._dirty_tags:
+                (value, timestamp) = self.data[tag]
+                records.append(self._pack_record(tag, value, datetime.fromisoformat(timestamp).timestamp()))
+                self._saved_values[tag] = value
+            self._dirty_tags.clear()
+            # One write per save so a batch is never interleaved with another
+            os.write(self._journal_fd, b''.join(records))
+            if self.journal_fsync:
+                os.fsync(self._journal_fd)
+            self._journal_size += len(records) * DiskDataStore.JOURNAL_RECORD.size
+            self.flush_count += 1
+            if self._journal_size >= self.compact_threshold_bytes:
+                self._compaction_event.set()
+
+    def _pack_record(self, tag, value, epoch_secs) -> bytes:
+        if isinstance(value, float):
+            (value_type, value_bytes) = (DiskDataStore._VALUE_FLOAT, struct.pack('<d', value))
+        else:
+            (value_type, value_bytes) = (DiskDataStore._VALUE_INT, struct.pack('<q', value))
+        record = DiskDataStore.JOURNAL_RECORD.pack(0, tag.encode('utf-8'), value_type, value_bytes, epoch_secs)
+        return struct.pack('<I', zlib.crc32(record[4:])) + record[4:]
+
+    def _replay_journal(self, journal_filename):
+        """Applies the journal records over the snapshot - stops at the first torn or corrupt record."""
+        if not os.path.exists(journal_filename):
+            return
+        with open(journal_filename, 'rb') as file:
+            journal_bytes = file.read()
+        record_size = DiskDataStore.JOURNAL_RECORD.size
+        good_size = 0
+        for offset in range(0, len(journal_bytes) - record_size + 1, record_size):
+            record = journal_bytes[offset:offset + record_size]
+            (crc, tag_bytes, value_type, value_bytes, epoch_secs) = DiskDataStore.JOURNAL_RECORD.unpack(record)
+            if crc != zlib.crc32(record[4:]):
+                break
+            value = struct.unpack('<d' if value_type == DiskDataStore._VALUE_FLOAT else '<q', value_bytes)[0]
+            self.data[tag_bytes.rstrip(b'\0').decode('utf-8')] = (value, datetime.fromtimestamp(epoch_secs).isoformat())
+            good_size = offset + record_size
+        if good_size != len(journal_bytes):
+            # Drop the tail so new records are not appended after garbage
+            print(f"DiskDataStore: {journal_filename}: dropped {len(journal_bytes) - good_size} bytes after the last good record")
+            with open(journal_filename, 'r+b') as file:
+                file.truncate(good_size)
+
+    def _run_compaction(self):
+        while True:
+            self._compaction_event.wait()
+            self._compaction_event.clear()
+            if self._stop_event.is_set():
+                return
+            try:
+                self.compact()
+            except OSError as e:
+                print(f"DiskDataStore: compaction failed: {e}")
@@ -0,0 +1,230 @@
+'''
+Structured log sink - one JSON object per line in <directory>/YYYYMMDD.jsonl:
+
+    {"ts": 1760000000.123456, "key": "service", "level": "ERROR", "msg": "Limit Violation: ...", "fields": {...}}
+
+("fields" only when the record has them) plus a sidecar index <file>.idx so a query reads only
+the byte spans that can match instead of the whole file:
+
+    {"size": bytes of the file the index covers,
+     "hours": {"13": [first offset, end offset], ...},
+     "keys": {"service": {"13": [first offset, end offset, record count], ...}, ...},
+     "levels": {"ERROR": {"13": [[start offset, end offset], ...]}, "WARN": {...}}}
+
+Keys interleave, so a key's span covers most of its hours. WARN and ERROR records are rare and
+are listed one by one (adjacent ones merged) - a --level WARN / ERROR query reads only them.
+
+Hours are local time, like the file date. The index is rewritten (temp file + rename) on flush;
+bytes past "size" - records written after the last index save, e.g. before a power cut - are
+indexed again when the writer reopens the file and are scanned linearly by queries.
+StructuredLogWriter is thread-safe - a synchronous Logger calls it from every logging thread.
+'''
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+LEVEL_ORDER = {'DEBUG': -1, 'INFO': 0, 'WARN': 1, 'ERROR': 2}
+# Levels whose records are indexed individually
+INDEXED_LEVELS = ('WARN', 'ERROR')
+
+class StructuredLogIndex:
+
+    def __init__(self, size=0, hours=None, keys=None, levels=None) -> None:
+        self.size = size
+        self.hours = hours if hours != None else dict()
+        self.keys = keys if keys != None else dict()
+        self.levels = levels if levels != None else dict()
+
+    def add(self, hour, key, start, end, level_str=None) -> None:
+        hour = str(hour)
+        hour_span = self.hours.get(hour)
+        if hour_span == None:
+            self.hours[hour] = [start, end]
+        else:
+            hour_span[1] = end
+        key_hours = self.keys.setdefault(key, dict())
+        key_span = key_hours.get(hour)
+        if key_span == None:
+            key_hours[hour] = [start, end, 1]
+        else:
+            key_span[1] = end
+            key_span[2] += 1
+        if level_str in INDEXED_LEVELS:
+            level_spans = self.levels.setdefault(level_str, dict()).setdefault(hour, list())
+            if len(level_spans) > 0 and level_spans[-1][1] == start:
+                level_spans[-1][1] = end
+            else:
+                level_spans.append([start, end])
+        self.size = end
+
+    def get_spans(self, hours, key=None) -> list:
+        '''Sorted, merged [start, end) byte spans of the given hours (of one key) - the unindexed tail excluded'''
+        source = self.hours if key == None else self.keys.get(key, {})
+        return _merge_spans(source[str(hour)][:2] for hour in hours if str(hour) in source)
+
+    def get_level_spans(self, hours, min_level) -> list:
+        '''Sorted, merged spans of the indexed records at min_level or above (min_level WARN or higher)'''
+        min_level_order = LEVEL_ORDER[min_level]
+        return _merge_spans(span for level_str in INDEXED_LEVELS if LEVEL_ORDER[level_str] >= min_level_order
+                            for hour in hours for span in self.levels.get(level_str, {}).get(str(hour), []))
+
+    def to_dict(self) -> dict:
+        return {'size': self.size, 'hours': self.hours, 'keys': self.keys, 'levels': self.levels}
+
+    @staticmethod
+    def load(index_path):
+        try:
+            with open(index_path, 'r') as file:
+                index_dict = json.load(file)
+            if 'levels' not in index_dict:
+                # Written before levels were indexed - rebuilt by the writer, read in full by queries
+                return StructuredLogIndex()
+            return StructuredLogIndex(index_dict['size'], index_dict['hours'], index_dict['keys'], index_dict['levels'])
+        except (OSError, ValueError, KeyError):
+            return StructuredLogIndex()
+
+    def save(self, index_path) -> None:
+        temp_path = index_path + ".tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(self.to_dict(), file, separators=(',', ':'))
+        os.replace(temp_path, index_path)
+
+def _merge_spans(spans) -> list:
+    '''Sorted [start, end) spans with the overlapping and adjacent ones merged'''
+    merged = list()
+    for (start, end) in sorted(list(span) for span in spans):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+class StructuredLogWriter:
+
+    FILE_DATE_FORMAT = '%Y%m%d.jsonl'
+
+    def __init__(self, directory="log", flush_interval_secs=1.0) -> None:
+        self._directory = directory
+        self._flush_interval_secs = flush_interval_secs
+        self._file = None
+        self._file_path = None
+        self._index = None
+        self._dirty = False
+        self._last_flush = time.monotonic()
+        # File offset, write and index update must not interleave; close() and rollover flush under it too
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, timestamp : datetime, key, level_str, msg, fields=None) -> None:
+        record = {'ts': round(timestamp.timestamp(), 6), 'key': key, 'level': level_str, 'msg': msg}
+        if fields:
+            record['fields'] = fields
+        line = (json.dumps(record, default=str, separators=(',', ':')) + "\n").encode('utf8')
+        with self._lock:
+            self._open_day_file(timestamp)
+            start = self._file.tell()
+            self._file.write(line)
+            self._index.add(timestamp.hour, key, start, start + len(line), level_str)
+            self._dirty = True
+            if time.monotonic() - self._last_flush >= self._flush_interval_secs:
+                self.flush()
+
+    def flush(self) -> None:
+        '''Write buffered records, then the index that covers them'''
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._dirty:
+                return
+            self._file.flush()
+            self._index.save(self._file_path + ".idx")
+            self._dirty = False
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file != None:
+                self.flush()
+                self._file.close()
+                self._file = None
+
+    def _open_day_file(self, timestamp):
+        file_path = os.path.join(self._directory, timestamp.strftime(self.FILE_DATE_FORMAT))
+        if file_path == self._file_path:
+            return
+        self.close()
+        self._file_path = file_path
+        self._index = StructuredLogIndex.load(file_path + ".idx")
+        self._file = open(file_path, 'ab')
+        file_size = self._file.tell()
+        if self._index.size > file_size:
+            # Index newer than the file (file replaced) - start over
+            self._index = StructuredLogIndex()
+        if self._index.size < file_size:
+            self._reindex_tail(file_size)
+
+    def _reindex_tail(self, file_size):
+        # Records written after the last index save
+        with open(self._file_path, 'rb') as file:
+            file.seek(self._index.size)
+            offset = self._index.size
+            for line in file:
+                if line.endswith(b"\n"):
+                    try:
+                        record = json.loads(line)
+                        self._index.add(datetime.fromtimestamp(record['ts']).hour, record['key'], offset, offset + len(line),
+                                        record.get('level'))
+                    except (ValueError, KeyError):
+                        pass
+                offset += len(line)
+        if not line.endswith(b"\n"):
+            # Torn last record - terminate it so the next record starts on its own line
+            self._file.write(b"\n")
+            file_size += 1
+        self._index.size = file_size
+        self._dirty = True
+
+def query(directory, start : datetime, end : datetime, key=None, min_level=None, contains=None):
+    '''
+    Records (dicts) with start <= ts < end, oldest first - reads only the indexed spans that can match:
+    the WARN / ERROR records themselves for min_level WARN or higher, else the hours (of the key).
+    '''
+    min_level_order = LEVEL_ORDER.get(min_level, None) if min_level != None else None
+    start_ts = start.timestamp()
+    end_ts = end.timestamp()
+    day = datetime(start.year, start.month, start.day)
+    while day < end:
+        file_path = os.path.join(directory, day.strftime(StructuredLogWriter.FILE_DATE_FORMAT))
+        if os.path.exists(file_path):
+            hours = [hour for hour in range(24) if day + timedelta(hours=hour + 1) > start and day + timedelta(hours=hour) < end]
+            index = StructuredLogIndex.load(file_path + ".idx")
+            if min_level_order != None and min_level_order >= LEVEL_ORDER[INDEXED_LEVELS[0]]:
+                spans = index.get_level_spans(hours, min_level)
+            else:
+                spans = index.get_spans(hours, key)
+            spans.append([index.size, None])
+            with open(file_path, 'rb') as file:
+                for (span_start, span_end) in spans:
+                    file.seek(span_start)
+                    span_bytes = file.read() if span_end == None else file.read(span_end - span_start)
+                    for line in span_bytes.splitlines():
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        if not (start_ts <= record['ts'] < end_ts):
+                            continue
+                        if key != None and record['key'] != key:
+                            continue
+                        if min_level_order != None and LEVEL_ORDER.get(record['level'], 0) < min_level_order:
+                            continue
+                        if contains != None and contains not in record['msg']:
+                            continue
+                        yield record
+        day += timedelta(days=1)
+
+def format_record(record) -> str:
+    '''Same layout as the text log'''
+    header = "[{0}][{1}][{2}]".format(datetime.fromtimestamp(record['ts']), record['key'], record['level']).ljust(50)
+    fields = record.get('fields')
+    return header + record['msg'] + ("" if not fields else f"  {json.dumps(fields, default=str)}")
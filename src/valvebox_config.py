@@ -17,7 +17,9 @@ class ConfigManager:
     _log_key = "config"
     
     # Public Class Constants
-    NUMBER_OF_VALVES = 4
+    NUMBER_OF_VALVES = 4                # Default when the config has no 'number_of_valves'
+    VALVES_PER_IO_EXPANDER = 4          # Kitchen Sink layout - 8 inputs on port A, 8 outputs on port B
+    DEFAULT_IO_EXPANDER_ADDRESS = 0x21
 
     # Public Class Members
     active_config = None
@@ -128,11 +130,60 @@ class ConfigManager:
         # All Topics
         self.active_config['base_topic'] = '/ValveBox'
         
+        # Subscribe Topics - System
+        self.active_config['subscribe']['i2c_trace_dump'] = 'i2c_trace_dump'
+        
+        # I2C Transaction Trace (diagnostics) - dumped on SIGUSR1 or a message on subscribe/i2c_trace_dump
+        self.active_config['i2c_trace']['enabled'] = False
+        self.active_config['i2c_trace']['depth'] = 4096
+        self.active_config['i2c_trace']['dump_directory'] = 'trace'
+        
         # Publish Topics - System
         self.active_config['publish']['system_state'] = 'system_state'
         self.active_config['publish']['system_error'] = 'system_error'
         self.active_config['publish']['flow_counter'] = 'flow_counter'
         
+        # Flow Meters - channel A (GP16) then channel B (GP26); K-factor in pulses per unit volume
+        # Edges closer than debounce_ms are ignored - it caps the pulse rate at 1000 / debounce_ms Hz
+        # Publishes rate, rate_1m, rate_15m (volume per minute) and volume per channel
+        self.active_config['flow_meter']['publish_interval_secs'] = 5
+        self.active_config['flow_meter']['debounce_ms'] = 5
+        self.active_config['flow_meter']['channels'] = list()
+        for (flow_name, attribute_to_valves) in (('flow_a', True), ('flow_b', False)):
+            self.active_config['flow_meter']['channels'].append({'name': flow_name, 'k_factor': 1.0,
+                                                                 'attribute_to_valves': attribute_to_valves,
+                                                                 'publish': {'rate': f'{flow_name}/rate',
+                                                                             'rate_1m': f'{flow_name}/rate_1m',
+                                                                             'rate_15m': f'{flow_name}/rate_15m',
+                                                                             'volume': f'{flow_name}/volume'}})
+        
+        # Data Store - counters are kept in memory and written every flush_interval_secs, when a count
+        # moved by flush_delta_threshold since the last write, and at exit (SIGINT / SIGTERM)
+        self.active_config['data_store']['write_behind'] = True
+        self.active_config['data_store']['flush_interval_secs'] = 30
+        self.active_config['data_store']['flush_delta_threshold'] = 100
+        # Journal - each write appends a fixed-size record, folded into the JSON snapshot past journal_compact_bytes
+        self.active_config['data_store']['journal'] = True
+        self.active_config['data_store']['journal_compact_bytes'] = 65536
+        
+        # Logging - minimum level (DEBUG, INFO, WARN, ERROR) and per log key overrides, e.g. {'monitor': 'WARN'}
+        self.active_config['logging']['min_level'] = 'INFO'
+        self.active_config['logging']['key_min_levels'] = {}
+        
+        # On-device history (SQLite) - raw samples with 1 minute / 1 hour rollups; the oldest rows are pruned to stay under budget_mb
+        self.active_config['history']['enabled'] = True
+        self.active_config['history']['path'] = 'history/valvebox_history.db'
+        self.active_config['history']['budget_mb'] = 64
+        self.active_config['history']['batch_size'] = 500
+        self.active_config['history']['flush_interval_secs'] = 5
+
+        # I/O Expanders - MCP23017 addresses (0x20 - 0x27), pins are addressed as [expander index, pin]
+        # Pi GPIO wired to each expander's INTA output (None = poll the limit switches only)
+        self.active_config['number_of_valves'] = ConfigManager.NUMBER_OF_VALVES
+        expander_count = (ConfigManager.NUMBER_OF_VALVES + ConfigManager.VALVES_PER_IO_EXPANDER - 1) // ConfigManager.VALVES_PER_IO_EXPANDER
+        self.active_config['io_expander']['addresses'] = [ConfigManager.DEFAULT_IO_EXPANDER_ADDRESS + index for index in range(expander_count)]
+        self.active_config['io_expander']['interrupt_bcm_pins'] = [None] * expander_count
+        
         # Publish Topics - Per Valve
         for index in range(ConfigManager.NUMBER_OF_VALVES):
             valve_topic = f'valve_{index + 1}'
@@ -141,20 +192,60 @@ class ConfigManager:
             self.active_config[valve_topic]['publish']['position'] = f'{valve_topic}/valve_position'
             self.active_config[valve_topic]['publish']['open_time_secs'] = f'{valve_topic}/pump_run_time_secs'
             self.active_config[valve_topic]['publish']['error_message'] = f'{valve_topic}/error_message'
+            self.active_config[valve_topic]['publish']['volume'] = f'{valve_topic}/volume'
                 
-            # Pins
-            self.active_config[valve_topic]['open_pin'] = 2*index
-            self.active_config[valve_topic]['close_pin'] = 1 + 2*index
-            self.active_config[valve_topic]['direction_pin'] = 8 + 2*index
-            self.active_config[valve_topic]['enable_pin'] = 9 + 2*index
+            # Pins - [expander index, pin]
+            expander_index = index // ConfigManager.VALVES_PER_IO_EXPANDER
+            pin_index = index % ConfigManager.VALVES_PER_IO_EXPANDER
+            self.active_config[valve_topic]['open_pin'] = [expander_index, 2*pin_index]
+            self.active_config[valve_topic]['close_pin'] = [expander_index, 1 + 2*pin_index]
+            self.active_config[valve_topic]['direction_pin'] = [expander_index, 8 + 2*pin_index]
+            self.active_config[valve_topic]['enable_pin'] = [expander_index, 9 + 2*pin_index]
             self.active_config[valve_topic]['transition_time_secs'] = 20
     
     def get_valve_configs(self) -> dict:
         valve_configs = dict()
-        for index in range(ConfigManager.NUMBER_OF_VALVES):
+        for index in range(self.get_number_of_valves()):
             valve_topic = f'valve_{index + 1}'    
             valve_configs[valve_topic] = self.active_config[valve_topic]   
         return valve_configs 
+    
+    def get_flow_meter_config(self) -> dict:
+        return self.active_config.get('flow_meter', {})
+    
+    def get_number_of_valves(self) -> int:
+        return self.active_config.get('number_of_valves', ConfigManager.NUMBER_OF_VALVES)
+    
+    def get_io_expander_addresses(self) -> list:
+        return self.active_config.get('io_expander', {}).get('addresses', [ConfigManager.DEFAULT_IO_EXPANDER_ADDRESS])
+    
+    def get_io_expander_interrupt_pins(self) -> list:
+        '''Pi GPIO (BCM) wired to each expander INTA output, None if not wired'''
+        interrupt_pins = list(self.active_config.get('io_expander', {}).get('interrupt_bcm_pins', []))
+        expander_count = len(self.get_io_expander_addresses())
+        return (interrupt_pins + [None] * expander_count)[:expander_count]
+    
+    '''
+    Pin assignment of a valve as (expander index, open pin, close pin, direction pin, enable pin).
+    Pins may be a plain pin number (expander 0) or [expander index, pin]; all four pins of a valve
+    must share one expander so the direction / enable write stays a single transaction.
+    '''
+    def get_valve_pin_assignment(self, valve_topic : str) -> tuple:
+        valve_config = self.active_config[valve_topic]
+        expander_pins = list()
+        for pin_key in ('open_pin', 'close_pin', 'direction_pin', 'enable_pin'):
+            pin_value = valve_config[pin_key]
+            if isinstance(pin_value, int):
+                expander_pins.append((0, pin_value))
+            else:
+                expander_pins.append((int(pin_value[0]), int(pin_value[1])))
+        expander_index = expander_pins[0][0]
+        for (pin_expander_index, pin) in expander_pins:
+            if pin_expander_index != expander_index:
+                raise Exception(f"{valve_topic}: all pins of a valve must be on the same I/O expander")
+        if expander_index < 0 or expander_index >= len(self.get_io_expander_addresses()):
+            raise Exception(f"{valve_topic}: unknown I/O expander index {expander_index}")
+        return (expander_index,) + tuple(pin for (pin_expander_index, pin) in expander_pins)
                     
     '''
     Recursively convert all defaultdicts to dicts; useful for JSON serialization
@@ -0,0 +1,310 @@
+'''
+High-rate waveform capture of one ADS7828 channel into a memory-mapped circular file.
+
+A capture thread streams raw 12-bit codes (and time.monotonic_ns() timestamps) into the ring.
+trigger() freezes the samples around an event - pre_trigger_samples before it and
+post_trigger_samples after it - into a separate file in the capture directory.
+
+The capture thread shares the I2C bus with the ContinuousSampler that feeds the motor current
+limits, at the same priority. Every sample it reads is bus time the protection sampling cannot
+use, so keep rate_hz finite - rate_hz 0 (as fast as the bus allows) is for bench use only.
+
+File layout (native little-endian, same for the ring and frozen captures):
+    header '<4sHBBQQdd' padded to 64 bytes:
+        magic, version, channel, flags (1 = circular, 2 = lookup table), capacity, write count (total samples
+        written - the ring holds the last min(write count, capacity)), gain, offset (units = gain * code + offset)
+    codes       uint16[capacity]
+    timestamps  int64[capacity]  (8-byte aligned)
+    lut         float64[4096]    (flag 2 only: units = lut[code] for a channel on a non-linear calibration
+                                  curve - gain and offset are NaN)
+'''
+from array import array
+import mmap
+import struct
+import threading
+import datetime
+import time
+import os
+import sys
+
+import ads7828
+
+# numpy is optional - without it the reader returns memoryviews
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+WAVEFORM_MAGIC = b'WFRM'
+WAVEFORM_VERSION = 1
+HEADER_SIZE = 64
+FLAG_CIRCULAR = 0x01
+FLAG_LUT = 0x02
+_HEADER_FORMAT = '<4sHBBQQdd'
+_WRITE_COUNT_OFFSET = 16
+
+def _timestamps_offset(capacity) -> int:
+    return HEADER_SIZE + ((2 * capacity + 7) // 8) * 8
+
+def _file_size(capacity, lut_size=0) -> int:
+    return _timestamps_offset(capacity) + 8 * capacity + 8 * lut_size
+
+class WaveformCapture:
+
+    # Samples read per bus burst before they are copied into the ring
+    BLOCK_SIZE = 64
+
+    def __init__(self, adc : ads7828.ADS7828, channel_index, ring_file_path, capacity_samples=65536,
+                 pre_trigger_samples=4096, post_trigger_samples=4096, capture_directory="capture",
+                 gain=1.0, offset=0.0, rate_hz=1000, trigger_holdoff_secs=10.0, on_capture=None, lut=None) -> None:
+        '''gain/offset convert a linear channel; a non-linear one passes its lookup table (array('d') indexed by code) as lut'''
+        if pre_trigger_samples + post_trigger_samples + self.BLOCK_SIZE > capacity_samples:
+            raise Exception("WaveformCapture: capacity must hold the pre and post trigger windows plus one block")
+        self._adc = adc
+        self.channel_index = channel_index
+        self.capacity = capacity_samples
+        self.pre_trigger_samples = pre_trigger_samples
+        self.post_trigger_samples = post_trigger_samples
+        self.capture_directory = capture_directory
+        self.gain = gain
+        self.offset = offset
+        self.lut = lut
+        if lut != None:
+            (self.gain, self.offset) = (float('NaN'), float('NaN'))
+        self._block_period_secs = (self.BLOCK_SIZE / rate_hz) if rate_hz > 0 else 0   # 0 = as fast as the bus allows
+        self._trigger_holdoff_secs = trigger_holdoff_secs
+        self._on_capture = on_capture
+        self._block_codes = array('H', bytes(2 * self.BLOCK_SIZE))
+        self._block_timestamps = array('q', bytes(8 * self.BLOCK_SIZE))
+        self._write_count = 0
+        self._pending_trigger = None      # (write count at the trigger, reason)
+        self._last_trigger_time = None
+        self._trigger_lock = threading.Lock()
+        self._thread = None
+        self._stop_event = threading.Event()
+        self.capture_count = 0
+        self.ignored_trigger_count = 0
+        self.error_count = 0
+        self._open_ring_file(ring_file_path)
+
+    def start(self) -> None:
+        if self._thread != None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="waveform-capture", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1.0) -> None:
+        if self._thread == None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def close(self) -> None:
+        self.stop()
+        self._codes.release()
+        self._timestamps.release()
+        self._write_count_view.release()
+        self._mmap.close()
+
+    def trigger(self, reason="") -> bool:
+        '''Freeze the window around now to disk once the post-trigger samples are in; False if ignored'''
+        with self._trigger_lock:
+            now = time.monotonic()
+            if self._pending_trigger != None or (self._last_trigger_time != None and
+                                                 now - self._last_trigger_time < self._trigger_holdoff_secs):
+                self.ignored_trigger_count += 1
+                return False
+            self._last_trigger_time = now
+            self._pending_trigger = (self._write_count, reason)
+            return True
+
+    def get_write_count(self) -> int:
+        return self._write_count
+
+    def _open_ring_file(self, ring_file_path):
+        folder_path = os.path.dirname(ring_file_path)
+        if folder_path != "" and not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        lut_size = len(self.lut) if self.lut != None else 0
+        file_size = _file_size(self.capacity, lut_size)
+        with open(ring_file_path, 'w+b') as ring_file:
+            ring_file.truncate(file_size)
+            self._mmap = mmap.mmap(ring_file.fileno(), file_size)
+        flags = FLAG_CIRCULAR | (FLAG_LUT if self.lut != None else 0)
+        struct.pack_into(_HEADER_FORMAT, self._mmap, 0, WAVEFORM_MAGIC, WAVEFORM_VERSION, self.channel_index,
+                         flags, self.capacity, 0, self.gain, self.offset)
+        if self.lut != None:
+            self._mmap[_file_size(self.capacity):] = self.lut.tobytes()
+        file_view = memoryview(self._mmap)
+        timestamps_offset = _timestamps_offset(self.capacity)
+        self._codes = file_view[HEADER_SIZE:HEADER_SIZE + 2 * self.capacity].cast('H')
+        self._timestamps = file_view[timestamps_offset:timestamps_offset + 8 * self.capacity].cast('q')
+        self._write_count_view = file_view[_WRITE_COUNT_OFFSET:_WRITE_COUNT_OFFSET + 8].cast('Q')
+        file_view.release()
+
+    def _run(self):
+        next_block_time = time.monotonic()
+        while not self._stop_event.is_set():
+            if self._block_period_secs > 0:
+                wait_secs = next_block_time - time.monotonic()
+                if wait_secs > 0 and self._stop_event.wait(wait_secs):
+                    break
+                next_block_time = max(next_block_time + self._block_period_secs, time.monotonic())
+            self.error_count += self._adc.read_raw_block(self.channel_index, self._block_codes, self._block_timestamps)
+            self._append_block()
+            pending_trigger = self._pending_trigger
+            if pending_trigger != None and self._write_count >= pending_trigger[0] + self.post_trigger_samples:
+                self._freeze(*pending_trigger)
+
+    def _append_block(self):
+        start = self._write_count % self.capacity
+        first_part = min(self.BLOCK_SIZE, self.capacity - start)
+        self._codes[start:start + first_part] = self._block_codes[:first_part]
+        self._timestamps[start:start + first_part] = self._block_timestamps[:first_part]
+        if first_part < self.BLOCK_SIZE:
+            remaining = self.BLOCK_SIZE - first_part
+            self._codes[:remaining] = self._block_codes[first_part:]
+            self._timestamps[:remaining] = self._block_timestamps[first_part:]
+        self._write_count += self.BLOCK_SIZE
+        self._write_count_view[0] = self._write_count
+
+    def _freeze(self, trigger_write_count, reason):
+        # Copy the window out of the ring now; the file is written on a separate thread
+        first_sample = max(trigger_write_count - self.pre_trigger_samples, self._write_count - self.capacity, 0)
+        last_sample = trigger_write_count + self.post_trigger_samples
+        codes = array('H')
+        timestamps = array('q')
+        for (start, stop) in self._ring_ranges(first_sample, last_sample):
+            codes.frombytes(self._codes[start:stop].tobytes())
+            timestamps.frombytes(self._timestamps[start:stop].tobytes())
+        with self._trigger_lock:
+            self._pending_trigger = None
+        file_name = datetime.datetime.now().strftime(f"waveform_ch{self.channel_index}_%Y%m%d_%H%M%S.bin")
+        file_path = os.path.join(self.capture_directory, file_name)
+        threading.Thread(target=self._write_capture, args=(file_path, codes, timestamps, reason),
+                         name="waveform-capture-write", daemon=True).start()
+
+    def _ring_ranges(self, first_sample, last_sample) -> list:
+        start = first_sample % self.capacity
+        count = last_sample - first_sample
+        if start + count <= self.capacity:
+            return [(start, start + count)]
+        return [(start, self.capacity), (0, start + count - self.capacity)]
+
+    def _write_capture(self, file_path, codes, timestamps, reason):
+        write_capture_file(file_path, self.channel_index, codes, timestamps, self.gain, self.offset, self.lut)
+        self.capture_count += 1
+        if self._on_capture != None:
+            self._on_capture(file_path, reason)
+
+def write_capture_file(file_path, channel_index, codes : array, timestamps_ns : array, gain=1.0, offset=0.0, lut=None) -> None:
+    '''Write a frozen (non-circular) capture - lut (array('d') indexed by code) replaces gain and offset'''
+    folder_path = os.path.dirname(file_path)
+    if folder_path != "" and not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+    capacity = len(codes)
+    with open(file_path, 'wb') as capture_file:
+        if lut != None:
+            (gain, offset) = (float('NaN'), float('NaN'))
+        header = struct.pack(_HEADER_FORMAT, WAVEFORM_MAGIC, WAVEFORM_VERSION, channel_index,
+                             FLAG_LUT if lut != None else 0, capacity, capacity, gain, offset)
+        capture_file.write(header.ljust(HEADER_SIZE, b'\0'))
+        capture_file.write(codes.tobytes().ljust(_timestamps_offset(capacity) - HEADER_SIZE, b'\0'))
+        capture_file.write(timestamps_ns.tobytes())
+        if lut != None:
+            capture_file.write(lut.tobytes())
+
+class WaveformFile:
+    '''
+    A capture file opened read-only through mmap.
+    codes and timestamps_ns are numpy views (memoryviews without numpy) onto the file in storage
+    order - no copy is made. In a circular file that has wrapped the oldest sample is at oldest_index.
+    lut is the lookup table of a non-linear channel (None when gain and offset apply).
+    close() (or a with block) unmaps the file - drop any views taken from it first.
+    '''
+
+    def __init__(self, file_path) -> None:
+        with open(file_path, 'rb') as waveform_file:
+            self._mmap = mmap.mmap(waveform_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.channel_index, flags, self.capacity, self.write_count,
+         self.gain, self.offset) = struct.unpack_from(_HEADER_FORMAT, self._mmap, 0)
+        if magic != WAVEFORM_MAGIC or version != WAVEFORM_VERSION or len(self._mmap) < _file_size(self.capacity):
+            raise Exception(f"WaveformFile: unsupported waveform file: {file_path}")
+        self.circular = (flags & FLAG_CIRCULAR) != 0
+        self.sample_count = min(self.write_count, self.capacity)
+        self.oldest_index = (self.write_count % self.capacity) if self.write_count > self.capacity else 0
+        timestamps_offset = _timestamps_offset(self.capacity)
+        lut_offset = _file_size(self.capacity)
+        lut_size = (len(self._mmap) - lut_offset) // 8 if flags & FLAG_LUT else 0
+        self.lut = None
+        self._file_view = None
+        if np != None:
+            self.codes = np.frombuffer(self._mmap, dtype='<u2', count=self.sample_count, offset=HEADER_SIZE)
+            self.timestamps_ns = np.frombuffer(self._mmap, dtype='<i8', count=self.sample_count, offset=timestamps_offset)
+            if lut_size > 0:
+                self.lut = np.frombuffer(self._mmap, dtype='<f8', count=lut_size, offset=lut_offset)
+        else:
+            self._file_view = memoryview(self._mmap)
+            self.codes = self._file_view[HEADER_SIZE:HEADER_SIZE + 2 * self.sample_count].cast('H')
+            self.timestamps_ns = self._file_view[timestamps_offset:timestamps_offset + 8 * self.sample_count].cast('q')
+            if lut_size > 0:
+                self.lut = self._file_view[lut_offset:lut_offset + 8 * lut_size].cast('d')
+
+    def close(self) -> None:
+        '''Unmap the file - raises BufferError while a view of it (e.g. from ordered()) is still referenced'''
+        if self._mmap == None:
+            return
+        for view in (self.codes, self.timestamps_ns, self.lut, self._file_view):
+            if isinstance(view, memoryview):
+                view.release()
+        (self.codes, self.timestamps_ns, self.lut, self._file_view) = (None, None, None, None)
+        self._mmap.close()
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def ordered(self) -> tuple:
+        '''(codes, timestamps_ns) oldest first - a view when the file has not wrapped, else a copy'''
+        if self.oldest_index == 0:
+            return (self.codes, self.timestamps_ns)
+        if np != None:
+            return (np.roll(self.codes, -self.oldest_index), np.roll(self.timestamps_ns, -self.oldest_index))
+        split = self.oldest_index
+        return (array('H', self.codes[split:]) + array('H', self.codes[:split]),
+                array('q', self.timestamps_ns[split:]) + array('q', self.timestamps_ns[:split]))
+
+    def to_units(self, codes=None):
+        '''Engineering units of codes (default: all samples in storage order) - a new array'''
+        if codes is None:
+            codes = self.codes
+        invalid_code = ads7828.ADS7828.INVALID_CODE
+        if self.lut is not None:
+            if np != None:
+                valid = codes < len(self.lut)
+                units = self.lut[np.where(valid, codes, 0)]
+                units[~valid] = np.nan
+                return units
+            return [float('NaN') if code >= len(self.lut) else self.lut[code] for code in codes]
+        if np != None:
+            units = codes * self.gain + self.offset
+            units[codes == invalid_code] = np.nan
+            return units
+        return [float('NaN') if code == invalid_code else code * self.gain + self.offset for code in codes]
+
+'''Print a capture file: python waveform_capture.py <capture file>'''
+if __name__ == '__main__':
+    with WaveformFile(sys.argv[1]) as waveform:
+        (codes, timestamps_ns) = waveform.ordered()
+        units = waveform.to_units(codes)
+        print(f"Channel {waveform.channel_index}: {waveform.sample_count} samples")
+        if waveform.sample_count > 1:
+            duration_secs = (timestamps_ns[-1] - timestamps_ns[0]) / 1e9
+            print(f"Duration: {duration_secs:.3f} secs\tRate: {(waveform.sample_count - 1) / duration_secs:.0f} Hz")
+            print(f"Min: {min(units):.3f}\tMax: {max(units):.3f}")
+        del codes, timestamps_ns
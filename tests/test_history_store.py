@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import history_store
+
+class HistoryStoreBudgetTest(unittest.TestCase):
+
+    SERIES_COUNT = 50
+    BUCKET_COUNT = 500
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.store = history_store.HistoryStore(os.path.join(self._directory.name, 'history.db'))
+        self.connection = self.store._connect()
+
+    def tearDown(self):
+        self.connection.close()
+        self._directory.cleanup()
+
+    def _fill_rollups(self, table):
+        with self.connection:
+            for series_index in range(self.SERIES_COUNT):
+                series_id = self.store._get_series_id(self.connection, f'series_{series_index}')
+                self.connection.executemany(f'INSERT INTO {table} (series_id, bucket, count, sum, min, max) VALUES (?, ?, 1, 1.0, 1.0, 1.0)',
+                                            [(series_id, bucket) for bucket in range(self.BUCKET_COUNT)])
+
+    def _over_budget_by(self, excess_bytes):
+        self.store.budget_bytes = self.store._get_used_bytes(self.connection) - excess_bytes
+        self.store._enforce_budget(self.connection)
+
+    def _check_rollup_pruning(self, table):
+        self._fill_rollups(table)
+        self._over_budget_by(4096)
+        (row_count, bucket_count, oldest_bucket) = self.connection.execute(
+            f'SELECT count(*), count(DISTINCT bucket), min(bucket) FROM {table}').fetchone()
+        # Many series share each bucket - a few buckets go, not the table
+        self.assertGreater(bucket_count, self.BUCKET_COUNT // 2)
+        self.assertEqual(row_count, bucket_count * self.SERIES_COUNT)
+        self.assertEqual(oldest_bucket, self.BUCKET_COUNT - bucket_count)
+        self.assertLessEqual(self.store._get_used_bytes(self.connection), self.store.budget_bytes)
+
+    def test_budget_prunes_oldest_1m_buckets_of_many_series(self):
+        self._check_rollup_pruning('rollup_1m')
+
+    def test_budget_prunes_oldest_1h_buckets_of_many_series(self):
+        self._check_rollup_pruning('rollup_1h')
+
+    def test_budget_prunes_raw_samples_before_rollups(self):
+        for timestamp in range(20000):
+            for series_index in range(self.SERIES_COUNT // 10):
+                self.store.record(f'series_{series_index}', 1.0, timestamp=timestamp)
+        self.store.start()
+        self.assertTrue(self.store.flush())
+        self.store.stop()
+        rollup_1m_count = self.connection.execute('SELECT count(*) FROM rollup_1m').fetchone()[0]
+        self._over_budget_by(4096)
+        self.assertGreater(self.connection.execute('SELECT count(*) FROM samples_raw').fetchone()[0], 0)
+        self.assertEqual(self.connection.execute('SELECT count(*) FROM rollup_1m').fetchone()[0], rollup_1m_count)
+
+if __name__ == '__main__':
+    unittest.main()